@@ -0,0 +1,118 @@
+import logging
+import time
+from typing import Callable, Dict, Hashable, List, Optional
+
+import gevent
+from gevent.queue import Queue, Empty
+
+from metrics import Gauge, Histogram
+
+logger = logging.getLogger(__name__)
+
+
+class Actors:
+    """
+    Greenlets owning state of keys, every key has at most one greenlet handling the commands sent to it
+
+    Commands are handled in the order in which they were sent, those queued while the actor was busy
+    are handled together as one batch. An actor which got no command for idle_timeout seconds evicts
+    the state of its key and exits, the next command starts a new one
+    """
+
+    def __init__(self, handle: Callable[[Hashable, List[any]], None], evict: Optional[Callable[[Hashable], None]] = None,
+                 batch_size: int = 100, idle_timeout: float = 300.0, count: Optional[Gauge] = None,
+                 batch_sizes: Optional[Histogram] = None):
+        """
+        :param handle: handles a batch of commands sent to a key, called by the actor of the key
+        :param evict: drops the state of a key whose actor exits, called by the actor of the key
+        :param batch_size: how many commands are handled at most in one batch
+        :param idle_timeout: how long (in seconds) does an actor without commands wait before it exits
+        :param count: actors running
+        :param batch_sizes: counts of commands handled in one batch
+        """
+        self.handle = handle
+        self.evict = evict
+        self.batch_size = batch_size
+        self.idle_timeout = idle_timeout
+        self.count = count
+        self.batch_sizes = batch_sizes
+        # key -> commands waiting for its actor
+        self.__mailboxes: Dict[Hashable, Queue] = {}
+        # key -> time.monotonic() when was it last used
+        self.__used: Dict[Hashable, float] = {}
+        # how many actors are handling a batch
+        self.__busy = 0
+
+    def tell(self, key: Hashable, command: any) -> None:
+        """
+        Queues a command for the actor of a key, starting the actor if needed
+        :param key: key owned by the actor
+        :param command: the command
+        :return: None
+        """
+        self.__mailbox(key).put(command)
+
+    def touch(self, key: Hashable) -> None:
+        """
+        Keeps the state of a key used without a command, it is evicted idle_timeout seconds after this
+        :param key: the key
+        :return: None
+        """
+        self.__mailbox(key)
+
+    def __mailbox(self, key: Hashable) -> Queue:
+        self.__used[key] = time.monotonic()
+        mailbox = self.__mailboxes.get(key)
+        if mailbox is None:
+            mailbox = self.__mailboxes[key] = Queue()
+            gevent.spawn(self.__run, key, mailbox)
+            if self.count is not None:
+                self.count.inc()
+        return mailbox
+
+    def __run(self, key: Hashable, mailbox: Queue) -> None:
+        try:
+            while True:
+                try:
+                    batch = [mailbox.get(timeout=max(0.0, self.__used[key] + self.idle_timeout - time.monotonic()))]
+                except Empty:
+                    if time.monotonic() - self.__used[key] < self.idle_timeout:
+                        continue  # touched meanwhile
+                    if self.evict is not None:
+                        try:
+                            self.evict(key)
+                        except Exception:
+                            logger.exception('eviction of %s failed', key)
+                    # commands sent while evicting are handled by this actor
+                    if mailbox.empty() and time.monotonic() - self.__used[key] >= self.idle_timeout:
+                        return
+                    continue
+                while len(batch) < self.batch_size and not mailbox.empty():
+                    batch.append(mailbox.get_nowait())
+                if self.batch_sizes is not None:
+                    self.batch_sizes.observe(len(batch))
+                self.__busy += 1
+                try:
+                    self.handle(key, batch)
+                except Exception:
+                    logger.exception('actor of %s failed', key)
+                finally:
+                    self.__busy -= 1
+        finally:
+            del self.__mailboxes[key]
+            del self.__used[key]
+            if self.count is not None:
+                self.count.dec()
+
+    def join(self, timeout: Optional[float] = None) -> bool:
+        """
+        Waits until all queued commands are handled
+        :param timeout: how long (in seconds) to wait at most, None to wait until they are handled
+        :return: True if all commands were handled
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.__busy or any(not mailbox.empty() for mailbox in self.__mailboxes.values()):
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            gevent.sleep(0.05)
+        return True
@@ -1,17 +1,60 @@
+import hmac
 import json
+import logging
+import os
+import random
+import re
+import signal
+import socket
+import sqlite3
 import sys
+import tempfile
 import time
 
+from collections import deque
+from datetime import datetime, timedelta
+from decimal import Decimal
+from functools import partial
+from itertools import count
 from os import path
-from typing import Optional, Tuple, List, Dict
+from typing import Optional, Tuple, List, Dict, Iterable, Set, Callable, Union, Deque
 from uuid import uuid4 as uuid
 
-from flask import Flask, render_template, Blueprint, url_for
+from flask import Flask, render_template, Blueprint, url_for, Response, copy_current_request_context, \
+    request as http_request
 from flask_sockets import Sockets
+import gevent
 from gevent import monkey
+from gevent.event import Event
+from gevent.local import local
+from gevent.pool import Pool
+# noinspection PyPackageRequirements
+from geventwebsocket.exceptions import WebSocketError
+# noinspection PyPackageRequirements
+from geventwebsocket.handler import WebSocketHandler
 # noinspection PyPackageRequirements
 from geventwebsocket.websocket import WebSocket
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import or_, and_, event, func, inspect, select, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import validates
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.schema import CreateColumn
+
+from actors import Actors
+from assets import AssetStore, CACHE_CONTROL, SCRIPTS as ASSET_SCRIPTS
+from backup import TableRows, copy_database, pack_game, unpack_game
+from bus import EventBus, LocalBus, SocketBus, BusBroker, LOBBY, user_channel, game_channel
+from dbthreads import DatabaseThreads
+from ledger import LedgerEngine, TransferError, PlayerRow, Balances, BalanceChange, Deltas, StoredTransfer, \
+    Transfer, MONEY_QUANTUM, parse_amount, format_amount
+from metrics import Counter, Gauge, Histogram, registry
+from wire import WireFormat, EncodedFrame, PLAIN_JSON, ENCRYPTION_AES_CTR_HMAC
+
+try:
+    from crypt import FrameCrypt, NONCE_SIZE
+except ImportError:  # pycryptodome is needed only for encrypted connections
+    FrameCrypt = NONCE_SIZE = None
 
 # GLOBAL CONSTANTS
 
@@ -21,9 +64,78 @@ SCRIPT_DIR = path.abspath(path.join(sys.argv[0], path.pardir))
 # Config, overridden by data/config.json if exists
 CONFIG = {
     'host': '0.0.0.0',
-    'port': 8926
+    'port': 8926,
+    # SQLAlchemy URI of the database, defaults to data/db.sqlite
+    'database_uri': None,
+    # PRAGMA statements executed on every new connection to an SQLite database
+    'sqlite_pragmas': {'journal_mode': 'WAL', 'synchronous': 'NORMAL', 'cache_size': -16000, 'mmap_size': 0},
+    # how many threads run writes and commits (and reads outside the WAL journal mode) of an SQLite database,
+    # so waiting for the disk or locks does not stop other connections, 0 runs them in the greenlets
+    'db_threads': 4,
+    # how often (in seconds) are balances changed in memory written into the database
+    'ledger_flush_interval': 1.0,
+    # 'write-behind' to write balances in the background, 'sync' to write them before replying,
+    # 'group' to write them before replying together with other transfers made at about the same time
+    'ledger_durability': LedgerEngine.DURABILITY_WRITE_BEHIND,
+    # how long (in seconds) are transfers collected into one transaction in the 'group' ledger durability
+    'ledger_group_window': 0.002,
+    # how many history records are sent at once
+    'history_page_size': 100,
+    # how many games are listed on one page of the lobby
+    'lobby_page_size': 20,
+    # how long (in seconds) after its last activity is a game listed in the lobby without searching for its name,
+    # None to list all games
+    'lobby_stale_after': 30 * 24 * 3600,
+    # how often (in seconds) at most is the activity of a game written after money was sent in it
+    'lobby_activity_interval': 60.0,
+    # how many messages changing one game are handled together by its actor, with one commit
+    'game_batch_size': 100,
+    # how long (in seconds) is a game which nobody uses kept in memory
+    'game_idle_timeout': 300.0,
+    # how many processes serve the clients, more than 1 forces the 'sync' ledger durability
+    'workers': 1,
+    # unix socket through which the workers exchange events, defaults to data/bus.sock
+    'bus_socket': None,
+    # DEBUG, INFO, WARNING or ERROR, frames sent and received are logged at the DEBUG level
+    'log_level': 'INFO',
+    # which part of frames is logged at the DEBUG level, 1.0 to log all of them
+    'log_sample_rate': 1.0,
+    # how many messages of one connection are handled at the same time
+    'connection_concurrency': 8,
+    # frames at least this long (in bytes) are compressed for clients accepting compression
+    'compression_threshold': 1024,
+    # how many last frames sent to a client are kept to be sent again after the client reconnects
+    'resume_buffer_size': 200,
+    # how long (in seconds) can a disconnected client resume its session
+    'resume_timeout': 60.0,
+    # how long (in seconds) can a client send nothing before the server pings it
+    'ping_interval': 20.0,
+    # a client which sends nothing, not even a reply to a ping, for this many seconds is disconnected
+    'idle_timeout': 60.0,
+    # how many clients can be connected to one process at once, others are refused, None for no limit
+    'max_connections': None,
+    # how long (in seconds) does a stopped server wait for frames and messages of its clients before exiting
+    'drain_timeout': 10.0,
+    # how many frames can wait to be sent to one client, a client which does not read them fast enough
+    # is disconnected and can resume its session after reconnecting
+    'outbound_queue_size': 1000,
+    # hex of a 16, 24 or 32 bytes long key shared with clients, every connection is then encrypted by it,
+    # None for unencrypted connections
+    'transport_key': None,
+    # preload templates and serve static files bundled, minified, fingerprinted and compressed,
+    # otherwise templates and static files are read from the disk again when they change
+    'production': False,
+    # secret sent by administrators as "Authorization: Bearer <token>" to back up the database and export
+    # and import games under /admin/, None to disable these pages
+    'admin_token': None,
+    # how many pages of the database are copied at once by an online backup
+    'backup_pages': 256,
+    # how long (in seconds) does an online backup let the clients be served between copying the pages
+    'backup_pause': 0.005
 }
 
+logger = logging.getLogger('app')
+
 # WEB SERVER SETUP section
 
 monkey.patch_all()  # fix sockets
@@ -33,11 +145,87 @@ html = Blueprint(r'html', __name__)
 soc = Blueprint(r'soc', __name__)
 
 app = Flask(__name__)
+# replaced by load_config() in the production mode
 app.config['TEMPLATES_AUTO_RELOAD'] = True
+# replaced by load_config() if configured otherwise
 app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + path.join(SCRIPT_DIR, 'data', 'db.sqlite')
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+# every handled message has its own session, keep the connections open instead of opening one for each of them
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {'poolclass': QueuePool, 'pool_size': 10, 'max_overflow': -1}
 db = SQLAlchemy(app)
 sockets = Sockets(app)
+# static files served in the production mode
+assets = AssetStore(app.static_folder, '/assets/')
+# template name -> the rendered page, pages do not change in the production mode
+rendered_pages: Dict[str, str] = {}
+
+# METRICS
+
+MESSAGE_SECONDS = Histogram('gamemoney_message_seconds', 'Time spent handling a message from a client', ['type'])
+MESSAGE_QUERIES = Histogram('gamemoney_message_queries', 'Database queries made while handling a message from a client',
+                            ['type'], buckets=(0, 1, 2, 5, 10, 20, 50, 100))
+DB_QUERIES = Counter('gamemoney_db_queries_total', 'Database queries executed')
+DB_COMMITS = Counter('gamemoney_db_commits_total', 'Database transactions committed')
+FRAMES_SENT = Counter('gamemoney_frames_sent_total', 'Frames sent to clients')
+BYTES_SENT = Counter('gamemoney_bytes_sent_total', 'Bytes of frames sent to clients')
+FRAMES_RECEIVED = Counter('gamemoney_frames_received_total', 'Frames received from clients')
+CONNECTIONS = Gauge('gamemoney_connections', 'Open connections of clients')
+FRAMES_COALESCED = Counter('gamemoney_frames_coalesced_total', 'Frames dropped before sending, replaced by newer ones')
+CLIENTS_EVICTED = Counter('gamemoney_clients_evicted_total', 'Clients disconnected for not reading their frames')
+CONNECTIONS_REAPED = Counter('gamemoney_connections_reaped_total', 'Clients disconnected for sending nothing')
+CONNECTIONS_REFUSED = Counter('gamemoney_connections_refused_total', 'Connections refused over max_connections')
+DB_THREAD_QUEUE = Gauge('gamemoney_db_thread_queue', 'Calls of the database waiting for a thread or running in it')
+DB_THREAD_WAIT_SECONDS = Histogram('gamemoney_db_thread_wait_seconds', 'Time calls of the database waited for a thread',
+                                   buckets=(.0001, .0005, .001, .005, .01, .05, .1, .5, 1.0))
+DB_WRITE_WAIT_SECONDS = Histogram('gamemoney_db_write_wait_seconds',
+                                  'Time transactions waited for the transaction writing before them',
+                                  buckets=(.0001, .0005, .001, .005, .01, .05, .1, .5, 1.0))
+GAME_ACTORS = Gauge('gamemoney_game_actors', 'Games kept in memory with an actor handling their changes')
+GAME_BATCH_MESSAGES = Histogram('gamemoney_game_batch_messages', 'Messages changing a game handled together',
+                                buckets=(1, 2, 5, 10, 20, 50, 100, 200))
+
+# Threads running blocking calls of SQLite, started by serve()
+database_threads = DatabaseThreads(DB_THREAD_QUEUE, DB_THREAD_WAIT_SECONDS, DB_WRITE_WAIT_SECONDS)
+
+# Count of database queries made by the current greenlet
+greenlet_queries = local()
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def count_query(*_) -> None:
+    DB_QUERIES.inc()
+    greenlet_queries.count = getattr(greenlet_queries, 'count', 0) + 1
+
+
+@event.listens_for(Engine, 'commit')
+def count_commit(*_) -> None:
+    DB_COMMITS.inc()
+
+
+@event.listens_for(Engine, 'connect')
+def set_sqlite_pragmas(dbapi_connection, _) -> None:
+    """
+    Configures every new SQLite connection by sqlite_pragmas from CONFIG
+    """
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    for name, value in CONFIG['sqlite_pragmas'].items():
+        cursor.execute(f'PRAGMA {name}={value}')
+    cursor.close()
+
+
+def log_frame(direction: str, frame: any) -> None:
+    """
+    Logs a sent or received frame at the DEBUG level
+    Only part of frames given by log_sample_rate is logged
+    :param direction: '->' for sent frames, '<-' for received
+    :param frame: the frame
+    :return: None
+    """
+    if logger.isEnabledFor(logging.DEBUG) and random.random() < CONFIG['log_sample_rate']:
+        logger.debug('%s %s', direction, frame)
+
 
 # DATABASE
 
@@ -47,6 +235,13 @@ rel_game_users = db.Table('rel-game-users',
                           db.Column('game_id', db.Integer, db.ForeignKey('game.id'), primary_key=True)
                           )
 
+# history record <-> players taking part in it besides player1 and player2, N-N relation table
+rel_record_players = db.Table('rel-record-players',
+                              db.Column('record_id', db.Integer, db.ForeignKey('history_record.id'), primary_key=True),
+                              db.Column('player_id', db.Integer, db.ForeignKey('game_player.id'), primary_key=True),
+                              db.Index('ix_rel_record_players_player_id', 'player_id', 'record_id')
+                              )
+
 
 class User(db.Model):
     """
@@ -59,7 +254,7 @@ class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String, nullable=False)
     key = db.Column(db.String, nullable=False, unique=True)
-    games = db.relationship('Game', secondary=rel_game_users, lazy='subquery', backref=db.backref('users', lazy=True))
+    games = db.relationship('Game', secondary=rel_game_users, lazy=True, backref=db.backref('users', lazy=True))
 
     def characters_in_game(self, game: "Game") -> List["GamePlayer"]:
         """
@@ -67,9 +262,14 @@ class User(db.Model):
         :param game: game in which are players looked for
         :return: list of GamePlayer objects inside the game belonging to this user
         """
-        characters = self.characters
-        players = game.players
-        return [ch for ch in players if ch in characters]
+        return GamePlayer.query.filter_by(game_id=game.id, user_id=self.id).order_by(GamePlayer.id).all()
+
+    def game_ids(self) -> List[int]:
+        """
+        :return: ids of games this user is member of, without loading the games
+        """
+        return [game_id for game_id, in db.session.query(rel_game_users.c.game_id)
+                .filter(rel_game_users.c.user_id == self.id)]
 
 
 class GamePlayer(db.Model):
@@ -80,34 +280,54 @@ class GamePlayer(db.Model):
     Player can be infinite, meaning that he has infinite amount of money
     and is owner of the game
     """
+    __table_args__ = (
+        db.Index('ix_game_player_game_id_user_id', 'game_id', 'user_id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String, nullable=False)
     is_infinite = db.Column(db.Boolean, default=False, nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     user = db.relationship('User', backref=db.backref('characters', lazy=True))
     game_id = db.Column(db.Integer, db.ForeignKey('game.id'), nullable=False)
+    # starting balances as JSON, the current balances are in GamePlayerBalance
     money = db.Column(db.String, nullable=False)
+    balances = db.relationship('GamePlayerBalance', backref='player', lazy=True, order_by='GamePlayerBalance.id')
 
-    def notify_transfer(self, sender: "GamePlayer", recipient: "GamePlayer",
+    @staticmethod
+    def create(name: str, game: "Game", user: User, is_infinite: bool = False) -> "GamePlayer":
+        """
+        Creates a new player with starting balances given by the type of the game
+        :param name: name of the player
+        :param game: game the player is in
+        :param user: user owning the player
+        :param is_infinite: True if the player has infinite amount of money
+        :return: the new player
+        """
+        player = GamePlayer(name=name, game=game, user=user, money=game.type.config, is_infinite=is_infinite)
+        for currency, amount in game.type.starting_balances().items():
+            player.balances.append(GamePlayerBalance(currency=currency, amount=amount))
+        return player
+
+    @staticmethod
+    def notify_transfer(game_id: int, user_ids: Iterable[int], sender_id: int, recipient_id: int,
                         amount_sender: float, amount_recipient: float, currency: str) -> None:
         """
-        Notifies this user about money transfer
-        :param sender: sender of the money
-        :param recipient: recipient of the money
+        Notifies users about money transfer
+        :param game_id: id of the game in which the transfer happened
+        :param user_ids: ids of the notified users
+        :param sender_id: id of the sender of the money
+        :param recipient_id: id of the recipient of the money
         :param amount_sender: how much does have sender left
         :param amount_recipient: how much  does have recipient left
         :param currency: the currency used
         :return: None
         """
-        client = online_users.get(self.user.id)
-        if client is None:
-            return
-        client.send_event('moneyTransfer', {'sender': sender.id,
-                                            'recipient': recipient.id,
-                                            'senderAmount': amount_sender,
-                                            'recipientAmount': amount_recipient,
-                                            'currency': currency
-                                            })
+        broadcast_event('moneyTransfer', {'sender': sender_id,
+                                          'recipient': recipient_id,
+                                          'senderAmount': amount_sender,
+                                          'recipientAmount': amount_recipient,
+                                          'currency': currency
+                                          }, [user_channel(user_id, game_id) for user_id in user_ids])
 
 
 class GameType(db.Model):
@@ -119,6 +339,46 @@ class GameType(db.Model):
     name = db.Column(db.String, nullable=False, unique=True)
     config = db.Column(db.String, nullable=False)
 
+    def starting_balances(self) -> Balances:
+        """
+        :return: {currency: amount} every new player of this game type starts with
+        """
+        return {currency: parse_amount(amount) for currency, amount in json.loads(self.config).items()}
+
+
+class Money(db.TypeDecorator):
+    """
+    Exact decimal amount of money
+    Stored as an integer count of MONEY_QUANTUM, so the database can add and compare amounts exactly
+    """
+    impl = db.BigInteger
+    cache_ok = True
+
+    def process_bind_param(self, value: Optional[Decimal], dialect) -> Optional[int]:
+        return None if value is None else int(Decimal(value) / MONEY_QUANTUM)
+
+    def process_result_value(self, value: Optional[int], dialect) -> Optional[Decimal]:
+        return None if value is None else Decimal(value) * MONEY_QUANTUM
+
+
+class GamePlayerBalance(db.Model):
+    """
+    Amount of one currency owned by a game player
+    Together with the amount, the same updates count money sent and received in the currency,
+    statistics of games are summed from them, see Game.stats()
+    """
+    __table_args__ = (
+        db.UniqueConstraint('player_id', 'currency'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    player_id = db.Column(db.Integer, db.ForeignKey('game_player.id'), nullable=False)
+    currency = db.Column(db.String, nullable=False)
+    amount = db.Column(Money, nullable=False)
+    sent = db.Column(Money, nullable=False, default=Decimal(0), server_default='0')
+    received = db.Column(Money, nullable=False, default=Decimal(0), server_default='0')
+    sent_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    received_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
 
 class Game(db.Model):
     """
@@ -126,10 +386,20 @@ class Game(db.Model):
     Can be password protected or hidden
     Multiple games with the same name can occur
     """
+    __table_args__ = (
+        db.Index('ix_game_hidden_active_at', 'hidden', 'active_at'),
+        db.Index('ix_game_hidden_search_name', 'hidden', 'search_name'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String, nullable=False)
+    # casefolded name, games are searched by it, see Game.lobby_page()
+    search_name = db.Column(db.String)
     password = db.Column(db.String)
     hidden = db.Column(db.Boolean, nullable=False, default=False)
+    # UTC time of the last change in the game, None for games not changed since it is recorded
+    active_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # sequence number of the last change of players of this game, see Game.next_seq()
+    seq = db.Column(db.Integer, nullable=False, default=0, server_default='0')
 
     type_id = db.Column(db.Integer, db.ForeignKey('game_type.id'), nullable=False)
     type = db.relationship('GameType')
@@ -138,49 +408,122 @@ class Game(db.Model):
     players = db.relationship('GamePlayer', backref='game', lazy=True)
     history_records = db.relationship('HistoryRecord', backref='game', lazy=True)
 
+    @validates('name')
+    def validate_name(self, _, name: str) -> str:
+        self.search_name = name.casefold()
+        return name
+
     @staticmethod
-    def list_games(user_id: Optional[int] = None, user: Optional[User] = None) -> None:
+    def lobby_page(page: int = 0, prefix: str = '') -> dict:
+        """
+        Lists one page of shown games, the most recently active first
+        Without a prefix only games active in the last lobby_stale_after seconds are listed
+        :param page: number of the page, starting from 0
+        :param prefix: only games with names starting with this (ignoring case) are listed
+        :return: {games: [{id, name, game: name of the game type, password: True if the game has a password}],
+                  page, prefix, more: True if there is a next page}
+        """
+        query = db.session.query(Game.id, Game.name, GameType.name, Game.password.isnot(None)) \
+            .join(GameType, Game.type_id == GameType.id).filter(Game.hidden.is_(False))
+        if prefix:
+            # a range instead of LIKE, so ix_game_hidden_search_name can be used
+            search_name = prefix.casefold()
+            query = query.filter(Game.search_name >= search_name, Game.search_name < search_name + '\U0010ffff')
+        elif CONFIG['lobby_stale_after'] is not None:
+            query = query.filter(Game.active_at >= datetime.utcnow() - timedelta(seconds=CONFIG['lobby_stale_after']))
+        page_size = CONFIG['lobby_page_size']
+        rows = query.order_by(Game.active_at.desc(), Game.id.desc()) \
+            .offset(page * page_size).limit(page_size + 1).all()
+        return {
+            'games': [{'id': game_id, 'name': name, 'game': type_name, 'password': bool(has_password)}
+                      for game_id, name, type_name, has_password in rows[:page_size]],
+            'page': page,
+            'prefix': prefix,
+            'more': len(rows) > page_size
+        }
+
+    def publish_lobby_diff(self) -> None:
         """
-        Sends a list of all currently shown games to the user
-        User can be specified by user_id or User object
-        :param user_id: id of User to send to
-        :param user: User to send to
+        Tells users in the lobby that this game was created, shown or hidden
+        Clients put added games at the top of the first page, as they were just active
         :return: None
         """
-        if user is None:
-            user = User.query.filter_by(id=user_id).first()
+        if self.hidden:
+            diff = {'added': [], 'removed': [self.id]}
         else:
-            user_id = user.id
-        if user_id not in online_users:
-            return
-        r = []
-        for game in Game.query.filter_by(hidden=False).all():
-            r.append({
-                'id': game.id,
-                'name': game.name,
-                'game': game.type.name,
-                'password': game.password is not None and user not in game.users
-            })
-        online_users[user_id].send_event('listGames', r)
+            diff = {'added': [{'id': self.id, 'name': self.name, 'game': self.type.name,
+                               'password': self.password is not None}],
+                    'removed': []}
+        publish_event(LOBBY, 'lobbyDiff', diff)
+
+    def has_user(self, user_id: int) -> bool:
+        """
+        :param user_id: id of the user
+        :return: True if the user is member of this game, without loading all members
+        """
+        return db.session.query(rel_game_users.c.user_id) \
+            .filter_by(game_id=self.id, user_id=user_id).first() is not None
 
-    def notify_online_players(self) -> None:
+    def add_user(self, user_id: int) -> None:
         """
-        Sends a list of all players inside this game to all users
+        Makes the user member of this game, without loading all members
+        :param user_id: id of the user who is not member yet
         :return: None
         """
-        r = self.get_all_players()
+        db.session.execute(rel_game_users.insert().values(game_id=self.id, user_id=user_id))
 
-        for u in self.users:
-            if u.id not in online_users:
-                continue
-            online_users[u.id].send_event('playersAll', r)
+    def next_seq(self) -> int:
+        """
+        Numbers a change of players of this game, has to be committed together with the change
+        Clients apply the changes in the order of their numbers and ask for a snapshot if they miss one
+        :return: sequence number of the change
+        """
+        self.seq = Game.seq + 1  # incremented by the database, so more workers cannot use the same number
+        db.session.flush()
+        return self.seq
+
+    def notify_players_change(self, event_type: str, change: dict) -> None:
+        """
+        Sends a numbered change of players to all users inside this game
+        :param event_type: 'playerAdded' or 'playerRenamed'
+        :param change: the change with its seq
+        :return: None
+        """
+        publish_event(game_channel(self.id), event_type, change)
+
+    def players_snapshot(self, user: User) -> dict:
+        """
+        Lists players of this game for a user who then follows the numbered changes
+        The sequence number is the one loaded with the game, so a change made meanwhile may be both
+        in the snapshot and sent as an event, but it is never missed
+        :param user: user receiving the snapshot
+        :return: {game, seq, user: id of the user, players: format_players(user), playersAll: get_all_players()}
+        """
+        return {
+            'game': self.id,
+            'seq': self.seq,
+            'user': user.id,
+            'players': self.format_players(user),
+            'playersAll': self.get_all_players()
+        }
 
     def get_all_players(self) -> Dict[int, str]:
         """
         Lists all players inside this game
         :return: {playerID: playerName}
         """
-        return {p.id: p.name for p in self.players}
+        return self.player_names()
+
+    def player_names(self, player_ids: Optional[Iterable[int]] = None) -> Dict[int, str]:
+        """
+        Gets names of players inside this game without loading the players
+        :param player_ids: ids of the players, None for all players
+        :return: {playerID: playerName}
+        """
+        query = db.session.query(GamePlayer.id, GamePlayer.name).filter(GamePlayer.game_id == self.id)
+        if player_ids is not None:
+            query = query.filter(GamePlayer.id.in_(set(player_ids)))
+        return dict(query.order_by(GamePlayer.id))
 
     def format_players(self, user: User) -> List[dict]:
         """
@@ -190,37 +533,112 @@ class Game(db.Model):
         :return: [{id, name, infinite, money: [{currency: str, amount: float}]}]
         """
         r = []
+        balances = ledger.game(self.id).balances
         for ch in user.characters_in_game(self):
             r.append({
                 'name': ch.name,
-                'money': [{'currency': k, 'amount': v} for k, v in json.loads(ch.money).items()],
+                'money': self.format_money(balances[ch.id]),
                 'infinite': ch.is_infinite,
                 'id': ch.id
             })
         return r
 
-    def send_history(self, user: User) -> None:
+    @staticmethod
+    def format_money(balances: Balances) -> List[dict]:
+        """
+        :param balances: balances of a player
+        :return: [{currency: str, amount: float}]
+        """
+        return [{'currency': k, 'amount': float(v)} for k, v in balances.items()]
+
+    def add_player(self, player: "GamePlayer", balances: Balances, record: "HistoryRecord") -> dict:
+        """
+        Adds a new player into this game with a history record about it, called by the actor of this game
+        which commits it with the other changes of its batch
+        Users inside the game are notified by the playerAdded event
+        :param player: the new player
+        :param balances: starting balances of the player
+        :param record: history record about the new player
+        :return: the playerAdded change {seq, id, name, user: id of the owning user, infinite, money}
+        """
+        db.session.add(player)
+        self.update_history(record)
+        db.session.add(record)
+        change = {
+            'seq': self.next_seq(),
+            'id': player.id,
+            'name': player.name,
+            'user': player.user_id,
+            'infinite': player.is_infinite,
+            'money': self.format_money(balances)
+        }
+        current_batch().after_commit(partial(ledger.add_player, self.id, change['id'], change['user'], balances))
+        publish_ledger_change(self.id)
+        self.notify_players_change('playerAdded', change)
+        return change
+
+    def history_page(self, user: User, cursor: Optional[int] = None) -> dict:
         """
-        Sends list of relevant history records of this game to user
+        Lists the latest history records of this game relevant to the user
+        The game owner gets all records, other users only the records of their players and records for everybody
         :param user: user receiving the history
-        :return: None
+        :param cursor: only records older than this are listed, None for the latest records
+        :return: {records: [oldest ... newest], cursor: pass to get older records or None if there are none}
+        """
+        ledger.flush(self.id)  # write pending records of this game before reading them
+        query = HistoryRecord.query.filter(HistoryRecord.game_id == self.id)
+        if self.owner_id != user.id:
+            players = db.session.query(GamePlayer.id).filter(GamePlayer.game_id == self.id,
+                                                             GamePlayer.user_id == user.id)
+            query = query.filter(or_(HistoryRecord.all.is_(True),
+                                     HistoryRecord.player1_id.in_(players),
+                                     HistoryRecord.player2_id.in_(players),
+                                     HistoryRecord.id.in_(select(rel_record_players.c.record_id)
+                                                          .where(rel_record_players.c.player_id.in_(players)))))
+        if cursor is not None:
+            query = query.filter(HistoryRecord.id < cursor)
+        page_size = CONFIG['history_page_size']
+        records = query.order_by(HistoryRecord.id.desc()).limit(page_size + 1).all()
+        more = len(records) > page_size
+        records = records[:page_size]
+        records.reverse()
+        return {
+            'records': [self.format_history_record(record) for record in records],
+            'cursor': records[0].id if more else None
+        }
+
+    def stats(self, user: User) -> dict:
+        """
+        Sums statistics of this game counted together with balances of its players
+        The game owner gets statistics of all players, other users only of their players
+        :param user: user receiving the statistics
+        :return: {transfers: count of all transfers, currencies: [{currency, volume: money sent, transfers}],
+                  players: [{id, name, money: [{currency, sent, received, sentCount, receivedCount}]}]}
         """
-        rs = []
-        for record in self.history_records:
-            p1: GamePlayer = record.player1
-            p2: GamePlayer = record.player2
-            relevant = self.owner.id == user.id  # always send to the game owner
-            if not relevant and p1 is not None and p1.user.id == user.id:
-                relevant = True
-            elif not relevant and p2 is not None and p2.user.id == user.id:
-                relevant = True
-            if not relevant:
+        ledger.flush(self.id)  # write pending transfers of this game before reading them
+        rows = db.session.query(GamePlayer.id, GamePlayer.name, GamePlayer.user_id, GamePlayerBalance.currency,
+                                GamePlayerBalance.sent, GamePlayerBalance.received,
+                                GamePlayerBalance.sent_count, GamePlayerBalance.received_count) \
+            .join(GamePlayerBalance, GamePlayerBalance.player_id == GamePlayer.id) \
+            .filter(GamePlayer.game_id == self.id) \
+            .order_by(GamePlayer.id, GamePlayerBalance.id)
+        currencies: Dict[str, dict] = {}
+        players: Dict[int, dict] = {}
+        for player_id, name, user_id, currency, sent, received, sent_count, received_count in rows:
+            # every transfer is counted once by its sender
+            totals = currencies.setdefault(currency, {'currency': currency, 'volume': Decimal(0), 'transfers': 0})
+            totals['volume'] += sent
+            totals['transfers'] += sent_count
+            if self.owner_id != user.id and user_id != user.id:
                 continue
-            rs.append(self.format_history_record(record))
-        client = online_users.get(user.id)
-        if client is None:
-            return
-        client.send_event('history', rs)
+            player = players.setdefault(player_id, {'id': player_id, 'name': name, 'money': []})
+            player['money'].append({'currency': currency, 'sent': float(sent), 'received': float(received),
+                                    'sentCount': sent_count, 'receivedCount': received_count})
+        return {
+            'transfers': sum(totals['transfers'] for totals in currencies.values()),
+            'currencies': [dict(totals, volume=float(totals['volume'])) for totals in currencies.values()],
+            'players': list(players.values())
+        }
 
     def update_history(self, record: "HistoryRecord") -> None:
         """
@@ -228,29 +646,44 @@ class Game(db.Model):
         :param record: record to be added to the history of this game
         :return: None
         """
-        self.history_records.append(record)
+        record.game = self  # does not load the whole history, unlike self.history_records.append()
+        self.active_at = datetime.utcnow()
+        db.session.flush()  # assigns ids to new players referenced by the record
         if not record.all:
             notified_players = {record.player1, record.player2} - {None}
-            notified_users = {p.user for p in notified_players} | {self.owner}
+            self.notify_history(record, {p.user_id for p in notified_players} | {self.owner_id})
         else:
-            notified_users = set(self.users)
-        for u in notified_users:
-            client = online_users.get(u.id)
-            if client is None:
-                continue
-            client.send_event('historyUpdate', self.format_history_record(record))
+            self.notify_history(record)
+
+    def notify_history(self, record: "HistoryRecord", user_ids: Optional[Iterable[int]] = None) -> None:
+        """
+        Notifies users about a new record in history of this game
+        Does not add the record into the history
+        :param record: the new record
+        :param user_ids: ids of users to notify, None to notify all users inside the game
+        :return: None
+        """
+        if user_ids is None:
+            channels = [game_channel(self.id)]
+        else:
+            channels = [user_channel(user_id, self.id) for user_id in user_ids]
+        broadcast_event('historyUpdate', self.format_history_record(record), channels)
 
     @staticmethod
     def format_history_record(record: "HistoryRecord") -> dict:
         """
         Format history record into a dictionary parseable by web app
         :param record: record to be formatted
-        :return: {text, p1: playerId || None, p2: playerId || None}
+        :return: {id, text, all, p1: playerId || None, p2: playerId || None}
         """
-        message = {'text': record.string, 'all': record.all}
-        if record.player1 is not None:
+        message = {'id': record.id, 'text': record.string, 'all': record.all}
+        if record.player1_id is not None:
+            message['p1'] = record.player1_id
+        elif record.player1 is not None:
             message['p1'] = record.player1.id
-        if record.player2 is not None:
+        if record.player2_id is not None:
+            message['p2'] = record.player2_id
+        elif record.player2 is not None:
             message['p2'] = record.player2.id
         return message
 
@@ -258,39 +691,831 @@ class Game(db.Model):
 class HistoryRecord(db.Model):
     """
     A record holding information about a change in a game
-    Can have up to two assigned players p1 and p2
+    Can have up to two assigned players p1 and p2, more players taking part in it are in rel_record_players
     If all is set, then this record is visible to all players in game
+    The string is shown to users, kind, amount and currency describe the change for queries
     """
+    KIND_GAME_STARTED = 'gameStarted'
+    KIND_PLAYER_ADDED = 'playerAdded'
+    KIND_PLAYER_RENAMED = 'playerRenamed'
+    KIND_GAME_HIDDEN = 'gameHidden'
+    KIND_GAME_SHOWN = 'gameShown'
+    # p1 sent amount of currency to p2
+    KIND_TRANSFER = 'transfer'
+    # more transfers, amount is their sum if all of them were in the same currency
+    KIND_TRANSFER_BATCH = 'transferBatch'
+
+    __table_args__ = (
+        db.Index('ix_history_record_game_id_id', 'game_id', 'id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     string = db.Column(db.String, nullable=False)
     all = db.Column(db.Boolean, default=False)
+    # one of KIND_*, None for records the kind of which could not be recognized, see migrate()
+    kind = db.Column(db.String)
+    amount = db.Column(Money)
+    currency = db.Column(db.String)
+    # UTC time of the change, None for records written before it was recorded
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
     player1_id = db.Column(db.Integer, db.ForeignKey('game_player.id'), nullable=True)
     player1 = db.relationship('GamePlayer', foreign_keys="HistoryRecord.player1_id")
     player2_id = db.Column(db.Integer, db.ForeignKey('game_player.id'), nullable=True)
     player2 = db.relationship('GamePlayer', foreign_keys="HistoryRecord.player2_id")
     game_id = db.Column(db.Integer, db.ForeignKey('game.id'), nullable=False)
 
+    @staticmethod
+    def values(game_id: int, string: str, kind: str, is_all: bool, player1_id: Optional[int] = None,
+               player2_id: Optional[int] = None, amount: Optional[Decimal] = None,
+               currency: Optional[str] = None, participants: Iterable[int] = ()) -> dict:
+        """
+        Values of a record written by the ledger, all of them have the same keys
+        :param participants: ids of other players taking part in the record, see rel_record_players
+        :return: {column name: value, participants: [player id]}
+        """
+        return {'game_id': game_id, 'string': string, 'kind': kind, 'all': is_all, 'player1_id': player1_id,
+                'player2_id': player2_id, 'amount': amount, 'currency': currency, 'created_at': datetime.utcnow(),
+                'participants': [player_id for player_id in participants if player_id not in (player1_id, player2_id)]}
+
+    @staticmethod
+    def from_values(values: dict) -> "HistoryRecord":
+        """
+        :param values: values of a record made by values()
+        :return: the record, it is not added to the database session
+        """
+        return HistoryRecord(**{name: value for name, value in values.items() if name != 'participants'})
+
+
+def ledger_load(game_id: int) -> List[PlayerRow]:
+    """
+    Loads balances of all players inside a game for the ledger
+    :param game_id: id of the game
+    :return: [(player id, user id, is infinite, balances)]
+    """
+    rows = db.session.query(GamePlayer.id, GamePlayer.user_id, GamePlayer.is_infinite,
+                            GamePlayerBalance.currency, GamePlayerBalance.amount) \
+        .outerjoin(GamePlayerBalance, GamePlayerBalance.player_id == GamePlayer.id) \
+        .filter(GamePlayer.game_id == game_id) \
+        .order_by(GamePlayer.id, GamePlayerBalance.id)
+    players: Dict[int, PlayerRow] = {}
+    for player_id, user_id, is_infinite, currency, amount in rows:
+        player = players.setdefault(player_id, (player_id, user_id, is_infinite, {}))
+        if currency is not None:
+            player[3][currency] = amount
+    return list(players.values())
+
+
+def balance_change_values(change: BalanceChange) -> dict:
+    """
+    :param change: change of a balance
+    :return: values of an update of GamePlayerBalance adding the change
+    """
+    balances = GamePlayerBalance.__table__
+    return {'amount': balances.c.amount + change.amount,
+            'sent': balances.c.sent + change.sent,
+            'received': balances.c.received + change.received,
+            'sent_count': balances.c.sent_count + change.sent_count,
+            'received_count': balances.c.received_count + change.received_count}
+
+
+def add_to_balance(connection, player_id: int, currency: str, change: BalanceChange) -> None:
+    """
+    Adds a change to the balance of a player
+    :param connection: connection inside a transaction
+    :param player_id: id of the player
+    :param currency: currency of the balance
+    :param change: the change, negative to take it back
+    :return: None
+    """
+    balances = GamePlayerBalance.__table__
+    connection.execute(balances.update()
+                       .where(and_(balances.c.player_id == player_id, balances.c.currency == currency))
+                       .values(balance_change_values(change)))
+
+
+def insert_history_records(connection, records: List[dict]) -> List[int]:
+    """
+    :param connection: connection inside a transaction
+    :param records: values of new HistoryRecord rows made by HistoryRecord.values()
+    :return: ids of the inserted rows
+    """
+    record_ids = []
+    for record in records:
+        record_id = connection.execute(HistoryRecord.__table__.insert(),
+                                       {name: value for name, value in record.items() if name != 'participants'}) \
+            .inserted_primary_key[0]
+        if record.get('participants'):
+            connection.execute(rel_record_players.insert(), [{'record_id': record_id, 'player_id': player_id}
+                                                             for player_id in record['participants']])
+        record_ids.append(record_id)
+    return record_ids
+
+
+def ledger_store(deltas: Deltas, records: List[dict]) -> None:
+    """
+    Adds changes of balances made by the ledger and writes new history records in one transaction
+    :param deltas: {(player id, currency): change of the amount}
+    :param records: values of new HistoryRecord rows, they get 'id' when they are written
+    :return: None
+    """
+    with db.engine.begin() as connection:
+        for (player_id, currency), change in deltas.items():
+            if any(change):
+                add_to_balance(connection, player_id, currency, change)
+        record_ids = insert_history_records(connection, records)
+    for record, record_id in zip(records, record_ids):
+        record['id'] = record_id
+
+
+def ledger_store_transfers(groups: List[Tuple[List[StoredTransfer], Optional[dict]]]) -> List[bool]:
+    """
+    Writes groups of transfers into the database in one transaction
+    The sender's balance is decreased only if he has enough money at the moment of the update,
+    so concurrent transfers cannot overdraw it
+    :param groups: [([(sender id, recipient id, currency, amount, True if the sender must have enough money)],
+                   values of HistoryRecord describing the transfers, it gets 'id' when it is written)]
+    :return: for each group False if any sender does not have enough money and nothing of the group was written
+    """
+    balances = GamePlayerBalance.__table__
+    stored = []
+    records = []
+    with db.engine.begin() as connection:
+        for transfers, record in groups:
+            written = []
+            for sender_id, recipient_id, currency, amount, guarded in transfers:
+                condition = and_(balances.c.player_id == sender_id, balances.c.currency == currency)
+                if guarded:
+                    condition = and_(condition, balances.c.amount >= amount)
+                if connection.execute(balances.update().where(condition)
+                                      .values(balance_change_values(BalanceChange.sending(amount)))).rowcount != 1:
+                    break
+                add_to_balance(connection, recipient_id, currency, BalanceChange.receiving(amount))
+                written.append((sender_id, recipient_id, currency, amount))
+            else:
+                stored.append(True)
+                if record is not None:
+                    records.append(record)
+                continue
+            # other groups are written in the same transaction, so only this group is taken back
+            for sender_id, recipient_id, currency, amount in reversed(written):
+                add_to_balance(connection, recipient_id, currency, -BalanceChange.receiving(amount))
+                add_to_balance(connection, sender_id, currency, -BalanceChange.sending(amount))
+            stored.append(False)
+        record_ids = insert_history_records(connection, records)
+    for record, record_id in zip(records, record_ids):
+        record['id'] = record_id
+    return stored
+
+
+# Balances of all players in loaded games
+ledger = LedgerEngine(ledger_load, ledger_store, ledger_store_transfers)
+
 
-# Map of user id -> GameClient for all currenctly online users
-online_users: Dict[int, "GameClient"] = {}
+class Session:
+    """
+    Logged user of one client kept after the client disconnects, so the client can resume it
+    Frames sent in the session are numbered from 1 by the frame announcing the session,
+    the client counts frames it received and after reconnecting gets the missed ones again
+    """
+
+    def __init__(self, user_id: int, buffer_size: int):
+        """
+        :param user_id: id of the logged user
+        :param buffer_size: how many last frames are kept
+        """
+        self.token = uuid().hex
+        self.user_id = user_id
+        # the connected client, None while it is disconnected
+        self.client: Optional["GameClient"] = None
+        # channels this session receives events from
+        self.channels: Set[str] = set()
+        # number of frames sent in this session
+        self.sent = 0
+        # last frames as JSON, the last one has number sent
+        self.buffer: Deque[str] = deque(maxlen=buffer_size)
+        # time.monotonic() when the client disconnected
+        self.detached_at: Optional[float] = None
+
+    def record(self, frame: str) -> None:
+        """
+        Numbers a frame sent in this session and keeps it in the buffer
+        :param frame: the frame as JSON
+        :return: None
+        """
+        self.sent += 1
+        self.buffer.append(frame)
+
+    def frame(self, number: int) -> Optional[str]:
+        """
+        :param number: number of a frame sent in this session
+        :return: the frame as JSON or None if it is not in the buffer anymore
+        """
+        index = number - (self.sent - len(self.buffer)) - 1
+        return self.buffer[index] if 0 <= index < len(self.buffer) else None
+
+    def subscribe(self, channel: str) -> None:
+        """
+        Starts sending events published on the channel to this session
+        :param channel: channel to subscribe
+        :return: None
+        """
+        subscriptions.setdefault(channel, set()).add(self)
+        self.channels.add(channel)
+
+    def attach(self, client: "GameClient") -> None:
+        """
+        Sends events of this session to the client from now on
+        :return: None
+        """
+        self.client = client
+        self.detached_at = None
+        client.session = self
+        client.logged_in = True
+        client.user_id = self.user_id
+
+    def detach(self) -> None:
+        """
+        Keeps events of this session only in the buffer until a client resumes it
+        :return: None
+        """
+        if self.client is not None:
+            # frames which were not written yet are sent after a client resumes the session
+            for frame in self.client.take_unwritten():
+                self.record(frame)
+            self.client.session = None
+            self.client = None
+        self.detached_at = time.monotonic()
+
+    def close(self) -> None:
+        """
+        Ends this session, it cannot be resumed anymore
+        :return: None
+        """
+        for channel in self.channels:
+            clients = subscriptions.get(channel)
+            if clients is None:
+                continue
+            clients.discard(self)
+            if not clients:
+                del subscriptions[channel]
+        self.channels.clear()
+        sessions.pop(self.token, None)
+
+
+# Resume token -> session of a client of this process
+sessions: Dict[str, Session] = {}
+
+# Channel -> sessions of this process subscribed to the channel
+subscriptions: Dict[str, Set[Session]] = {}
+
+# Clients connected to this process
+clients: Set["GameClient"] = set()
+
+
+def close_expired_sessions() -> None:
+    """
+    Ends sessions whose clients did not resume them within resume_timeout seconds, runs forever
+    :return: None
+    """
+    while True:
+        gevent.sleep(CONFIG['resume_timeout'] / 2)
+        expired_at = time.monotonic() - CONFIG['resume_timeout']
+        for session in list(sessions.values()):
+            if session.detached_at is not None and session.detached_at < expired_at:
+                session.close()
+
+
+def reap_idle_connections() -> None:
+    """
+    Pings clients which sent nothing for ping_interval seconds and disconnects those
+    which sent nothing for idle_timeout seconds, runs forever
+    :return: None
+    """
+    while True:
+        gevent.sleep(CONFIG['ping_interval'] / 2)
+        now = time.monotonic()
+        for client in list(clients):
+            idle = now - client.last_received
+            if idle >= CONFIG['idle_timeout']:
+                CONNECTIONS_REAPED.inc()
+                client.abort()
+            elif idle >= CONFIG['ping_interval']:
+                client.send_ping()
+
+
+# Channel used only between processes, id of a game whose ledger was changed in another process
+LEDGER_CHANNEL = 'ledger'
+
+
+def deliver(channel: str, payload: str) -> None:
+    """
+    Delivers an event published on the bus to clients of this process
+    :param channel: channel of the event
+    :param payload: frame to be sent to the subscribed clients or a change made by another process
+    :return: None
+    """
+    if channel == LEDGER_CHANNEL:
+        ledger.forget(int(payload))
+        return
+    # the frame is encoded only once for all clients using the same format
+    frames: Dict[WireFormat, EncodedFrame] = {}
+    for session in list(subscriptions.get(channel, ())):
+        client = session.client
+        if client is None:
+            session.record(payload)
+            continue
+        frame = frames.get(client.wire)
+        if frame is None:
+            frame = frames[client.wire] = client.wire.encode(payload, CONFIG['compression_threshold'])
+        client.send_encoded(payload, frame)
+
+
+# Delivers events to clients of all processes, replaced in main() if there are more workers
+bus: EventBus = LocalBus(deliver)
+
+
+def encode_event(event_type: str, event_message: any, request_id: any = None) -> str:
+    """
+    Encodes an event into a frame that can be sent to clients
+    :param event_type: type of the event
+    :param event_message: content of the event
+    :param request_id: id of the request this event replies to, None if it is not a reply
+    :return: the frame
+    """
+    if request_id is None:
+        return json.dumps({'type': event_type, 'message': event_message})
+    return json.dumps({'type': event_type, 'message': event_message, 'id': request_id})
+
+
+def publish_event(channel: str, event_type: str, event_message: any) -> None:
+    """
+    Sends an event to all clients subscribed to the channel
+    :param channel: channel of the event
+    :param event_type: type of the event
+    :param event_message: content of the event
+    :return: None
+    """
+    batch = current_batch()
+    if batch is not None:
+        batch.publish(channel, event_type, event_message)
+        return
+    bus.publish(channel, encode_event(event_type, event_message))
+
+
+def broadcast_event(event_type: str, event_message: any, channels: Iterable[str]) -> None:
+    """
+    Sends the same event to many channels, the event is encoded only once
+    :param event_type: type of the event
+    :param event_message: content of the event
+    :param channels: channels to send to
+    :return: None
+    """
+    batch = current_batch()
+    frame = encode_event(event_type, event_message)
+    for channel in channels:
+        if batch is not None:
+            batch.publish(channel, event_type, event_message, frame)
+        else:
+            bus.publish(channel, frame)
+
+
+# Ids of history records sent before they are written, see publish_history_record()
+temporary_record_ids = count(-1, -1)
+
+
+def publish_history_record(game_id: int, record: dict, channels: List[str]) -> None:
+    """
+    Sends a historyUpdate event with a history record written by the ledger
+    A record which is not written yet is sent at once with a temporary negative id,
+    historyId event {temporary, id} gives its id after it is written
+    :param game_id: id of the game of the record
+    :param record: values of the record made by HistoryRecord.values()
+    :param channels: channels to send to
+    :return: None
+    """
+    message = Game.format_history_record(HistoryRecord.from_values(record))
+    if message['id'] is not None:
+        broadcast_event('historyUpdate', message, channels)
+        return
+    temporary_id = message['id'] = next(temporary_record_ids)
+    broadcast_event('historyUpdate', message, channels)
+    ledger.when_written(game_id, lambda: broadcast_event('historyId', {'temporary': temporary_id, 'id': record['id']},
+                                                         channels))
+
+
+def publish_ledger_change(game_id: int) -> None:
+    """
+    Tells other processes that balances or players of a game were changed,
+    they will load the game into their ledgers again
+    :param game_id: id of the changed game
+    :return: None
+    """
+    batch = current_batch()
+    if batch is not None:
+        batch.ledger_changed = True
+        return
+    bus.publish(LEDGER_CHANNEL, str(game_id), local=False)
+
+
+# when (time.monotonic()) did this process last write the activity of a game, see mark_game_active()
+games_marked_active: Dict[int, float] = {}
+
+
+def mark_game_active(game_id: int) -> None:
+    """
+    Records activity of a game after money was sent in it
+    Sending money does not touch the game otherwise, so the activity is written
+    at most once per lobby_activity_interval seconds by every process
+    :param game_id: id of the game
+    :return: None
+    """
+    now = time.monotonic()
+    if now - games_marked_active.get(game_id, -CONFIG['lobby_activity_interval']) < CONFIG['lobby_activity_interval']:
+        return
+    games_marked_active[game_id] = now
+    Game.query.filter_by(id=game_id).update({'active_at': datetime.utcnow()})
+    db.session.commit()
+
+
+class SerialQueue:
+    """
+    Runs jobs with the same key one after another, in the order in which they were queued
+    """
+
+    def __init__(self):
+        # key -> event set when the last queued job with the key is done
+        self.__last: Dict[str, Event] = {}
+
+    def queue(self, key: str, job: Callable[[], any]) -> Callable[[], any]:
+        """
+        Queues a job, jobs must be queued in the order in which they should run
+        The returned function has to be called exactly once
+        :param key: jobs with the same key do not run at the same time
+        :param job: the job
+        :return: function waiting for all earlier jobs with the key and then running the job
+        """
+        previous = self.__last.get(key)
+        done = Event()
+        self.__last[key] = done
+
+        def run() -> any:
+            try:
+                if previous is not None:
+                    previous.wait()
+                return job()
+            finally:
+                done.set()
+                if self.__last.get(key) is done:
+                    del self.__last[key]
+
+        return run
+
+
+# Orders messages changing the same data across all connections of this process
+serial_queue = SerialQueue()
+
+
+# Replies of which only the last one is useful, older ones are dropped if they were not sent yet
+REPLACEABLE_EVENTS = {'listGames', 'myGames', 'playersSnapshot'}
+
+
+class Request:
+    """
+    A message received from a client, handled by its Handler
+    """
+
+    def __init__(self, client: "GameClient", message_type: str, message: any, request_id: any):
+        self.client = client
+        self.type = message_type
+        self.message = message
+        self.id = request_id
+        self.received = time.perf_counter()
+        self.__user: Optional[User] = None
+        # the game the message was sent from, for handlers with game context
+        self.game: Optional[Game] = None
+
+    @property
+    def user(self) -> Optional[User]:
+        """
+        The user logged in on the client, loaded into the session of this request when needed
+        """
+        if self.__user is None and self.client.user_id is not None:
+            self.__user = User.query.filter_by(id=self.client.user_id).first()
+        return self.__user
+
+    def send(self, event_type: str, event_message: any) -> None:
+        """
+        Sends part of the reply to this request
+        :param event_type: type of the event
+        :param event_message: content of the event
+        :return: None
+        """
+        self.client.send_raw(encode_event(event_type, event_message, self.id),
+                             event_type if event_type in REPLACEABLE_EVENTS else None)
+
+
+class Handler:
+    """
+    Handles one type of messages sent by clients
+    """
+
+    def __init__(self, handle: Callable[[Request], Optional[Tuple[str, any]]], schema: any,
+                 logged_in: Optional[bool], game: bool, serial: Optional[Callable[[Request], str]],
+                 actor: Optional[Callable[[Request], int]], error: str):
+        self.handle = handle
+        self.schema = schema
+        self.logged_in = logged_in
+        self.game = game
+        self.serial = serial
+        self.actor = actor
+        self.error = error
+
+
+# Message type -> its handler
+handlers: Dict[str, Handler] = {}
+
+
+def handler(message_type: str, schema: any = None, logged_in: Optional[bool] = True, game: bool = False,
+            serial: Optional[Callable[[Request], str]] = None, actor: Optional[Callable[[Request], int]] = None,
+            error: Optional[str] = None):
+    """
+    Registers a function handling messages of one type
+    The function gets the Request and returns (type, message) of the reply or None
+    :param message_type: type of the handled messages
+    :param schema: expected content of the message, see validate()
+    :param logged_in: True if the message can be sent only after logging in, False only before logging in,
+                      None always, messages which are not handled after logging in are handled one by one
+    :param game: True if the message is sent from inside a game as {game: id}, the game is loaded into Request.game
+                 after checking that the user is its member
+    :param serial: None if the message only reads data, otherwise returns the key of data changed by the message,
+                   messages with the same key are handled one after another in the order in which they were received
+    :param actor: None or returns id of the game changed by the message, the message is then handled by the actor
+                  of the game together with other messages changing it and committed with them, see GameBatch
+    :param error: type of the reply sent if the message does not match the schema, defaults to message_type + 'ERR'
+    :return: the decorator
+    """
+    if game:
+        schema = dict(schema or {}, game=(int, str))
+
+    def decorator(handle: Callable[[Request], Optional[Tuple[str, any]]]):
+        handlers[message_type] = Handler(handle, schema, logged_in, game, serial, actor,
+                                         error or message_type + 'ERR')
+        return handle
+
+    return decorator
+
+
+def validate(value: any, schema: any) -> bool:
+    """
+    Checks that a value sent by a client matches the schema
+    :param value: the value
+    :param schema: None for any value, a type or a tuple of types, [schema] for a list of values matching the schema
+                   or {key: schema} for a dictionary, keys ending with '?' are optional
+    :return: True if the value matches
+    """
+    if schema is None:
+        return True
+    if isinstance(schema, list):
+        return isinstance(value, list) and all(validate(item, schema[0]) for item in value)
+    if isinstance(schema, dict):
+        if not isinstance(value, dict):
+            return False
+        for key, value_schema in schema.items():
+            optional = key.endswith('?')
+            key = key.rstrip('?')
+            if key not in value:
+                if optional:
+                    continue
+                return False
+            if not validate(value[key], value_schema):
+                return False
+        return True
+    return isinstance(value, schema)
+
+
+# A message changing a game, (the request, function handling it in the context of the request and returning the reply,
+# event set after the reply was sent)
+GameMessage = Tuple[Request, Callable[[], Optional[Tuple[str, any]]], Event]
+
+
+class GameBatch:
+    """
+    Messages changing one game handled together by the actor of the game
+    Their changes are committed in one transaction, their transfers are written into the ledger at once
+    and the events they publish are sent after that, transfers published to one channel as one event
+    """
+
+    def __init__(self, game_id: int):
+        self.game_id = game_id
+        # (channel, event type, event message, the encoded event or None) published by the messages
+        self.events: List[Tuple[str, str, any, Optional[str]]] = []
+        # functions called after the changes are committed
+        self.committed: List[Callable[[], None]] = []
+        # (request, its transfers, values of their HistoryRecord, function getting their results and returning
+        # the reply to the request)
+        self.transfers: List[Tuple[Request, List[Transfer], dict,
+                                   Callable[[List[Tuple[Decimal, Decimal]]], Optional[Tuple[str, any]]]]] = []
+        # True if other processes have to load the game into their ledgers again
+        self.ledger_changed = False
+
+    def publish(self, channel: str, event_type: str, event_message: any, frame: Optional[str] = None) -> None:
+        """
+        Sends an event to all clients subscribed to the channel after the changes are committed
+        :param channel: channel of the event
+        :param event_type: type of the event
+        :param event_message: content of the event
+        :param frame: the event already encoded, None to encode it when it is sent
+        :return: None
+        """
+        self.events.append((channel, event_type, event_message, frame))
+
+    def after_commit(self, callback: Callable[[], None]) -> None:
+        """
+        :param callback: function called after the changes are committed
+        :return: None
+        """
+        self.committed.append(callback)
+
+    def transfer(self, request: Request, transfers: List[Transfer], record: dict,
+                 confirm: Callable[[List[Tuple[Decimal, Decimal]]], Optional[Tuple[str, any]]]) -> None:
+        """
+        Queues transfers to be written into the ledger together with transfers of the other messages,
+        either all of them or none
+        :param request: the message sending the money, gets type + 'ERR' reply if the transfers are not possible
+        :param transfers: [(sender id, recipient id, currency, amount)]
+        :param record: values of HistoryRecord describing the transfers
+        :param confirm: gets [(how much does have sender left, how much does have recipient left)] after each
+                        transfer when they are written and returns the reply
+        :return: None
+        """
+        self.transfers.append((request, transfers, record, confirm))
+
+    def write_transfers(self) -> List[Tuple[Request, Optional[Tuple[str, any]]]]:
+        """
+        Writes the queued transfers into the ledger and confirms them
+        If writing them fails, all of them get type + 'ERR' replies and the game is loaded into the ledger again,
+        so its balances are those in the database
+        :return: [(request, its reply)]
+        """
+        if not self.transfers:
+            return []
+        try:
+            results = ledger.transfer_groups(self.game_id,
+                                             [(transfers, record) for _, transfers, record, _ in self.transfers])
+        except Exception:
+            logger.exception('writing transfers of game %d failed', self.game_id)
+            ledger.forget(self.game_id)
+            return [(request, (request.type + 'ERR', 'The money could not be sent, try again'))
+                    for request, _, _, _ in self.transfers]
+        replies = []
+        for (request, _, _, confirm), result in zip(self.transfers, results):
+            if isinstance(result, TransferError):
+                replies.append((request, (request.type + 'ERR', str(result))))
+                continue
+            try:
+                replies.append((request, confirm(result)))
+            except Exception:
+                logger.exception('handling of %s failed', request.type)
+                replies.append((request, (request.type + 'ERR', 'The money was sent, reload the game to see it')))
+        if not all(isinstance(result, TransferError) for result in results):
+            publish_ledger_change(self.game_id)
+            try:
+                mark_game_active(self.game_id)
+            except Exception:
+                db.session.rollback()
+                logger.exception('writing activity of game %d failed', self.game_id)
+        return replies
+
+    def send_events(self) -> None:
+        """
+        Sends the published events, transfers published to one channel are sent in one moneyTransfer event
+        :return: None
+        """
+        if self.ledger_changed:
+            bus.publish(LEDGER_CHANNEL, str(self.game_id), local=False)
+        transfers: Dict[str, List[dict]] = {}
+        for channel, event_type, event_message, _ in self.events:
+            if event_type == 'moneyTransfer':
+                transfers.setdefault(channel, []).extend(
+                    event_message if isinstance(event_message, list) else [event_message])
+        for channel, event_type, event_message, frame in self.events:
+            if event_type == 'moneyTransfer':
+                merged = transfers.pop(channel, None)
+                if merged is None:
+                    continue  # sent together with the first transfer published to the channel
+                if len(merged) > 1:
+                    frame = encode_event(event_type, merged)
+            bus.publish(channel, frame if frame is not None else encode_event(event_type, event_message))
+
+
+# The batch handled by the current greenlet, see current_batch()
+batch_local = local()
+
+
+def current_batch() -> Optional[GameBatch]:
+    """
+    :return: batch of messages handled by the current greenlet if it is the actor of a game, None otherwise
+    """
+    return getattr(batch_local, 'batch', None)
+
+
+def handle_game_messages(game_id: int, messages: List[GameMessage]) -> None:
+    """
+    Handles messages changing a game together, called by the actor of the game
+    If any of them fails before the changes are committed, they are handled again one by one,
+    so the others do not fail with it
+    :param game_id: id of the game
+    :param messages: the messages in the order in which they were received
+    :return: None
+    """
+    try:
+        with app.app_context():
+            if not handle_game_batch(game_id, messages) and len(messages) > 1:
+                for message in messages:
+                    handle_game_batch(game_id, [message])
+    finally:
+        for _, _, done in messages:
+            done.set()
+
+
+def handle_game_batch(game_id: int, messages: List[GameMessage]) -> bool:
+    """
+    Handles messages changing a game in one transaction and sends the replies
+    :param game_id: id of the game
+    :param messages: the messages
+    :return: False if handling of any message failed and nothing was committed
+    """
+    batch = GameBatch(game_id)
+    batch_local.batch = batch
+    replies: List[Tuple[Request, Optional[Tuple[str, any]]]] = []
+    try:
+        try:
+            for request, handle, _ in messages:
+                if request.client.evicted:
+                    continue  # nobody would get the reply
+                queries = getattr(greenlet_queries, 'count', 0)
+                replies.append((request, handle()))
+                MESSAGE_QUERIES.observe(getattr(greenlet_queries, 'count', 0) - queries, (request.type,))
+            db.session.commit()
+        except Exception:
+            if len(messages) == 1:
+                logger.exception('handling of %s failed', messages[0][0].type)
+            return False
+        try:
+            for callback in batch.committed:
+                callback()
+        except Exception:
+            logger.exception('updating game %d after commit failed', game_id)
+            ledger.forget(game_id)  # loaded again from the committed changes
+        replies.extend(batch.write_transfers())
+        batch.send_events()
+    finally:
+        batch_local.batch = None
+        db.session.remove()
+    for request, reply in replies:
+        if reply is not None:
+            request.send(reply[0], reply[1])
+        MESSAGE_SECONDS.observe(time.perf_counter() - request.received, (request.type,))
+    return True
+
+
+def evict_game(game_id: int) -> None:
+    """
+    Drops a game nobody used for game_idle_timeout seconds from memory, called by the actor of the game
+    :param game_id: id of the game
+    :return: None
+    """
+    ledger.forget(game_id)
+    games_marked_active.pop(game_id, None)
+
+
+# Actors of games used by clients of this process, configured by load_config()
+game_actors = Actors(handle_game_messages, evict_game, count=GAME_ACTORS, batch_sizes=GAME_BATCH_MESSAGES)
 
 
 class SocketComm:
     def __init__(self, web_soc: "WebSocket"):
         self.__soc = web_soc
+        # time.monotonic() when anything was last received from the client
+        self.last_received = time.monotonic()
+        # replies to pings are not passed to receive(), see GameWebSocket
+        web_soc.handler.on_pong = self.on_pong
         self.on_connect()
 
     def run(self):
-        while not self.__soc.closed:
-            try:
-                msg: Optional[str] = self.__soc.receive()
-                data: dict = json.loads(msg)
-            except (json.JSONDecodeError, TypeError):
-                continue
-            r = self.on_data(data)
-            if type(r) == dict:
-                self.send_dict(r)
-        self.on_disconnect()
+        try:
+            while not self.__soc.closed:
+                try:
+                    msg: Optional[str] = self.__soc.receive()
+                    self.last_received = time.monotonic()
+                    msg = self.read_frame(msg)
+                    data: dict = json.loads(msg)
+                except (json.JSONDecodeError, TypeError):
+                    continue
+                r = self.on_data(data)
+                if type(r) == dict:
+                    self.send_dict(r)
+        finally:
+            self.on_disconnect()
 
     def on_connect(self):
         pass
@@ -298,301 +1523,1116 @@ class SocketComm:
     def on_disconnect(self):
         pass
 
+    def on_pong(self, *_) -> None:
+        self.last_received = time.monotonic()
+
+    def read_frame(self, frame: Union[str, bytes, None]) -> Union[str, bytes, None]:
+        """
+        :param frame: frame received from the client, None if the connection was closed
+        :return: the frame as JSON, None to ignore it
+        """
+        return frame
+
     def on_data(self, data: dict) -> Optional[dict]:
         pass
 
     def send_dict(self, data: dict):
-        self.__soc.send(json.dumps(data))
+        self.send_raw(json.dumps(data))
 
+    def send_raw(self, frame: Union[str, bytes]):
+        try:
+            self.__soc.send(frame)
+        except WebSocketError:
+            pass  # the connection is lost, run() will notice it
+
+    def send_control(self, opcode: int) -> None:
+        """
+        Sends an empty control frame
+        :param opcode: WebSocket.OPCODE_PING or WebSocket.OPCODE_CLOSE
+        :return: None
+        """
+        try:
+            if opcode == WebSocket.OPCODE_CLOSE:
+                self.__soc.close()
+            else:
+                self.__soc.send_frame(b'', opcode)
+        except WebSocketError:
+            pass
+
+    def close(self):
+        self.__soc.close()
+
+    def abort(self) -> None:
+        """
+        Closes the connection without sending anything to the client, so it never waits for the client
+        :return: None
+        """
+        try:
+            self.__soc.handler.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass  # already closed
 
-class GameClient(SocketComm):
-    database_sync_time: List[float] = [time.time()]
 
-    def __init__(self, ws: WebSocket):
+class GameClient(SocketComm):
+    def __init__(self, ws: WebSocket, wire: WireFormat = PLAIN_JSON, crypt: Optional[FrameCrypt] = None):
         super().__init__(ws)
+        # how frames sent to this client are encoded
+        self.wire = wire
+        # encryption of frames of this connection, None if they are not encrypted
+        self.crypt = crypt
+        # frames waiting for the writer, (frame, encoded frame, session numbering it or None, key of replaceable frame,
+        # True if it counts into outbound_queue_size), control frames are (None, opcode, None, None, False)
+        self.outbox: Deque[Tuple[str, EncodedFrame, Optional[Session], Optional[str], bool]] = deque()
+        # how many queued frames count into outbound_queue_size
+        self.queued = 0
+        # key -> the queued replaceable frame with the key
+        self.replaceable: Dict[str, tuple] = {}
+        self.outbox_ready = Event()
+        # True after the client was disconnected for not reading its frames
+        self.evicted = False
+        self.writer = gevent.spawn(self.write_frames)
         self.logged_in = False
-        self.user: Optional[User] = None
-        self.local_sync = time.time()
+        self.user_id: Optional[int] = None
+        # session of the logged user, frames are numbered and kept in it
+        self.session: Optional[Session] = None
+        # messages of this client handled at the same time
+        self.pool = Pool(CONFIG['connection_concurrency'])
+
+    def on_connect(self):
+        CONNECTIONS.inc()
+        clients.add(self)
 
     def on_disconnect(self):
-        if self.user is not None and self.user.id in online_users:
-            del online_users[self.user.id]
+        CONNECTIONS.dec()
+        clients.discard(self)
+        self.writer.kill(block=False)
+        if self.session is not None:
+            self.session.detach()
 
-    def send_dict(self, data: dict):
-        print('->', data)
-        super().send_dict(data)
+    def subscribe(self, channel: str) -> None:
+        """
+        Starts sending events published on the channel to the session of this client
+        :param channel: channel to subscribe
+        :return: None
+        """
+        if self.session is not None:  # None if the client was evicted meanwhile
+            self.session.subscribe(channel)
+
+    def send_raw(self, frame: str, replaces: Optional[str] = None):
+        self.send_encoded(frame, self.wire.encode(frame, CONFIG['compression_threshold']), replaces)
+
+    def send_encoded(self, frame: str, encoded: EncodedFrame, replaces: Optional[str] = None) -> None:
+        """
+        Sends a frame already encoded for the format of this client, it is numbered in the session when it is written
+        :param frame: the frame as JSON
+        :param encoded: the frame encoded by WireFormat.encode()
+        :param replaces: key of a frame which makes older frames with the same key useless,
+                         those which were not written yet are dropped
+        :return: None
+        """
+        self.queue(frame, encoded, self.session, replaces)
+
+    def transmit(self, frame: str, encoded: EncodedFrame) -> None:
+        """
+        Sends again an encoded frame of a resumed session without numbering it,
+        resume_buffer_size already limits how many of them are queued
+        :param frame: the frame as JSON
+        :param encoded: the frame encoded by WireFormat.encode()
+        :return: None
+        """
+        self.queue(frame, encoded, None, None, limited=False)
+
+    def queue(self, frame: str, encoded: EncodedFrame, session: Optional[Session], replaces: Optional[str],
+              limited: bool = True) -> None:
+        """
+        Queues a frame for the writer of this client, senders never wait for the client
+        The client is disconnected if it has outbound_queue_size frames waiting
+        :param frame: the frame as JSON
+        :param encoded: the frame encoded by WireFormat.encode()
+        :param session: session numbering the frame, None if it is not numbered
+        :param replaces: see send_encoded()
+        :param limited: False if the frame is queued even if the queue is full
+        :return: None
+        """
+        if self.evicted:
+            return
+        entry = (frame, encoded, session, replaces, limited)
+        if limited and self.queued >= CONFIG['outbound_queue_size']:
+            # kept with the other frames which were not written, so the resumed session gets it too
+            self.outbox.append(entry)
+            self.evict()
+            return
+        if replaces is not None:
+            older = self.replaceable.get(replaces)
+            if older is not None:
+                self.outbox.remove(older)
+                self.queued -= older[4]
+                FRAMES_COALESCED.inc()
+            self.replaceable[replaces] = entry
+        self.queued += limited
+        self.outbox.append(entry)
+        self.outbox_ready.set()
+
+    def send_ping(self) -> None:
+        """
+        Pings the client after the frames which are already queued, its reply is not numbered in the session
+        :return: None
+        """
+        self.queue(None, WebSocket.OPCODE_PING, None, None, limited=False)
+
+    def go_away(self) -> None:
+        """
+        Closes the connection after writing the frames which are already queued, the client then reconnects
+        :return: None
+        """
+        self.queue(None, WebSocket.OPCODE_CLOSE, None, None, limited=False)
+
+    def take_unwritten(self) -> List[str]:
+        """
+        Empties the queue of this client
+        :return: frames numbered in the session of this client which were not written yet
+        """
+        frames = [entry[0] for entry in self.outbox if entry[2] is not None and entry[2] is self.session]
+        self.outbox.clear()
+        self.queued = 0
+        self.replaceable.clear()
+        return frames
+
+    def write_frames(self) -> None:
+        """
+        Writes queued frames to the connection one after another, runs until the client disconnects
+        :return: None
+        """
+        while True:
+            while not self.outbox:
+                self.outbox_ready.clear()
+                self.outbox_ready.wait()
+            entry = self.outbox.popleft()
+            frame, encoded, session, replaces, limited = entry
+            self.queued -= limited
+            if replaces is not None and self.replaceable.get(replaces) is entry:
+                del self.replaceable[replaces]
+            if frame is None:
+                self.send_control(encoded)
+                if encoded == WebSocket.OPCODE_CLOSE:
+                    return
+                continue
+            if session is not None and session is self.session:
+                session.record(frame)
+            log_frame('->', frame)
+            if self.crypt is not None:
+                encoded = self.crypt.wrap(encoded)
+            super().send_raw(encoded)
+            FRAMES_SENT.inc()
+            BYTES_SENT.inc(len(encoded))  # json.dumps escapes all non-ASCII characters, so characters are bytes
+
+    def evict(self) -> None:
+        """
+        Disconnects this client because it does not read its frames fast enough,
+        frames of its session are kept, so it can resume the session after reconnecting
+        :return: None
+        """
+        logger.warning('disconnecting a slow client of user %s with %d frames waiting', self.user_id, self.queued)
+        CLIENTS_EVICTED.inc()
+        self.evicted = True
+        if self.session is not None:
+            self.session.detach()
+        self.writer.kill(block=False)
+        self.abort()
+
+    def read_frame(self, frame: Union[str, bytes, None]) -> Union[str, bytes, None]:
+        if self.crypt is None or frame is None:
+            return frame
+        try:
+            if isinstance(frame, str):
+                raise ValueError('Unencrypted frame')
+            return self.crypt.decrypt(bytes(frame))
+        except ValueError:
+            # the client does not know the key or the frame was changed
+            self.abort()
+            return None
 
     def on_data(self, data: dict) -> Optional[dict]:
-        print('<-', data)
+        FRAMES_RECEIVED.inc()
+        log_frame('<-', data)
+        if not isinstance(data, dict):
+            return
         message_type = data.get('type')
         message = data.get('message')
         if message_type is None or message is None:
             return
-
-        r = self.on_message(message_type, message)
-        if r is not None:
-            return self.send_event(r[0], r[1])
-
-    def on_message(self, message_type: str, message: any) -> Optional[Tuple[str, any]]:
-        if message_type == 'ping':
-            return 'pong', 'pong'
-
-        if not self.logged_in:
-            if message_type == 'register':
-                u = User(name=message, key=uuid().hex)
-                db.session.add(u)
-                db.session.commit()
-                return 'register', u.key
-            if message_type == 'login':
-                u = User.query.filter_by(key=message).first()
-                if u is None:
-                    return 'unknownUser', 'I don\'t know you'
-                self.logged_in = True
-                self.user = u
-                online_users[self.user.id] = self
-                return 'login', u.name
+        message_handler = handlers.get(message_type) if isinstance(message_type, str) else None
+        if message_handler is None or message_handler.logged_in not in (None, self.logged_in):
             return
 
-        if self.local_sync < self.database_sync_time[0]:
-            print('synchronizing with global database')
-            db.session.commit()
-            self.local_sync = time.time()
+        request = Request(self, message_type, message, data.get('id'))
+        if not validate(message, message_handler.schema):
+            request.send(message_handler.error, 'Invalid information')
+            return
+        if message_handler.logged_in is not True:
+            # the state of the client may change, so following messages wait for this one
+            self.handle(message_handler, request)
+            return
 
-        # Lobby
-        if message_type == 'listGames':
-            Game.list_games(user=self.user)
+        if message_handler.actor is not None:
+            try:
+                game_id = message_handler.actor(request)
+            except ValueError:
+                request.send(message_handler.error, 'Invalid information')
+                return
+            done = Event()
+            game_actors.tell(game_id, (request, copy_current_request_context(
+                partial(self.handle_in_game, message_handler, request)), done))
+            # the reply is waited for in the pool, so the count of handled messages stays limited
+            self.pool.spawn(done.wait)
             return
-        elif message_type == 'nameChange':
-            self.user.name = message
-            db.session.commit()
-            return 'nameChange', self.user.name
-        elif message_type == 'listGameTypes':
-            r = []
-            for t in GameType.query.all():
-                r.append({'type': t.id, 'name': t.name})
-            return 'openNewGameModal', r
-        elif message_type == 'createGame':
-            game_name = message.get('name', '')
-            game_type_id = message.get('type', '')
-            game_password = message.get('password', '')
-
-            if not game_name or not game_type_id:
-                return 'openNewGameERR', 'Name or type not filled'
-            game_type = GameType.query.filter_by(id=game_type_id).first()
-            if game_type is None:
-                return 'openNewGameERR', 'This game types does not exist'
-            existing_game = Game.query.filter_by(name=game_name).first()
-            if existing_game is not None:
-                return 'openNewGameERR', 'Game with this name already exists'
-            game = Game(name=game_name, type=game_type, owner=self.user)
-            game.users.append(self.user)
-            bank = GamePlayer(name="Bank", game=game, user=self.user, money=game.type.config, is_infinite=True)
-            player = GamePlayer(name=self.user.name, game=game, user=self.user, money=game.type.config)
-            game.players.append(bank)
-            game.players.append(player)
-            if game_password:
-                game.password = game_password
-            db.session.add(game)
-            db.session.add(bank)
-            db.session.add(player)
-
-            record = HistoryRecord(string="The game was stared by %p1%", player1=player, all=True)
-            db.session.add(record)
-            game.update_history(record)
 
-            db.session.commit()
+        job = copy_current_request_context(partial(self.handle, message_handler, request))
+        if message_handler.serial is not None:
+            job = serial_queue.queue(message_handler.serial(request), job)
+        self.pool.spawn(job)
 
-            for u_id in online_users:
-                Game.list_games(u_id)
-
-            self.force_sync()
-            return 'gameEnter', f"{url_for('html.page_game', game_id=game.id)}"
-        elif message_type == 'enterGame':
-            room_id = message.get('id')
-            room_password = message.get('password')
-            game = Game.query.filter_by(id=room_id).first()
-            if game is None:
-                return 'gameEnterERR', 'This game does not exist'
-            if game.password is not None and game.password != room_password and self.user not in game.users:
-                return 'gameEnterERR', 'Wrong room password'
-            if game not in self.user.games:
-                game.users.append(self.user)
-                player = GamePlayer(name=self.user.name, game=game, user=self.user, money=game.type.config)
-                record = HistoryRecord(string=f"%p1% entered into the game as {player.name}", player1=player, all=True)
-                db.session.add(player)
-                game.update_history(record)
-                db.session.add(record)
-                db.session.commit()
-                self.force_sync()
-            game.notify_online_players()
-            return 'gameEnter', f"{url_for('html.page_game', game_id=game.id)}"
-
-        # Game
-        elif message_type == 'gameInfo':
-            game_id = int(message.split('/')[-1])
-            game = Game.query.filter_by(id=game_id).first()
-            if game is None:
-                return 'returnHomepage', 'This game does not exist'
-            if self.user not in game.users:
-                return 'returnHomepage', 'You are not allowed to be here'
-            self.send_event('players', game.format_players(self.user))
-            self.send_event('playersAll', game.get_all_players())
-            self.send_event('hideGame', game.hidden)
-            game.send_history(self.user)
-            return 'gameInfo', {'name': game.name, 'id': game.id}
-
-        game_id = message.get('game')
-        game: Game = Game.query.filter_by(id=game_id).first()
-        if game is None:
+    def handle(self, message_handler: Handler, request: Request) -> None:
+        """
+        Handles a request in its own database session and sends the reply
+        :param message_handler: handler of the type of the request
+        :param request: the request
+        :return: None
+        """
+        if self.evicted:
+            return  # nobody would get the reply
+        queries = getattr(greenlet_queries, 'count', 0)
+        try:
+            r = self.load_game(request) if message_handler.game else None
+            if r is None:
+                r = message_handler.handle(request)
+            if r is not None:
+                request.send(r[0], r[1])
+        except Exception:
+            logger.exception('handling of %s failed', request.type)
+        finally:
+            db.session.remove()
+            MESSAGE_SECONDS.observe(time.perf_counter() - request.received, (request.type,))
+            MESSAGE_QUERIES.observe(getattr(greenlet_queries, 'count', 0) - queries, (request.type,))
+
+    def handle_in_game(self, message_handler: Handler, request: Request) -> Optional[Tuple[str, any]]:
+        """
+        Handles a request changing a game, called by the actor of the game in a GameBatch
+        :param message_handler: handler of the type of the request
+        :param request: the request
+        :return: the reply
+        """
+        r = self.load_game(request) if message_handler.game else None
+        return r if r is not None else message_handler.handle(request)
+
+    @staticmethod
+    def load_game(request: Request) -> Optional[Tuple[str, any]]:
+        """
+        Loads the game the request was sent from into Request.game
+        :param request: the request
+        :return: None if the user can access the game, the reply otherwise
+        """
+        request.game = Game.query.join(rel_game_users) \
+            .filter(Game.id == request.message['game'], rel_game_users.c.user_id == request.client.user_id).first()
+        if request.game is not None:
+            game_actors.touch(request.game.id)
+            return None
+        if Game.query.filter_by(id=request.message['game']).first() is None:
             return 'returnHomepage', 'This game does not exist'
-        if self.user not in game.users:
-            return 'returnHomepage', 'You are not allowed to be here'
-
-        if message_type == 'playerNameChange':
-            player: Optional[GamePlayer] = GamePlayer.query.filter_by(id=message.get('player')).first()
-            if player is None:
-                return 'playerNameChangeERR', 'Player does not exist'
-            if player.user != self.user:
-                return 'playerNameChangeERR', 'Not your player'
-            name = message.get('name')
-            if not name:
-                return 'playerNameChangeERR', 'Invalid name'
-            for p2 in game.players:
-                if p2.id == player.id:
-                    continue
-                if p2.name == name:
-                    return 'playerNameChangeERR', 'Player with this name already exists'
+        return 'returnHomepage', 'You are not allowed to be here'
 
-            record = HistoryRecord(string=f"{player.name} has changed it's name to {name}", all=True)
-            player.name = name
+    def send_event(self, event_type: str, event_message: any):
+        return self.send_raw(encode_event(event_type, event_message))
 
-            game.update_history(record)
-            db.session.add(record)
-            db.session.commit()
-            self.force_sync()
-
-            game.notify_online_players()
-            return 'players', game.format_players(self.user)
-        elif message_type == 'addPlayer':
-            name = message.get('name')
-            if not name:
-                return 'addPlayer', 'Invalid name'
-            for p2 in game.players:
-                if p2.name == name:
-                    return 'addPlayerERR', 'Player with this name already exists'
-            player = GamePlayer(name=name, game=game, user=self.user, money=game.type.config)
-            record = HistoryRecord(string=f"%p1% entered into the game as {player.name}", player1=player, all=True)
-            db.session.add(player)
-            game.update_history(record)
-            db.session.add(record)
-            db.session.commit()
-            self.force_sync()
-
-            game.notify_online_players()
-            return 'players', game.format_players(self.user)
-        elif message_type == 'hideGame':
-            if game.owner != self.user:
-                return 'hideGameERR', 'Sorry, only owner of the game can do this'
-            game.hidden = not game.hidden
-
-            record = HistoryRecord(string="The game was hidden" if game.hidden else 'The game was shown again',
-                                   all=True)
-            game.update_history(record)
-            db.session.add(record)
-            db.session.commit()
-            self.force_sync()
-
-            for u_id in online_users:
-                Game.list_games(u_id)
-
-            self.force_sync()
-
-            return 'hideGame', game.hidden
-        elif message_type == 'modalSend':
-            player: GamePlayer = GamePlayer.query.filter_by(id=message.get('player')).first()
-            r = {
-                'otherPlayers': [],
-                'currencies': list(json.loads(player.money).keys())
-            }
-            for p2 in game.players:
-                if p2.id == player.id:
-                    continue
-                r['otherPlayers'].append({'name': p2.name, 'id': p2.id})
-            return 'openModalSend', r
-        elif message_type == 'sendMoney':
-            player: GamePlayer = GamePlayer.query.filter_by(id=message.get('player')).first()
-            recipient: GamePlayer = GamePlayer.query.filter_by(id=message.get('recipient')).first()
-            amount = float(message.get('amount', 0))
-            currency = message.get('currency')
 
-            if None in (player, recipient, currency):
-                return 'sendMoneyERR', 'Invalid information'
+def game_of(request: Request) -> int:
+    """
+    :return: id of the game the message was sent from
+    :raises ValueError: if it is not a number
+    """
+    return int(request.message['game'])
 
-            if amount <= 0:
-                return 'sendMoneyERR', 'You cannot send less than (or equal to) 0'
 
-            if player.game_id != recipient.game_id:
-                return 'sendMoneyERR', 'Both players must be in the same game!'
+# MESSAGE HANDLERS
 
-            p_money = json.loads(player.money)
-            r_money = json.loads(recipient.money)
-            if None in (p_money.get(currency), r_money.get(currency)):
-                return 'sendMoneyERR', 'Invalid currency'
+@handler('ping', logged_in=None)
+def handle_ping(_: Request):
+    return 'pong', 'pong'
 
-            if p_money.get(currency) < amount and not player.is_infinite:
-                return 'sendMoneyERR', 'You do not have enought money'
 
-            p_money[currency] -= amount
-            r_money[currency] += amount
+@handler('register', str, logged_in=False)
+def handle_register(request: Request):
+    u = User(name=request.message, key=uuid().hex)
+    db.session.add(u)
+    db.session.commit()
+    return 'register', u.key
+
+
+@handler('login', str, logged_in=False, error='unknownUser')
+def handle_login(request: Request):
+    u = User.query.filter_by(key=request.message).first()
+    if u is None:
+        return 'unknownUser', 'I don\'t know you'
+    session = Session(u.id, CONFIG['resume_buffer_size'])
+    sessions[session.token] = session
+    session.attach(request.client)
+    # the first frame of the session, nothing else can be sent to the client before it
+    request.send('session', {'token': session.token})
+    session.subscribe(user_channel(u.id))
+    return 'login', u.name
+
+
+@handler('resume', {'token': str, 'received': int}, logged_in=False, error='resumeERR')
+def handle_resume(request: Request):
+    session = sessions.get(request.message['token'])
+    received = request.message['received']
+    if session is None or not 0 < received <= session.sent:
+        return 'resumeERR', 'The session cannot be resumed'
+    if session.client is not None:
+        # the old connection is not known to be lost yet
+        old_client = session.client
+        session.detach()
+        old_client.logged_in = False
+        old_client.abort()
+    # frames recorded meanwhile are sent too, the session is attached only after the last of them
+    number = received + 1
+    while number <= session.sent:
+        frame = session.frame(number)
+        if frame is None:
+            session.close()
+            return 'resumeERR', 'The session cannot be resumed'
+        request.client.transmit(frame, request.client.wire.encode(frame, CONFIG['compression_threshold']))
+        number += 1
+    session.attach(request.client)
+    return 'resume', True
+
+
+# Lobby
+
+@handler('listGames', {'page?': int, 'prefix?': str})
+def handle_list_games(request: Request):
+    request.client.subscribe(LOBBY)
+    # games the user is member of can be entered without password
+    request.send('myGames', request.user.game_ids())
+    return 'listGames', Game.lobby_page(max(0, request.message.get('page', 0)), request.message.get('prefix', ''))
+
+
+@handler('nameChange', str, serial=lambda request: user_channel(request.client.user_id))
+def handle_name_change(request: Request):
+    request.user.name = request.message
+    db.session.commit()
+    return 'nameChange', request.user.name
+
+
+@handler('listGameTypes')
+def handle_list_game_types(_: Request):
+    r = []
+    for t in GameType.query.all():
+        r.append({'type': t.id, 'name': t.name})
+    return 'openNewGameModal', r
+
+
+@handler('createGame', {'name?': str, 'type?': (int, str), 'password?': (str, type(None))},
+         serial=lambda _: LOBBY, error='openNewGameERR')
+def handle_create_game(request: Request):
+    user = request.user
+    game_name = request.message.get('name', '')
+    game_type_id = request.message.get('type', '')
+    game_password = request.message.get('password', '')
+
+    if not game_name or not game_type_id:
+        return 'openNewGameERR', 'Name or type not filled'
+    game_type = GameType.query.filter_by(id=game_type_id).first()
+    if game_type is None:
+        return 'openNewGameERR', 'This game types does not exist'
+    existing_game = Game.query.filter_by(name=game_name).first()
+    if existing_game is not None:
+        return 'openNewGameERR', 'Game with this name already exists'
+    game = Game(name=game_name, type=game_type, owner=user)
+    game.users.append(user)
+    bank = GamePlayer.create("Bank", game, user, is_infinite=True)
+    player = GamePlayer.create(user.name, game, user)
+    game.players.append(bank)
+    game.players.append(player)
+    if game_password:
+        game.password = game_password
+    db.session.add(game)
+    db.session.add(bank)
+    db.session.add(player)
+
+    record = HistoryRecord(string="The game was stared by %p1%", kind=HistoryRecord.KIND_GAME_STARTED, player1=player,
+                           all=True)
+    db.session.add(record)
+    game.update_history(record)
 
-            player.money = json.dumps(p_money)
-            recipient.money = json.dumps(r_money)
+    db.session.commit()
+    for p in (bank, player):
+        ledger.add_player(game.id, p.id, user.id, game_type.starting_balances(), p.is_infinite)
+
+    game.publish_lobby_diff()
+
+    return 'gameEnter', f"{url_for('html.page_game', game_id=game.id)}"
+
+
+@handler('enterGame', {'id': (int, str), 'password?': (str, type(None))},
+         actor=lambda request: int(request.message['id']), error='gameEnterERR')
+def handle_enter_game(request: Request):
+    user = request.user
+    room_id = request.message.get('id')
+    room_password = request.message.get('password')
+    game = Game.query.filter_by(id=room_id).first()
+    if game is None:
+        return 'gameEnterERR', 'This game does not exist'
+    if game.has_user(user.id):
+        return 'gameEnter', f"{url_for('html.page_game', game_id=game.id)}"
+    if game.password is not None and game.password != room_password:
+        return 'gameEnterERR', 'Wrong room password'
+    game.add_user(user.id)
+    player = GamePlayer.create(user.name, game, user)
+    record = HistoryRecord(string=f"%p1% entered into the game as {player.name}", kind=HistoryRecord.KIND_PLAYER_ADDED,
+                           player1=player, all=True)
+    game.add_player(player, game.type.starting_balances(), record)
+    return 'gameEnter', f"{url_for('html.page_game', game_id=game.id)}"
+
+
+# Game
+
+@handler('gameInfo', str, error='returnHomepage')
+def handle_game_info(request: Request):
+    try:
+        game_id = int(request.message.split('/')[-1])
+    except ValueError:
+        return 'returnHomepage', 'This game does not exist'
+    game = Game.query.filter_by(id=game_id).first()
+    if game is None:
+        return 'returnHomepage', 'This game does not exist'
+    if not game.has_user(request.client.user_id):
+        return 'returnHomepage', 'You are not allowed to be here'
+    game_actors.touch(game.id)
+    request.client.subscribe(game_channel(game.id))
+    request.client.subscribe(user_channel(request.user.id, game.id))
+    request.send('playersSnapshot', game.players_snapshot(request.user))
+    request.send('hideGame', game.hidden)
+    request.send('history', game.history_page(request.user))
+    return 'gameInfo', {'name': game.name, 'id': game.id}
+
+
+@handler('playerNameChange', {'player': (int, str), 'name?': (str, type(None))}, game=True, actor=game_of)
+def handle_player_name_change(request: Request):
+    game = request.game
+    player: Optional[GamePlayer] = GamePlayer.query.filter_by(id=request.message.get('player'),
+                                                              game_id=game.id).first()
+    if player is None:
+        return 'playerNameChangeERR', 'Player does not exist'
+    if player.user_id != request.client.user_id:
+        return 'playerNameChangeERR', 'Not your player'
+    name = request.message.get('name')
+    if not name:
+        return 'playerNameChangeERR', 'Invalid name'
+    if GamePlayer.query.filter(GamePlayer.game_id == game.id, GamePlayer.name == name,
+                               GamePlayer.id != player.id).first() is not None:
+        return 'playerNameChangeERR', 'Player with this name already exists'
+
+    record = HistoryRecord(string=f"{player.name} has changed it's name to {name}",
+                           kind=HistoryRecord.KIND_PLAYER_RENAMED, all=True)
+    player.name = name
+
+    game.update_history(record)
+    db.session.add(record)
+    change = {'seq': game.next_seq(), 'id': player.id, 'name': name}
+
+    game.notify_players_change('playerRenamed', change)
+    return 'playerRenamed', change
+
+
+@handler('playersSnapshot', game=True)
+def handle_players_snapshot(request: Request):
+    return 'playersSnapshot', request.game.players_snapshot(request.user)
+
+
+@handler('addPlayer', {'name?': (str, type(None))}, game=True, actor=game_of)
+def handle_add_player(request: Request):
+    game = request.game
+    name = request.message.get('name')
+    if not name:
+        return 'addPlayer', 'Invalid name'
+    if GamePlayer.query.filter_by(game_id=game.id, name=name).first() is not None:
+        return 'addPlayerERR', 'Player with this name already exists'
+    player = GamePlayer.create(name, game, request.user)
+    record = HistoryRecord(string=f"%p1% entered into the game as {player.name}", kind=HistoryRecord.KIND_PLAYER_ADDED,
+                           player1=player, all=True)
+    return 'playerAdded', game.add_player(player, game.type.starting_balances(), record)
+
+
+@handler('hideGame', game=True, actor=game_of)
+def handle_hide_game(request: Request):
+    game = request.game
+    if game.owner_id != request.client.user_id:
+        return 'hideGameERR', 'Sorry, only owner of the game can do this'
+    game.hidden = not game.hidden
+
+    record = HistoryRecord(string="The game was hidden" if game.hidden else 'The game was shown again',
+                           kind=HistoryRecord.KIND_GAME_HIDDEN if game.hidden else HistoryRecord.KIND_GAME_SHOWN,
+                           all=True)
+    game.update_history(record)
+    db.session.add(record)
+
+    game.publish_lobby_diff()
+
+    return 'hideGame', game.hidden
+
+
+@handler('gameStats', game=True)
+def handle_game_stats(request: Request):
+    return 'gameStats', request.game.stats(request.user)
+
+
+@handler('historyMore', game=True)
+def handle_history_more(request: Request):
+    try:
+        cursor = int(request.message.get('cursor'))
+    except (TypeError, ValueError):
+        return 'historyMoreERR', 'Invalid cursor'
+    return 'historyMore', request.game.history_page(request.user, cursor)
+
+
+@handler('modalSend', {'player': (int, str)}, game=True, error='openModalSendERR')
+def handle_modal_send(request: Request):
+    game = request.game
+    balances = ledger.game(game.id).balances
+    try:
+        player_id = int(request.message['player'])
+    except ValueError:
+        return 'openModalSendERR', 'Invalid information'
+    if player_id not in balances:
+        return 'openModalSendERR', 'Player does not exist'
+    r = {
+        'otherPlayers': [],
+        'currencies': list(balances[player_id].keys())
+    }
+    for p2_id, p2_name in game.get_all_players().items():
+        if p2_id == player_id:
+            continue
+        r['otherPlayers'].append({'name': p2_name, 'id': p2_id})
+    return 'openModalSend', r
+
+
+@handler('sendMoney', {'player': (int, str), 'recipient': (int, str), 'currency': str, 'amount?': (int, float, str)},
+         game=True, actor=game_of)
+def handle_send_money(request: Request):
+    game = request.game
+    currency = request.message['currency']
+    try:
+        player_id, recipient_id = int(request.message['player']), int(request.message['recipient'])
+    except ValueError:
+        return 'sendMoneyERR', 'Invalid information'
+
+    try:
+        amount = parse_amount(request.message.get('amount', 0))
+    except TransferError as e:
+        return 'sendMoneyERR', str(e)
+    if ledger.game(game.id).users.get(player_id) != request.client.user_id:
+        return 'sendMoneyERR', 'You can send only money of your own players'
+    string = f"%p1% sent %p2% {format_amount(amount)} {currency}"
+    # the game is expired by the commit, its attributes would be loaded again in confirm()
+    game_id, owner_id = game.id, game.owner_id
+
+    def confirm(results: List[Tuple[Decimal, Decimal]]) -> None:
+        (amount_sender, amount_recipient), = results
+        users = ledger.game(game_id).users
+        notified_users = {users[player_id], users[recipient_id]}
+        GamePlayer.notify_transfer(game_id, notified_users, player_id, recipient_id, float(amount_sender),
+                                   float(amount_recipient), currency)
+
+        publish_history_record(game_id, record,
+                               [user_channel(user_id, game_id) for user_id in notified_users | {owner_id}])
+
+    record = HistoryRecord.values(game_id, string, HistoryRecord.KIND_TRANSFER, False, player_id, recipient_id,
+                                  amount, currency)
+    current_batch().transfer(request, [(player_id, recipient_id, currency, amount)], record, confirm)
+
+
+@handler('sendMoneyBatch', {'transfers': [{'player': (int, str), 'recipient': (int, str), 'currency': str,
+                                           'amount': (int, float, str)}]},
+         game=True, actor=game_of)
+def handle_send_money_batch(request: Request):
+    game = request.game
+    try:
+        transfers = [(int(t['player']), int(t['recipient']), t['currency'], parse_amount(t['amount']))
+                     for t in request.message['transfers']]
+    except ValueError:
+        return 'sendMoneyBatchERR', 'Invalid information'
+    except TransferError as e:
+        return 'sendMoneyBatchERR', str(e)
+
+    users = ledger.game(game.id).users
+    if any(users.get(sender_id) != request.client.user_id for sender_id, _, _, _ in transfers):
+        return 'sendMoneyBatchERR', 'You can send only money of your own players'
+    names = game.player_names({player_id for transfer in transfers for player_id in transfer[:2]})
+    senders = {sender_id for sender_id, _, _, _ in transfers}
+    recipients = {recipient_id for _, recipient_id, _, _ in transfers}
+    if len(senders) == 1:
+        string = "%p1% sent " + ', '.join(f"{format_amount(amount)} {currency} to {names.get(recipient_id)}"
+                                          for _, recipient_id, currency, amount in transfers)
+    else:
+        string = ', '.join(f"{names.get(sender_id)} sent {format_amount(amount)} {currency} to "
+                           f"{names.get(recipient_id)}"
+                           for sender_id, recipient_id, currency, amount in transfers)
+    # the record is visible to users of all players taking part in the transfers
+    player1_id = transfers[0][0] if transfers else None
+    player2_id = next(iter(recipients)) if len(recipients) == 1 else None
+    currencies = {currency for _, _, currency, _ in transfers}
+    if len(currencies) == 1:
+        total, currency = sum(amount for _, _, _, amount in transfers), next(iter(currencies))
+    else:
+        total, currency = None, None
+    # the game is expired by the commit, its attributes would be loaded again in confirm()
+    game_id, owner_id = game.id, game.owner_id
+
+    def confirm(results: List[Tuple[Decimal, Decimal]]) -> None:
+        # every user gets one notification with all transfers of his players
+        users = ledger.game(game_id).users
+        notifications: Dict[int, List[dict]] = {}
+        for (sender_id, recipient_id, transfer_currency, _), (amount_sender, amount_recipient) in zip(transfers,
+                                                                                                       results):
+            transfer = {'sender': sender_id,
+                        'recipient': recipient_id,
+                        'senderAmount': float(amount_sender),
+                        'recipientAmount': float(amount_recipient),
+                        'currency': transfer_currency}
+            for user_id in {users[sender_id], users[recipient_id]}:
+                notifications.setdefault(user_id, []).append(transfer)
+        for user_id, user_transfers in notifications.items():
+            publish_event(user_channel(user_id, game_id), 'moneyTransfer', user_transfers)
+
+        publish_history_record(game_id, record,
+                               [user_channel(user_id, game_id) for user_id in set(notifications) | {owner_id}])
+
+    record = HistoryRecord.values(game_id, string, HistoryRecord.KIND_TRANSFER_BATCH, False, player1_id, player2_id,
+                                  total, currency, sorted(senders | recipients))
+    current_batch().transfer(request, transfers, record, confirm)
 
-            for p in (player, recipient):
-                p.notify_transfer(player, recipient, p_money[currency], r_money[currency], currency)
 
-            record = HistoryRecord(string=f"%p1% sent %p2% {amount} {currency}", player1=player, player2=recipient)
-            game.update_history(record)
-            db.session.add(record)
-            db.session.commit()
-            self.force_sync()
+@soc.route('/soc')
+def soc_comm(ws: WebSocket):
+    # the client lists encodings and compressions it accepts, e.g. /soc?encoding=msgpack&compression=deflate
+    wire = WireFormat.negotiate(http_request.args.get('encoding', '').split(','),
+                                http_request.args.get('compression', '').split(','))
+    crypt = None
+    if CONFIG['transport_key'] is not None:
+        # the client sends its nonce, e.g. /soc?encryption=aes-ctr-hmac&nonce=<32 hex digits>,
+        # the server replies with its nonce, all following frames are encrypted,
+        # the first one proves to the client that the server uses the same key
+        try:
+            if http_request.args.get('encryption') != ENCRYPTION_AES_CTR_HMAC:
+                raise ValueError('Unencrypted connection')
+            crypt = FrameCrypt(bytes.fromhex(CONFIG['transport_key']), bytes.fromhex(http_request.args.get('nonce', '')))
+        except ValueError:
+            ws.close()
             return
+        ws.send(encode_event('encryption', {'nonce': crypt.server_nonce.hex()}))
+        wire = wire._replace(encryption=ENCRYPTION_AES_CTR_HMAC)
+    c = GameClient(ws, wire, crypt)
+    if crypt is not None:
+        c.send_raw(encode_event('encryption', {}))
+    c.run()
 
-    def force_sync(self):
-        self.database_sync_time[0] = time.time()
 
-    def send_event(self, event_type: str, event_message: any):
-        return self.send_dict({'type': event_type, 'message': event_message})
+def static_url(name: str) -> str:
+    """
+    :param name: path of a file relative to the static directory
+    :return: URL of the file served as it is on the disk
+    """
+    return url_for('static', filename=name)
 
 
-@soc.route('/soc')
-def soc_comm(ws: WebSocket):
-    c = GameClient(ws)
-    c.run()
+@html.context_processor
+def template_globals() -> dict:
+    """
+    :return: variables available in all templates
+    """
+    if CONFIG['production']:
+        asset_url = assets.url
+        scripts = assets.scripts()
+    else:
+        asset_url = static_url
+        scripts = [static_url(name) for name in ASSET_SCRIPTS]
+    return {'transport_encryption': ENCRYPTION_AES_CTR_HMAC if CONFIG['transport_key'] is not None else '',
+            'asset_url': asset_url, 'scripts': scripts}
+
+
+def render_page(template_name: str) -> Response:
+    """
+    Renders a page, in the production mode only once, browsers then revalidate it by its ETag
+    :param template_name: name of the template of the page
+    :return: response with the page
+    """
+    if not CONFIG['production']:
+        return Response(render_template(template_name), content_type='text/html; charset=utf-8')
+    page = rendered_pages.get(template_name)
+    if page is None:
+        page = rendered_pages[template_name] = render_template(template_name)
+    response = Response(page, content_type='text/html; charset=utf-8')
+    response.add_etag()
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(http_request)
 
 
 @html.route('/')
 def page_home():
-    return render_template('index.html')
+    return render_page('index.html')
 
 
 # noinspection PyUnresolvedReferences
 @html.route('/game/<int:game_id>')
 def page_game(*_, **__):
-    return render_template('game.html')
+    return render_page('game.html')
 
 
-def main():
-    from gevent import pywsgi
-    # noinspection PyPackageRequirements
-    from geventwebsocket.handler import WebSocketHandler
+@html.route('/assets/<path:name>')
+def page_asset(name: str):
+    found = assets.get(name, {encoding: quality for encoding, quality in http_request.accept_encodings})
+    if found is None:
+        return Response('Not found', status=404, content_type='text/plain')
+    asset, encoding, content = found
+    headers = {'Cache-Control': CACHE_CONTROL, 'ETag': asset.etag, 'Vary': 'Accept-Encoding'}
+    if asset.etag in http_request.headers.get('If-None-Match', ''):
+        return Response(status=304, headers=headers)
+    if encoding != 'identity':
+        headers['Content-Encoding'] = encoding
+    return Response(content, content_type=asset.content_type, headers=headers)
 
-    db.create_all()
 
+@html.route('/metrics')
+def page_metrics():
+    return Response(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def export_game(game_id: int) -> Optional[bytes]:
+    """
+    Exports a game with its players, their balances, history and users, so it can be imported by another server
+    Keys of the users are left out, they would let anybody with the export log in as the users
+    :param game_id: id of the game
+    :return: the game compressed by pack_game(), None if it does not exist
+    """
+    ledger.flush(game_id)  # write pending transfers of the game before reading them
+    players = select(GamePlayer.id).where(GamePlayer.game_id == game_id)
+    members = select(rel_game_users.c.user_id).where(rel_game_users.c.game_id == game_id)
+    with db.engine.connect() as connection:
+        if connection.dialect.name == 'sqlite':
+            # pysqlite begins transactions only before writes, all tables are read from one snapshot
+            connection.exec_driver_sql('BEGIN')
+
+        def read(query) -> TableRows:
+            result = connection.execute(query)
+            return {'columns': list(result.keys()), 'rows': [list(row) for row in result]}
+
+        game = read(Game.__table__.select().where(Game.id == game_id))
+        if not game['rows']:
+            return None
+        owner_id = game['rows'][0][game['columns'].index('owner_id')]
+        game_type = connection.execute(select(GameType.name).join(Game, Game.type_id == GameType.id)
+                                       .where(Game.id == game_id)).scalar()
+        tables = {
+            Game.__tablename__: game,
+            User.__tablename__: read(select(*[c for c in User.__table__.c if c.name != 'key']).where(or_(
+                User.id == owner_id, User.id.in_(members),
+                User.id.in_(select(GamePlayer.user_id).where(GamePlayer.game_id == game_id))))),
+            rel_game_users.name: read(rel_game_users.select().where(rel_game_users.c.game_id == game_id)),
+            GamePlayer.__tablename__: read(GamePlayer.__table__.select().where(GamePlayer.game_id == game_id)
+                                           .order_by(GamePlayer.id)),
+            GamePlayerBalance.__tablename__: read(GamePlayerBalance.__table__.select()
+                                                  .where(GamePlayerBalance.player_id.in_(players))),
+            HistoryRecord.__tablename__: read(HistoryRecord.__table__.select()
+                                              .where(HistoryRecord.game_id == game_id).order_by(HistoryRecord.id)),
+            rel_record_players.name: read(rel_record_players.select().where(rel_record_players.c.record_id.in_(
+                select(HistoryRecord.id).where(HistoryRecord.game_id == game_id)))),
+        }
+    return pack_game(game_type, tables)
+
+
+def import_value(column: db.Column, value: any) -> any:
+    """
+    :param column: column of a table
+    :param value: value of the column exported by export_value()
+    :return: the value as the column takes it
+    """
+    if value is None:
+        return None
+    if isinstance(column.type, db.DateTime):
+        return datetime.fromisoformat(value)
+    if isinstance(column.type, Money):
+        return Decimal(value)
+    return value
+
+
+def import_game(data: bytes) -> Tuple[int, List[dict]]:
+    """
+    Imports a game exported by export_game() as a new game, its rows are inserted in bulk in one transaction
+    Its users are registered again with new keys, a game with the same name gets a number after its name
+    :param data: the exported game
+    :return: (id of the new game, [{id, name, key} of its new users])
+    :raises ValueError: if the data are not an exported game or its type does not exist
+    """
+    export = unpack_game(data)
+    try:
+        tables = export['tables']
+
+        def rows(table: db.Table) -> List[dict]:
+            if table is rel_record_players and table.name not in tables:
+                return []  # exported before the table existed
+            # columns which do not exist here are left out
+            columns = [(i, table.c[name]) for i, name in enumerate(tables[table.name]['columns']) if name in table.c]
+            return [{column.name: import_value(column, row[i]) for i, column in columns}
+                    for row in tables[table.name]['rows']]
+
+        users, [game], players = rows(User.__table__), rows(Game.__table__), rows(GamePlayer.__table__)
+        members, balances = rows(rel_game_users), rows(GamePlayerBalance.__table__)
+        records, participants = rows(HistoryRecord.__table__), rows(rel_record_players)
+    except (KeyError, IndexError, TypeError, ValueError) as e:
+        raise ValueError(f'invalid exported game: {e!r}')
+
+    with db.engine.begin() as connection:
+        type_id = connection.execute(select(GameType.id).where(GameType.name == export['type'])).scalar()
+        if type_id is None:
+            raise ValueError(f'game type {export["type"]} does not exist')
+
+        new_users = [{'name': user['name'], 'key': uuid().hex} for user in users]
+        user_ids = {}
+        for user, new_user in zip(users, new_users):
+            new_user['id'] = user_ids[user['id']] = connection.execute(
+                User.__table__.insert(), new_user).inserted_primary_key[0]
+
+        # the transaction already writes, so no other one creates a game with the name until it is committed
+        name, number = game['name'], 1
+        while connection.execute(select(Game.id).where(Game.name == game['name'])).first() is not None:
+            number += 1
+            game['name'] = f'{name} ({number})'
+        del game['id']
+        game.update(type_id=type_id, owner_id=user_ids[game['owner_id']], search_name=game['name'].casefold())
+        game_id = connection.execute(Game.__table__.insert(), game).inserted_primary_key[0]
+
+        # the transaction writes, so no other one takes these ids until it is committed
+        first_player_id = (connection.execute(select(func.max(GamePlayer.id))).scalar() or 0) + 1
+        player_ids = {player['id']: first_player_id + i for i, player in enumerate(players)}
+        for player in players:
+            player.update(id=player_ids[player['id']], user_id=user_ids[player['user_id']], game_id=game_id)
+        for member in members:
+            member.update(user_id=user_ids[member['user_id']], game_id=game_id)
+        for balance in balances:
+            del balance['id']
+            balance['player_id'] = player_ids[balance['player_id']]
+        first_record_id = (connection.execute(select(func.max(HistoryRecord.id))).scalar() or 0) + 1
+        record_ids = {record['id']: first_record_id + i for i, record in enumerate(records)}
+        for record in records:
+            record.update(id=record_ids[record['id']], game_id=game_id,
+                          player1_id=player_ids.get(record['player1_id']),
+                          player2_id=player_ids.get(record['player2_id']))
+        for participant in participants:
+            participant.update(record_id=record_ids[participant['record_id']],
+                               player_id=player_ids[participant['player_id']])
+        for table, table_rows in ((GamePlayer.__table__, players), (rel_game_users, members),
+                                  (GamePlayerBalance.__table__, balances), (HistoryRecord.__table__, records),
+                                  (rel_record_players, participants)):
+            if table_rows:
+                connection.execute(table.insert(), table_rows)
+    logger.info('imported game %d with %d players and %d history records', game_id, len(players), len(records))
+    return game_id, new_users
+
+
+def admin_refusal() -> Optional[Response]:
+    """
+    :return: response refusing the current HTTP request to an /admin/ page, None if the request is allowed
+    """
+    token = CONFIG['admin_token']
+    if token is None:
+        return Response('Not found', status=404, content_type='text/plain')
+    if not hmac.compare_digest(http_request.headers.get('Authorization', '').encode('utf-8'),
+                               f'Bearer {token}'.encode('utf-8')):
+        return Response('Unauthorized', status=401, content_type='text/plain', headers={'WWW-Authenticate': 'Bearer'})
+    return None
+
+
+@html.route('/admin/backup')
+def page_admin_backup():
+    refusal = admin_refusal()
+    if refusal is not None:
+        return refusal
+    url = db.engine.url
+    if url.get_backend_name() != 'sqlite' or url.database in (None, '', ':memory:'):
+        return Response('Only SQLite database files can be backed up', status=501, content_type='text/plain')
+    ledger.flush()  # write pending transfers into the copy
+    handle, backup_path = tempfile.mkstemp(prefix='backup-', suffix='.sqlite',
+                                           dir=path.dirname(path.abspath(url.database)))
+    os.close(handle)
+    try:
+        copy_database(url.database, backup_path, CONFIG['backup_pages'], CONFIG['backup_pause'])
+        size = path.getsize(backup_path)
+    except Exception:
+        os.remove(backup_path)
+        raise
+
+    def stream() -> Iterable[bytes]:
+        try:
+            with open(backup_path, 'rb') as f:
+                yield from iter(partial(f.read, 64 * 1024), b'')
+        finally:
+            os.remove(backup_path)
+
+    file_name = f'db-{datetime.utcnow():%Y%m%d-%H%M%S}.sqlite'
+    return Response(stream(), content_type='application/vnd.sqlite3', direct_passthrough=True,
+                    headers={'Content-Length': str(size), 'Content-Disposition': f'attachment; filename="{file_name}"'})
+
+
+@html.route('/admin/games/<int:game_id>')
+def page_admin_export_game(game_id: int):
+    refusal = admin_refusal()
+    if refusal is not None:
+        return refusal
+    data = export_game(game_id)
+    if data is None:
+        return Response('Not found', status=404, content_type='text/plain')
+    return Response(data, content_type='application/gzip',
+                    headers={'Content-Disposition': f'attachment; filename="game-{game_id}.json.gz"'})
+
+
+@html.route('/admin/games', methods=['POST'])
+def page_admin_import_game():
+    refusal = admin_refusal()
+    if refusal is not None:
+        return refusal
+    try:
+        game_id, users = import_game(http_request.get_data())
+    except ValueError as e:
+        return Response(str(e), status=400, content_type='text/plain')
+    game = db.session.get(Game, game_id)
+    game.publish_lobby_diff()
+    # the users log in by opening their links
+    return Response(json.dumps({'id': game_id, 'name': game.name, 'url': f'/game/{game_id}',
+                                'users': [dict(user, url=f'/#user={user["key"]}') for user in users]}),
+                    status=201, content_type='application/json')
+
+
+def migrate() -> None:
+    """
+    Brings an existing database up to date with the models,
+    db.create_all() creates only missing tables
+    :return: None
+    """
+    # columns added to the models after their tables were created
+    inspector = inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing_columns:
+                db.session.execute(text(f'ALTER TABLE {db.engine.dialect.identifier_preparer.format_table(table)} '
+                                        f'ADD COLUMN {CreateColumn(column).compile(dialect=db.engine.dialect)}'))
+    db.session.commit()
+
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+
+    # activity of games used not to be recorded, they are as active as their last history record, if it has a time,
+    # so games still played do not disappear from the lobby
+    games = Game.__table__
+    last_record_at = select(func.max(HistoryRecord.created_at)).where(HistoryRecord.game_id == games.c.id) \
+        .scalar_subquery()
+    db.session.execute(games.update().where(games.c.active_at.is_(None))
+                       .values(active_at=func.coalesce(last_record_at, datetime.utcnow())))
+    db.session.commit()
+
+    # games used to be searched by their names
+    for game_id, name in db.session.query(Game.id, Game.name).filter(Game.search_name.is_(None)):
+        db.session.execute(Game.__table__.update().where(Game.id == game_id).values(search_name=name.casefold()))
+    db.session.commit()
+
+    # balances used to be stored as JSON in GamePlayer.money
+    migrated = db.session.query(GamePlayerBalance.player_id)
+    for player_id, money in db.session.query(GamePlayer.id, GamePlayer.money).filter(GamePlayer.id.notin_(migrated)):
+        rows = [{'player_id': player_id, 'currency': currency, 'amount': parse_amount(amount)}
+                for currency, amount in json.loads(money).items()]
+        if rows:
+            db.session.execute(GamePlayerBalance.__table__.insert(), rows)
+    db.session.commit()
+
+    # history records used to be described only by their strings, transfers in them are added to statistics
+    patterns = [
+        (r'The game was stared by %p1%', HistoryRecord.KIND_GAME_STARTED),
+        (r'%p1% entered into the game as .*', HistoryRecord.KIND_PLAYER_ADDED),
+        (r'The game was hidden', HistoryRecord.KIND_GAME_HIDDEN),
+        (r'The game was shown again', HistoryRecord.KIND_GAME_SHOWN),
+        (r'%p1% sent %p2% (?P<amount>\S+) (?P<currency>.+)', HistoryRecord.KIND_TRANSFER),
+        (r".* has changed it's name to .*", HistoryRecord.KIND_PLAYER_RENAMED),
+        (r'.* sent .+ to .+', HistoryRecord.KIND_TRANSFER_BATCH),
+    ]
+    records = HistoryRecord.__table__
+    stats: Deltas = {}
+    for record_id, string, player1_id, player2_id in db.session.query(
+            HistoryRecord.id, HistoryRecord.string, HistoryRecord.player1_id, HistoryRecord.player2_id) \
+            .filter(HistoryRecord.kind.is_(None)).all():
+        for pattern, kind in patterns:
+            match = re.fullmatch(pattern, string, re.DOTALL)
+            if match is not None:
+                break
+        else:
+            continue
+        values = {'kind': kind}
+        if kind == HistoryRecord.KIND_TRANSFER and player1_id is not None and player2_id is not None:
+            try:
+                amount = parse_amount(match['amount'])
+            except TransferError:
+                amount = None
+            if amount is not None:
+                values.update(amount=amount, currency=match['currency'])
+                # only the counters, the balances already contain the transfer
+                for key, change in (((player1_id, match['currency']), BalanceChange.sending(amount)),
+                                    ((player2_id, match['currency']), BalanceChange.receiving(amount))):
+                    stats[key] = stats.get(key, BalanceChange()) + change._replace(amount=Decimal(0))
+        db.session.execute(records.update().where(records.c.id == record_id).values(values))
+    for (player_id, currency), change in stats.items():
+        add_to_balance(db.session.connection(), player_id, currency, change)
+    db.session.commit()
+
+
+def load_config() -> None:
+    """
+    Updates CONFIG by data/config.json and configures the application by it
+    Has to be called before the database is used
+    :return: None
+    """
     config_file = path.join(SCRIPT_DIR, 'data', 'config.json')
     if path.exists(config_file):
         with open(config_file, 'r') as f:
             CONFIG.update(json.load(f))
+    if CONFIG['database_uri']:
+        app.config["SQLALCHEMY_DATABASE_URI"] = CONFIG['database_uri']
+    if CONFIG['db_threads'] > 0 and app.config["SQLALCHEMY_DATABASE_URI"].startswith('sqlite'):
+        app.config["SQLALCHEMY_ENGINE_OPTIONS"] = dict(app.config["SQLALCHEMY_ENGINE_OPTIONS"], connect_args={
+            'factory': database_threads.connection_class(), 'check_same_thread': False})
+        # readers wait for writers only outside the WAL mode
+        database_threads.reads = str(CONFIG['sqlite_pragmas'].get('journal_mode', '')).upper() != 'WAL'
+    logging.basicConfig(level=CONFIG['log_level'], format='%(asctime)s %(process)d %(levelname)s %(name)s: %(message)s')
+    ledger.flush_interval = CONFIG['ledger_flush_interval']
+    ledger.durability = CONFIG['ledger_durability']
+    ledger.group_window = CONFIG['ledger_group_window']
+    game_actors.batch_size = CONFIG['game_batch_size']
+    game_actors.idle_timeout = CONFIG['game_idle_timeout']
+    if CONFIG['transport_key'] is not None:
+        if FrameCrypt is None:
+            raise ValueError('transport_key needs pycryptodome')
+        FrameCrypt(bytes.fromhex(CONFIG['transport_key']), bytes(NONCE_SIZE))  # raises ValueError if it is invalid
+    if CONFIG['production']:
+        app.config['TEMPLATES_AUTO_RELOAD'] = False
+        for template_name in app.jinja_env.list_templates():
+            app.jinja_env.get_template(template_name)
+        assets.build()
+
+
+def main():
+    load_config()
+    db.create_all()
+    migrate()
 
     with open(path.join(SCRIPT_DIR, 'data', 'game-types.json')) as f:
         game_types = json.load(f)
@@ -606,9 +2646,138 @@ def main():
                 game_type.config = game_type_config
     db.session.commit()
 
-    server = pywsgi.WSGIServer((CONFIG['host'], CONFIG['port']), app, handler_class=WebSocketHandler)
-    print('up and running')
-    server.serve_forever()
+    if CONFIG['workers'] <= 1:
+        logger.info('up and running')
+        serve((CONFIG['host'], CONFIG['port']), LocalBus(deliver))
+        return
+
+    if ledger.durability == LedgerEngine.DURABILITY_WRITE_BEHIND:
+        logger.warning('more workers share the database, using the sync ledger durability')
+        ledger.durability = LedgerEngine.DURABILITY_SYNC
+    socket_path = CONFIG['bus_socket'] or path.join(SCRIPT_DIR, 'data', 'bus.sock')
+
+    # all workers accept connections from one listening socket
+    listener = socket.socket(socket.AF_INET6 if ':' in CONFIG['host'] else socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((CONFIG['host'], CONFIG['port']))
+    listener.listen(socket.SOMAXCONN)
+
+    # database connections cannot be shared by more processes
+    db.session.remove()
+    db.engine.dispose()
+
+    workers = []
+    for _ in range(CONFIG['workers']):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                serve(listener, SocketBus(deliver, socket_path))
+            finally:
+                os._exit(0)
+        workers.append(pid)
+
+    def stop_workers() -> None:
+        for worker in workers:
+            try:
+                os.kill(worker, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    broker = BusBroker(socket_path)
+    broker.start()
+    gevent.signal_handler(signal.SIGTERM, stop_workers)
+    logger.info('up and running')
+    try:
+        for _ in workers:
+            os.waitpid(-1, 0)
+    finally:
+        stop_workers()
+        broker.stop()
+
+
+class GameWebSocket(WebSocket):
+    """
+    WebSocket telling its handler about replies to pings
+    """
+    __slots__ = ()
+
+    def handle_pong(self, header, payload):
+        on_pong = getattr(self.handler, 'on_pong', None)
+        if on_pong is not None:
+            on_pong()
+
+
+class GameWebSocketHandler(WebSocketHandler):
+    """
+    Refuses WebSocket connections over max_connections before accepting them
+    """
+
+    def upgrade_websocket(self):
+        if CONFIG['max_connections'] is not None and len(clients) >= CONFIG['max_connections'] \
+                and self.environ.get('HTTP_UPGRADE', '').lower() == 'websocket':
+            CONNECTIONS_REFUSED.inc()
+            self.start_response('503 Service Unavailable', [('Retry-After', '5')])
+            return [b'Too many connections']
+        result = super().upgrade_websocket()
+        if getattr(self, 'websocket', None) is not None:
+            # WebSocketHandler creates the WebSocket itself
+            self.websocket.__class__ = GameWebSocket
+        return result
+
+
+def drain(server) -> None:
+    """
+    Stops accepting connections, writes frames queued for clients, closes their connections
+    and waits for their messages being handled, at most drain_timeout seconds
+    :param server: the stopped server
+    :return: None
+    """
+    server.close()
+    deadline = time.monotonic() + CONFIG['drain_timeout']
+    pools = [client.pool for client in clients]
+    logger.info('draining %d connections', len(pools))
+    for client in list(clients):
+        client.go_away()
+    while clients and time.monotonic() < deadline:
+        gevent.sleep(0.05)
+    for client in list(clients):
+        client.abort()
+    for pool in pools:
+        pool.join(timeout=max(0.0, deadline - time.monotonic()))
+
+
+def serve(listener, worker_bus: EventBus) -> None:
+    """
+    Serves clients in this process until SIGTERM or SIGINT, then drains the connections
+    and writes pending changes of the ledger
+    :param listener: (host, port) or a listening socket
+    :param worker_bus: bus connecting this process with the others
+    :return: None
+    """
+    from gevent import pywsgi
+
+    global bus
+    bus = worker_bus
+    server = pywsgi.WSGIServer(listener, app, handler_class=GameWebSocketHandler)
+    stopped = Event()
+    for signal_number in (signal.SIGTERM, signal.SIGINT):
+        gevent.signal_handler(signal_number, stopped.set)
+    database_threads.start(CONFIG['db_threads'])
+    bus.start()
+    ledger.start()
+    session_closer = gevent.spawn(close_expired_sessions)
+    reaper = gevent.spawn(reap_idle_connections)
+    try:
+        server.start()
+        stopped.wait()
+        drain(server)
+    finally:
+        reaper.kill()
+        session_closer.kill()
+        ledger.stop()
+        bus.stop()
+        database_threads.stop()
+        logger.info('stopped')
 
 
 app.register_blueprint(html, url_prefix=r'/')
@@ -0,0 +1,171 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, browsers get gzip without it
+    brotli = None
+
+# Scripts included by every page, in the order in which they are executed
+SCRIPTS = (
+    'scripts/prompt.js',
+    'scripts/popup.js',
+    'scripts/msgpack.js',
+    'scripts/crypt.js',
+    'scripts/comm.js',
+    'scripts/renderer.js',
+    'scripts/main.js',
+)
+
+# Name of the bundle of SCRIPTS
+SCRIPTS_BUNDLE = 'scripts/bundle.js'
+
+# Files with these extensions are compressed, the others (sounds) are already compressed
+COMPRESSED_EXTENSIONS = ('.js', '.css', '.svg', '.html', '.json')
+
+# How long can browsers cache fingerprinted files, their content never changes
+CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+
+class Asset(NamedTuple):
+    """
+    Fingerprinted file kept in memory together with its compressed variants
+    """
+    content_type: str
+    etag: str
+    # encoding (identity, gzip, br) -> content
+    variants: Dict[str, bytes]
+
+
+def minify_js(text: str) -> str:
+    """
+    Removes indentation, blank lines and lines with only a comment,
+    lines themselves are kept so the automatic semicolon insertion works as before
+    :param text: source of a script
+    :return: minified script
+    """
+    lines = (line.strip() for line in text.splitlines())
+    return '\n'.join(line for line in lines if line and not line.startswith('//'))
+
+
+def minify_css(text: str) -> str:
+    """
+    :param text: source of a stylesheet
+    :return: the stylesheet without comments and whitespace around its punctuation
+    """
+    text = re.sub(r'/\*.*?\*/', '', text, flags=re.DOTALL)
+    text = re.sub(r'\s+', ' ', text)
+    text = re.sub(r'\s*([{};,>])\s*', r'\1', text)
+    return re.sub(r':\s+', ':', text).replace(';}', '}').strip()
+
+
+def fingerprinted(name: str, content: bytes) -> str:
+    """
+    :param name: path of a file relative to the static directory, e.g. scripts/bundle.js
+    :param content: content of the file
+    :return: the path with a hash of the content, e.g. scripts/bundle.3f2a1b9c0d.js
+    """
+    root, extension = os.path.splitext(name)
+    return f'{root}.{hashlib.sha256(content).hexdigest()[:10]}{extension}'
+
+
+def compress(name: str, content: bytes) -> Dict[str, bytes]:
+    """
+    :param name: name of the file, decides whether it is worth compressing
+    :param content: content of the file
+    :return: encoding -> content, compressed variants only if they are smaller
+    """
+    variants = {'identity': content}
+    if not name.endswith(COMPRESSED_EXTENSIONS):
+        return variants
+    candidates = {'gzip': gzip.compress(content, 9, mtime=0)}
+    if brotli is not None:
+        candidates['br'] = brotli.compress(content, quality=11)
+    for encoding, compressed in candidates.items():
+        if len(compressed) < len(content):
+            variants[encoding] = compressed
+    return variants
+
+
+class AssetStore:
+    """
+    Static files bundled, minified, fingerprinted and compressed once, when the server starts
+    """
+
+    def __init__(self, static_dir: str, url_prefix: str):
+        """
+        :param static_dir: directory with static files
+        :param url_prefix: URL under which the fingerprinted files are served, e.g. /assets/
+        """
+        self.static_dir = static_dir
+        self.url_prefix = url_prefix
+        # name of a source file -> its URL
+        self.urls: Dict[str, str] = {}
+        # fingerprinted path -> file
+        self.files: Dict[str, Asset] = {}
+
+    def build(self) -> None:
+        """
+        Reads all static files and prepares them to be served
+        :return: None
+        """
+        sources: List[Tuple[str, bytes]] = []
+        for directory, _, file_names in os.walk(self.static_dir):
+            for file_name in sorted(file_names):
+                file_path = os.path.join(directory, file_name)
+                name = os.path.relpath(file_path, self.static_dir).replace(os.sep, '/')
+                if name in SCRIPTS:
+                    continue
+                with open(file_path, 'rb') as f:
+                    content = f.read()
+                if name.endswith('.js'):
+                    content = minify_js(content.decode('utf8')).encode('utf8')
+                elif name.endswith('.css'):
+                    content = minify_css(content.decode('utf8')).encode('utf8')
+                sources.append((name, content))
+
+        scripts = []
+        for name in SCRIPTS:
+            with open(os.path.join(self.static_dir, name), 'r', encoding='utf8') as f:
+                # a script not ending with a semicolon must not continue in the next one
+                scripts.append(minify_js(f.read()) + '\n;')
+        sources.append((SCRIPTS_BUNDLE, '\n'.join(scripts).encode('utf8')))
+
+        for name, content in sources:
+            path = fingerprinted(name, content)
+            content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+            if content_type.startswith('text/') or content_type == 'application/javascript':
+                content_type += '; charset=utf-8'
+            self.files[path] = Asset(content_type, f'"{path}"', compress(name, content))
+            self.urls[name] = self.url_prefix + path
+
+    def url(self, name: str) -> str:
+        """
+        :param name: path of a file relative to the static directory
+        :return: URL of its fingerprinted variant
+        """
+        return self.urls[name]
+
+    def scripts(self) -> List[str]:
+        """
+        :return: URLs of scripts to be included by every page
+        """
+        return [self.urls[SCRIPTS_BUNDLE]]
+
+    def get(self, path: str, accepted_encodings: Dict[str, float]) -> Optional[Tuple[Asset, str, bytes]]:
+        """
+        :param path: fingerprinted path of a file
+        :param accepted_encodings: encoding -> its quality accepted by the browser
+        :return: the file, encoding of its content and its content or None if there is no such file
+        """
+        asset = self.files.get(path)
+        if asset is None:
+            return None
+        for encoding in ('br', 'gzip'):
+            if encoding in asset.variants and accepted_encodings.get(encoding, 0) > 0:
+                return asset, encoding, asset.variants[encoding]
+        return asset, 'identity', asset.variants['identity']
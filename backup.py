@@ -0,0 +1,102 @@
+import gzip
+import json
+import logging
+import sqlite3
+import time
+from datetime import datetime
+from decimal import Decimal
+from typing import Dict, List, TypedDict
+
+import gevent
+
+logger = logging.getLogger(__name__)
+
+# Identifies exported games, see pack_game()
+GAME_EXPORT_FORMAT = 'gamemoney-game'
+GAME_EXPORT_VERSION = 1
+
+
+class TableRows(TypedDict):
+    """
+    Rows of one table, values of every row are in the order of the columns
+    """
+    columns: List[str]
+    rows: List[list]
+
+
+def copy_database(source_path: str, target_path: str, pages: int = 256, pause: float = 0.005) -> None:
+    """
+    Copies an SQLite database used by other connections into a new file by the backup API of SQLite
+
+    In the WAL journal mode the copy reads one snapshot of the database a few pages at a time
+    and lets other greenlets run between the steps, writers are never blocked by it
+    and their commits made meanwhile do not restart the copy.
+    In other journal modes a reader blocks writers, so the database is copied in one step
+    :param source_path: path of the database
+    :param target_path: path of the copy, overwritten if it exists
+    :param pages: how many pages are copied in one step
+    :param pause: how long (in seconds) to wait between the steps
+    :return: None
+    """
+    started = time.perf_counter()
+    source = sqlite3.connect(source_path, isolation_level=None)
+    target = sqlite3.connect(target_path, isolation_level=None)
+    try:
+        # an interrupted copy is just made again, so writing it does not wait for the disk
+        target.execute('PRAGMA synchronous=OFF').fetchall()
+        wal = source.execute('PRAGMA journal_mode').fetchone()[0].lower() == 'wal'
+        if wal:
+            # the read transaction keeps the snapshot between the steps
+            source.execute('BEGIN')
+            source.execute('SELECT 1 FROM sqlite_master LIMIT 1').fetchall()
+        source.backup(target, pages=pages if wal else -1, progress=lambda *_: gevent.sleep(pause), sleep=pause)
+        if wal:
+            source.execute('COMMIT')
+        # the copy is one file, without a WAL journal next to it
+        target.execute('PRAGMA journal_mode=DELETE').fetchall()
+    finally:
+        target.close()
+        source.close()
+    logger.info('database copied into %s in %.2f s', target_path, time.perf_counter() - started)
+
+
+def export_value(value: any) -> any:
+    """
+    :param value: value of a column
+    :return: the value stored exactly in JSON, decimals as strings and times in the ISO format
+    """
+    if isinstance(value, Decimal):
+        return str(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+def pack_game(game_type: str, tables: Dict[str, TableRows]) -> bytes:
+    """
+    :param game_type: name of the type of the game
+    :param tables: table name -> rows of the game in the table
+    :return: the game compressed for unpack_game()
+    """
+    export = {'format': GAME_EXPORT_FORMAT, 'version': GAME_EXPORT_VERSION, 'type': game_type,
+              'tables': {name: {'columns': table['columns'], 'rows': [[export_value(value) for value in row]
+                                                                      for row in table['rows']]}
+                         for name, table in tables.items()}}
+    return gzip.compress(json.dumps(export, separators=(',', ':')).encode('utf-8'))
+
+
+def unpack_game(data: bytes) -> dict:
+    """
+    :param data: game compressed by pack_game()
+    :return: {type: name of the type of the game, tables: {table name: rows of the game in the table}}
+    :raises ValueError: if the data are not an exported game
+    """
+    try:
+        export = json.loads(gzip.decompress(data))
+    except (OSError, EOFError, UnicodeDecodeError, json.JSONDecodeError) as e:
+        raise ValueError(f'not an exported game: {e}')
+    if not isinstance(export, dict) or export.get('format') != GAME_EXPORT_FORMAT:
+        raise ValueError('not an exported game')
+    if export.get('version') != GAME_EXPORT_VERSION:
+        raise ValueError(f'unsupported version {export.get("version")} of the exported game')
+    return export
@@ -0,0 +1,119 @@
+"""
+Throughput benchmark of the encryption of frames
+
+Compares MessageCrypt.encrypt_data()/decrypt_data() with the encrypted transport (crypt.seal() and FrameCrypt)
+for small and large frames and for a frame sent to many clients
+
+Usage: python bench/crypt_bench.py --recipients 50 --output results.json
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from typing import Callable
+
+# Directory of the repository
+REPO_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir))
+sys.path.insert(0, REPO_DIR)
+
+# noinspection PyPep8
+from crypt import MessageCrypt, FrameCrypt, NONCE_SIZE, seal
+
+# Header of frames sent by the server, JSON encrypted
+HEADER = bytes((4,))
+
+
+def sample_frame(size: int) -> dict:
+    """
+    :param size: approximate length of the frame as JSON
+    :return: a history update like those sent by the server
+    """
+    record = {'id': 1, 'text': 'Player 1 sent 100 M CZK to Player 2', 'time': '2026-01-01 12:00:00'}
+    count = max(1, size // len(json.dumps(record)))
+    return {'type': 'historyUpdate', 'message': [dict(record, id=i) for i in range(count)]}
+
+
+def rate(action: Callable[[], None], duration: float) -> float:
+    """
+    :param action: the measured action
+    :param duration: for how many seconds is the action repeated
+    :return: how many times per second was the action done
+    """
+    count = 0
+    start = time.perf_counter()
+    end = start + duration
+    while time.perf_counter() < end:
+        for _ in range(10):
+            action()
+        count += 10
+    return count / (time.perf_counter() - start)
+
+
+def measure(frame: dict, recipients: int, duration: float) -> dict:
+    """
+    :param frame: the measured frame
+    :param recipients: to how many clients is the frame sent
+    :param duration: seconds spent by every measurement
+    :return: frames per second encrypted and decrypted by the server with both encryptions, sizes of encrypted frames
+    """
+    key = os.urandom(16)
+    message_crypt = MessageCrypt(bytearray(key), bytearray(os.urandom(16)))
+    client_nonce = os.urandom(NONCE_SIZE)
+    server = FrameCrypt(key, client_nonce)
+    client = FrameCrypt(key, client_nonce, server.server_nonce)
+    data = json.dumps(frame).encode('utf8')
+
+    encrypted_hex = message_crypt.encrypt_data(frame)
+    received = []
+
+    def decrypt_frame():
+        # frames of the client have to be decrypted in the order in which they were encrypted
+        if not received:
+            received.extend(client.encrypt(data) for _ in range(100))
+        server.decrypt(received.pop(0))
+
+    def fan_out_message_crypt():
+        for _ in range(recipients):
+            message_crypt.encrypt_data(frame)
+
+    def fan_out_frame_crypt():
+        sealed = seal(HEADER, data)
+        for _ in range(recipients):
+            server.wrap(sealed)
+
+    return {
+        'size': len(data),
+        'encrypted_size': {'message_crypt': len(encrypted_hex), 'frame_crypt': len(server.wrap(seal(HEADER, data)))},
+        'encrypt_per_second': {'message_crypt': rate(lambda: message_crypt.encrypt_data(frame), duration),
+                               'frame_crypt': rate(lambda: server.wrap(seal(HEADER, data)), duration)},
+        'decrypt_per_second': {'message_crypt': rate(lambda: message_crypt.decrypt_data(encrypted_hex), duration),
+                               'frame_crypt': rate(decrypt_frame, duration)},
+        'fan_out_per_second': {'message_crypt': rate(fan_out_message_crypt, duration),
+                               'frame_crypt': rate(fan_out_frame_crypt, duration)},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--small', type=int, default=150, help='length of the small frame')
+    parser.add_argument('--large', type=int, default=8192, help='length of the large frame')
+    parser.add_argument('--recipients', type=int, default=50, help='to how many clients is one frame sent')
+    parser.add_argument('--duration', type=float, default=1.0, help='seconds spent by every measurement')
+    parser.add_argument('--output', help='file to save the results into as JSON')
+    args = parser.parse_args()
+
+    results = {
+        'recipients': args.recipients,
+        'small': measure(sample_frame(args.small), args.recipients, args.duration),
+        'large': measure(sample_frame(args.large), args.recipients, args.duration),
+    }
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    print(text)
+
+
+if __name__ == '__main__':
+    main()
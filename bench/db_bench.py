@@ -0,0 +1,165 @@
+"""
+Latency of idle clients while other clients write into the database
+
+Starts the server once for every count of db_threads, connects idle clients which only ping the server
+and measures their round trips, first alone and then while writers send money and add players
+with every transfer written before it is confirmed
+
+Usage: python bench/db_bench.py --threads 0,4 --idle 50 --writers 40 --duration 10 --output results.json
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# noinspection PyPep8
+from soc_bench import BenchSocket, BenchClient, Stats, free_port, git_commit, start_server
+
+# noinspection PyPep8
+import gevent
+# noinspection PyPep8
+from gevent.event import AsyncResult, Event
+
+
+def ping_loop(port: int, interval: float, stats: Stats, stop: Event) -> None:
+    """
+    Pings the server every interval seconds and records the round trips as 'ping'
+    """
+    soc = BenchSocket('127.0.0.1', port)
+    try:
+        gevent.sleep(random.uniform(0, interval))
+        while not stop.is_set():
+            started = time.perf_counter()
+            soc.send(json.dumps({'type': 'ping', 'message': ''}))
+            while json.loads(soc.receive())['type'] != 'pong':
+                pass
+            stats.record('ping', time.perf_counter() - started, False)
+            gevent.sleep(interval)
+    finally:
+        soc.close()
+
+
+def write_loop(port: int, n: int, args: argparse.Namespace, games: Dict[int, AsyncResult], stats: Stats,
+               ready: List[BenchClient], go: Event, stop: Event, failures: List[str]) -> None:
+    """
+    Joins a game and then sends money and adds players until stopped
+    """
+    gevent.sleep(args.ramp * n / max(1, args.writers))
+    group = n // args.players_per_game
+    game = games.setdefault(group, AsyncResult())
+    try:
+        client = BenchClient('127.0.0.1', port, Stats())
+        client.setup(f'writer{n}', f'writers{group}', args.game_type, game, n % args.players_per_game == 0)
+    except Exception as e:
+        failures.append(f'setup of writer {n}: {e!r}')
+        return
+    ready.append(client)
+    go.wait()
+    client.stats = stats
+    added = 0
+    try:
+        while not stop.is_set():
+            if random.random() < args.add_player_ratio:
+                added += 1
+                client.add_player(f'writer{n}-{added}')
+            else:
+                client.send_money()
+    except Exception as e:
+        if not stop.is_set():
+            failures.append(f'traffic of writer {n}: {e!r}')
+    finally:
+        client.soc.close()
+
+
+def measure(threads: int, args: argparse.Namespace) -> dict:
+    """
+    :param threads: db_threads of the server
+    :return: round trips of idle clients without and with writers, throughput of writers
+    """
+    data_dir = tempfile.mkdtemp(prefix='game-money-db-bench-')
+    port = free_port()
+    config = {'db_threads': threads, 'ledger_durability': 'sync',
+              'sqlite_pragmas': {'journal_mode': 'WAL', 'synchronous': 'FULL'}}
+    server = start_server(data_dir, port, dict(config, **json.loads(args.config)))
+    try:
+        quiet, busy, writes = Stats(), Stats(), Stats()
+        games: Dict[int, AsyncResult] = {}
+        ready: List[BenchClient] = []
+        failures: List[str] = []
+        go, stop_quiet, stop = Event(), Event(), Event()
+
+        writers = [gevent.spawn(write_loop, port, n, args, games, writes, ready, go, stop, failures)
+                   for n in range(args.writers)]
+        while len(ready) + len(failures) < args.writers:
+            gevent.sleep(0.05)
+
+        pingers = [gevent.spawn(ping_loop, port, args.interval, quiet, stop_quiet) for _ in range(args.idle)]
+        gevent.sleep(args.duration / 2)
+        stop_quiet.set()
+        gevent.joinall(pingers)
+
+        pingers = [gevent.spawn(ping_loop, port, args.interval, busy, stop) for _ in range(args.idle)]
+        go.set()
+        gevent.sleep(args.duration)
+        stop.set()
+        idle_quiet = quiet.summary().get('ping')
+        idle_busy = busy.summary().get('ping')
+        traffic = writes.summary()
+        gevent.joinall(pingers + writers, timeout=10)
+        return {
+            'db_threads': threads,
+            'idle_without_writers': idle_quiet,
+            'idle_with_writers': idle_busy,
+            'writers': {
+                'throughput_per_second': sum(summary['count'] for summary in traffic.values()) / args.duration,
+                'messages': traffic,
+                'failures': failures[:20]
+            }
+        }
+    finally:
+        server.terminate()
+        try:
+            server.wait(10)
+        except subprocess.TimeoutExpired:
+            server.kill()
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--threads', default='0,4', help='comma separated counts of db_threads to compare')
+    parser.add_argument('--idle', type=int, default=50, help='number of idle clients pinging the server')
+    parser.add_argument('--interval', type=float, default=0.1, help='seconds between pings of one idle client')
+    parser.add_argument('--writers', type=int, default=40, help='number of clients writing into the database')
+    parser.add_argument('--players-per-game', type=int, default=10, help='writers inside one game')
+    parser.add_argument('--add-player-ratio', type=float, default=0.05, help='part of messages adding a player')
+    parser.add_argument('--game-type', type=int, default=1, help='id of the game type of created games')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds of measuring with writers')
+    parser.add_argument('--ramp', type=float, default=2.0, help='seconds over which are the writers connected')
+    parser.add_argument('--config', default='{}', help='JSON merged into the config of the server')
+    parser.add_argument('--output', help='file to save the results into as JSON')
+    args = parser.parse_args()
+
+    results = {
+        'commit': git_commit(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'arguments': vars(args),
+        'runs': [measure(int(threads), args) for threads in args.threads.split(',')]
+    }
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    print(text)
+
+
+if __name__ == '__main__':
+    main()
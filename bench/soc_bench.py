@@ -0,0 +1,525 @@
+"""
+Load benchmark of the /soc protocol
+
+Starts app.main() in a child process against a temporary data directory,
+connects simulated clients which register, log in, list games, create or enter games,
+open them and then send money and add players for the given duration
+
+Usage: python bench/soc_bench.py --clients 1000 --duration 30 --output results.json
+"""
+import argparse
+import base64
+import json
+import os
+import random
+import re
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+from gevent import monkey
+
+monkey.patch_all()
+
+# noinspection PyPep8
+import gevent
+# noinspection PyPep8
+from gevent import socket
+# noinspection PyPep8
+from gevent.event import AsyncResult, Event
+# noinspection PyPep8
+from typing import Callable, Dict, List, Optional
+# noinspection PyPep8
+from urllib.request import urlopen
+
+# Directory of the repository
+REPO_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir))
+
+
+class BenchSocket:
+    """
+    Minimal WebSocket client sending and receiving text frames
+    """
+
+    def __init__(self, host: str, port: int, resource: str = '/soc'):
+        self.sock = socket.create_connection((host, port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        key = base64.b64encode(os.urandom(16)).decode()
+        self.sock.sendall(f'GET {resource} HTTP/1.1\r\n'
+                          f'Host: {host}:{port}\r\n'
+                          f'Upgrade: websocket\r\n'
+                          f'Connection: Upgrade\r\n'
+                          f'Sec-WebSocket-Key: {key}\r\n'
+                          f'Sec-WebSocket-Version: 13\r\n\r\n'.encode())
+        self.file = self.sock.makefile('rb')
+        status = self.file.readline()
+        if b' 101 ' not in status:
+            raise ConnectionError(f'handshake failed: {status!r}')
+        while self.file.readline() not in (b'\r\n', b''):
+            pass
+
+    def __read(self, n: int) -> bytes:
+        data = self.file.read(n)
+        if len(data) != n:
+            raise ConnectionError('connection closed')
+        return data
+
+    def __send_frame(self, opcode: int, payload: bytes) -> None:
+        header = bytearray([0x80 | opcode])
+        n = len(payload)
+        if n < 126:
+            header.append(0x80 | n)
+        elif n < 65536:
+            header.append(0x80 | 126)
+            header += struct.pack('!H', n)
+        else:
+            header.append(0x80 | 127)
+            header += struct.pack('!Q', n)
+        mask = os.urandom(4)
+        header += mask
+        # clients must mask their frames, xor of the whole payload at once is much faster than byte by byte
+        masked = (int.from_bytes(payload, 'big') ^ int.from_bytes((mask * (n // 4 + 1))[:n], 'big')).to_bytes(n, 'big')
+        self.sock.sendall(bytes(header) + masked)
+
+    def send(self, text: str) -> None:
+        self.__send_frame(0x1, text.encode('utf8'))
+
+    def receive(self) -> str:
+        message = b''
+        while True:
+            b1, b2 = self.__read(2)
+            opcode = b1 & 0x0f
+            n = b2 & 0x7f
+            if n == 126:
+                n = struct.unpack('!H', self.__read(2))[0]
+            elif n == 127:
+                n = struct.unpack('!Q', self.__read(8))[0]
+            mask = self.__read(4) if b2 & 0x80 else None
+            data = self.__read(n)
+            if mask is not None:
+                data = bytes(b ^ mask[i % 4] for i, b in enumerate(data))
+            if opcode == 0x8:
+                raise ConnectionError('connection closed by the server')
+            if opcode == 0x9:
+                self.__send_frame(0xA, data)
+                continue
+            if opcode == 0xA:
+                continue
+            message += data
+            if b1 & 0x80:
+                return message.decode('utf8')
+
+    def close(self) -> None:
+        self.sock.close()
+
+
+class Stats:
+    """
+    Latencies and errors of requests of every message type
+    """
+
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = {}
+        self.errors: Dict[str, int] = {}
+        self.events = 0
+
+    def record(self, message_type: str, seconds: float, error: bool) -> None:
+        self.latencies.setdefault(message_type, []).append(seconds)
+        if error:
+            self.errors[message_type] = self.errors.get(message_type, 0) + 1
+
+    def summary(self) -> Dict[str, dict]:
+        r = {}
+        for message_type, latencies in sorted(self.latencies.items()):
+            latencies = sorted(latencies)
+            r[message_type] = {
+                'count': len(latencies),
+                'errors': self.errors.get(message_type, 0),
+                'mean_ms': sum(latencies) / len(latencies) * 1000,
+                'p50_ms': percentile(latencies, 50) * 1000,
+                'p95_ms': percentile(latencies, 95) * 1000,
+                'p99_ms': percentile(latencies, 99) * 1000,
+                'max_ms': latencies[-1] * 1000
+            }
+        return r
+
+
+def percentile(values: List[float], p: float) -> float:
+    """
+    :param values: sorted values
+    :param p: percentile from 0 to 100
+    :return: the nearest-rank percentile of the values
+    """
+    return values[max(0, min(len(values) - 1, int(round(p / 100 * len(values))) - 1))]
+
+
+class BenchClient:
+    """
+    One simulated user, sends a message only after the previous one was answered
+    """
+
+    def __init__(self, host: str, port: int, stats: Stats):
+        self.soc = BenchSocket(host, port)
+        self.stats = stats
+        self.game_id: Optional[int] = None
+        self.players: List[int] = []
+        self.all_players: List[int] = []
+        # player of this user -> his balance in the currency, as the events tell
+        self.balances: Dict[int, float] = {}
+        self.currency: Optional[str] = None
+
+    def on_event(self, event: dict) -> None:
+        if event['type'] == 'playersSnapshot':
+            self.all_players = [int(player_id) for player_id in event['message']['playersAll']]
+        elif event['type'] == 'playerAdded' and event['message']['id'] not in self.all_players:
+            self.all_players.append(event['message']['id'])
+        elif event['type'] == 'moneyTransfer':
+            for transfer in event['message'] if isinstance(event['message'], list) else [event['message']]:
+                for player_id, amount in ((transfer['sender'], transfer['senderAmount']),
+                                          (transfer['recipient'], transfer['recipientAmount'])):
+                    if player_id in self.balances:
+                        self.balances[player_id] = amount
+
+    def request(self, message_type: str, message: any, reply: Callable[[dict], Optional[bool]]) -> dict:
+        """
+        Sends a message and waits for its reply, other events received meanwhile are processed
+        :param message_type: type of the message
+        :param message: content of the message
+        :param reply: returns True for the reply, False for an error reply and None for other events
+        :return: the reply
+        """
+        started = time.perf_counter()
+        self.soc.send(json.dumps({'type': message_type, 'message': message}))
+        while True:
+            event = json.loads(self.soc.receive())
+            self.stats.events += 1
+            self.on_event(event)
+            r = reply(event)
+            if r is not None:
+                self.stats.record(message_type, time.perf_counter() - started, not r)
+                return event
+
+    def setup(self, name: str, game_name: str, game_type: int, game: AsyncResult, creator: bool) -> None:
+        key = self.request('register', name, lambda e: e['type'] == 'register' or None)['message']
+        self.request('login', key, lambda e: e['type'] == 'login' or None)
+        self.request('listGames', {'page': 0}, lambda e: e['type'] == 'listGames' or None)
+        if creator:
+            r = self.request('createGame', {'name': game_name, 'type': game_type, 'password': ''},
+                             lambda e: {'gameEnter': True, 'openNewGameERR': False}.get(e['type']))
+            if r['type'] != 'gameEnter':
+                game.set_exception(RuntimeError(r['message']))
+                raise RuntimeError(r['message'])
+            game.set(int(r['message'].rstrip('/').split('/')[-1]))
+        self.game_id = game.get()
+        if not creator:
+            self.request('enterGame', {'id': self.game_id},
+                         lambda e: {'gameEnter': True, 'gameEnterERR': False}.get(e['type']))
+        players = []
+
+        def game_info(e: dict) -> Optional[bool]:
+            if e['type'] == 'playersSnapshot':
+                players.extend(e['message']['players'])
+            return {'gameInfo': True, 'returnHomepage': False}.get(e['type'])
+
+        self.request('gameInfo', f'/game/{self.game_id}', game_info)
+        self.players = [p['id'] for p in players if not p['infinite']]
+        self.currency = players[0]['money'][0]['currency']
+        self.balances = {p['id']: p['money'][0]['amount'] for p in players if not p['infinite']}
+
+    def has_money(self) -> bool:
+        """
+        :return: True if any player of this user has money to send, as far as the events tell
+        """
+        return any(self.balances.get(p, 0) >= 1 for p in self.players)
+
+    def send_money(self) -> None:
+        # users do not send money they do not have, refusals then come only from the server
+        senders = [p for p in self.players if self.balances.get(p, 0) >= 1]
+        sender = random.choice(senders or self.players)
+        recipients = [p for p in self.all_players if p != sender]
+        if not recipients:
+            return
+
+        def reply(e: dict) -> Optional[bool]:
+            if e['type'] == 'sendMoneyERR':
+                return False
+            if e['type'] == 'moneyTransfer':
+                transfers = e['message'] if isinstance(e['message'], list) else [e['message']]
+                if any(t['sender'] == sender for t in transfers):
+                    return True
+            return None
+
+        self.request('sendMoney', {'game': self.game_id, 'player': sender, 'recipient': random.choice(recipients),
+                                   'amount': 1, 'currency': self.currency}, reply)
+
+    def add_player(self, name: str) -> None:
+        def reply(e: dict) -> Optional[bool]:
+            if e['type'] == 'playerAdded':
+                return e['message'].get('name') == name or None
+            return {'addPlayerERR': False, 'addPlayer': False}.get(e['type'])
+
+        r = self.request('addPlayer', {'game': self.game_id, 'name': name}, reply)
+        if r['type'] == 'playerAdded':
+            self.players.append(r['message']['id'])
+            self.balances[r['message']['id']] = next(
+                (m['amount'] for m in r['message'].get('money', ()) if m['currency'] == self.currency), 0)
+
+
+def rss_of(pid: int) -> Dict[str, int]:
+    """
+    :param pid: id of a process
+    :return: {rss_bytes, peak_rss_bytes} of the process and all its children
+    """
+    r = {'rss_bytes': 0, 'peak_rss_bytes': 0}
+    pids = [pid]
+    while pids:
+        current = pids.pop()
+        try:
+            with open(f'/proc/{current}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        r['rss_bytes'] += int(line.split()[1]) * 1024
+                    elif line.startswith('VmHWM:'):
+                        r['peak_rss_bytes'] += int(line.split()[1]) * 1024
+            with open(f'/proc/{current}/task/{current}/children') as f:
+                pids.extend(int(child) for child in f.read().split())
+        except OSError:
+            pass
+    return r
+
+
+def queries_per_message(port: int) -> Dict[str, float]:
+    """
+    Reads metrics of the server, with more workers only of the one answering the request
+    :param port: port of the server
+    :return: {message type: mean count of database queries made while handling one message}
+    """
+    with urlopen(f'http://127.0.0.1:{port}/metrics', timeout=10) as response:
+        metrics = response.read().decode()
+    sums = dict(re.findall(r'^gamemoney_message_queries_sum\{type="([^"]+)"} (\S+)$', metrics, re.M))
+    counts = dict(re.findall(r'^gamemoney_message_queries_count\{type="([^"]+)"} (\S+)$', metrics, re.M))
+    return {message_type: float(sums[message_type]) / float(count)
+            for message_type, count in counts.items() if float(count)}
+
+
+def over_budget(queries: Dict[str, float], budget: Dict[str, float]) -> List[str]:
+    """
+    :param queries: {message type: mean count of queries per message}
+    :param budget: {message type: highest allowed mean count of queries per message}
+    :return: descriptions of message types exceeding the budget
+    """
+    return [f'{message_type}: {queries[message_type]:.2f} queries per message, budget {limit}'
+            for message_type, limit in budget.items()
+            if message_type in queries and queries[message_type] > limit]
+
+
+def over_error_rate(messages: Dict[str, dict], limit: float) -> List[str]:
+    """
+    :param messages: {message type: summary of its requests by Stats.summary()}
+    :param limit: highest allowed part of error replies
+    :return: descriptions of message types exceeding the limit
+    """
+    return [f'{message_type}: {summary["errors"]} errors of {summary["count"]} requests, limit {limit}'
+            for message_type, summary in messages.items()
+            if summary['count'] and summary['errors'] / summary['count'] > limit]
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(data_dir: str, port: int, config: dict) -> subprocess.Popen:
+    """
+    Starts app.main() in a child process with its data in data_dir
+    :return: the server process, running and accepting connections
+    """
+    os.makedirs(os.path.join(data_dir, 'data'))
+    shutil.copy(os.path.join(REPO_DIR, 'data', 'game-types.json'), os.path.join(data_dir, 'data'))
+    with open(os.path.join(data_dir, 'data', 'config.json'), 'w') as f:
+        json.dump(dict(config, host='127.0.0.1', port=port), f)
+    log = open(os.path.join(data_dir, 'server.log'), 'w')
+    server = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve', data_dir],
+                              stdout=log, stderr=subprocess.STDOUT)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f'server exited, see {log.name}')
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return server
+        except OSError:
+            gevent.sleep(0.1)
+    server.kill()
+    raise RuntimeError('server did not start')
+
+
+def serve(data_dir: str) -> None:
+    """
+    Runs app.main() as if app.py was located in data_dir, so it uses the database in data_dir/data
+    :return: None
+    """
+    sys.argv = [os.path.join(data_dir, 'app.py')]
+    sys.path.insert(0, REPO_DIR)
+    import app
+    app.main()
+
+
+def run(args: argparse.Namespace) -> dict:
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+    data_dir = tempfile.mkdtemp(prefix='game-money-bench-')
+    port = free_port()
+    server = start_server(data_dir, port, json.loads(args.config))
+    try:
+        setup_stats = Stats()
+        traffic_stats = Stats()
+        games: Dict[int, AsyncResult] = {}
+        clients: List[BenchClient] = []
+        failures: List[str] = []
+        go = Event()
+        stop = Event()
+
+        def simulate(n: int) -> None:
+            gevent.sleep(args.ramp * n / args.clients)
+            group = n // args.players_per_game
+            game = games.setdefault(group, AsyncResult())
+            try:
+                client = BenchClient('127.0.0.1', port, setup_stats)
+                client.setup(f'bench{n}', f'bench{group}', args.game_type, game, n % args.players_per_game == 0)
+            except Exception as e:
+                failures.append(f'setup of client {n}: {e!r}')
+                return
+            clients.append(client)
+            go.wait()
+            client.stats = traffic_stats
+            added = 0
+            try:
+                while not stop.is_set():
+                    # users without money add a player, who gets the starting money
+                    if random.random() < args.add_player_ratio or not client.has_money():
+                        added += 1
+                        client.add_player(f'bench{n}-{added}')
+                    else:
+                        client.send_money()
+                    if args.think:
+                        gevent.sleep(random.uniform(0, 2 * args.think))
+            except Exception as e:
+                if not stop.is_set():
+                    failures.append(f'traffic of client {n}: {e!r}')
+
+        started = time.perf_counter()
+        greenlets = [gevent.spawn(simulate, n) for n in range(args.clients)]
+        while len(clients) + len(failures) < args.clients:
+            gevent.sleep(0.05)
+        setup_seconds = time.perf_counter() - started
+        rss_idle = rss_of(server.pid)
+
+        go.set()
+        gevent.sleep(args.duration)
+        stop.set()
+        # requests answered after the end are not counted
+        traffic = traffic_stats.summary()
+        events = traffic_stats.events
+        requests = sum(summary['count'] for summary in traffic.values())
+        rss = rss_of(server.pid)
+        for client in clients:
+            client.soc.close()
+        gevent.joinall(greenlets, timeout=5)
+        queries = queries_per_message(port)
+
+        return {
+            'commit': git_commit(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'arguments': vars(args),
+            'clients': {'connected': len(clients), 'failed': len(failures), 'failures': failures[:20]},
+            'setup': {'seconds': setup_seconds, 'messages': setup_stats.summary()},
+            'traffic': {
+                'seconds': args.duration,
+                'requests': requests,
+                'throughput_per_second': requests / args.duration,
+                'events_received': events,
+                'messages': traffic
+            },
+            'server': {'after_setup': rss_idle, 'after_traffic': rss},
+            'queries_per_message': queries
+        }
+    finally:
+        server.terminate()
+        try:
+            server.wait(10)
+        except subprocess.TimeoutExpired:
+            server.kill()
+        if args.keep_data:
+            print(f'server data kept in {data_dir}', file=sys.stderr)
+        else:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=100, help='number of simulated users')
+    parser.add_argument('--players-per-game', type=int, default=10, help='users inside one game')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds of sending money and adding players')
+    parser.add_argument('--ramp', type=float, default=5.0, help='seconds over which are the clients connected')
+    parser.add_argument('--think', type=float, default=0.0, help='mean pause of a client between messages')
+    parser.add_argument('--add-player-ratio', type=float, default=0.02, help='part of messages adding a player')
+    parser.add_argument('--game-type', type=int, default=1, help='id of the game type of created games')
+    parser.add_argument('--config', default='{}', help='JSON merged into the config of the server')
+    parser.add_argument('--output', help='file to save the results into as JSON')
+    parser.add_argument('--query-budget', help='JSON file {message type: highest mean count of database queries '
+                                               'per message}, exits with 1 if any type exceeds it')
+    parser.add_argument('--max-error-rate', type=float,
+                        help='highest allowed part of error replies to any message type, exits with 1 if exceeded')
+    parser.add_argument('--keep-data', action='store_true', help='do not delete the database and the server log')
+    parser.add_argument('--serve', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve)
+        return
+
+    results = run(args)
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    print(text)
+
+    if args.query_budget:
+        with open(args.query_budget) as f:
+            exceeded = over_budget(results['queries_per_message'], json.load(f))
+        for line in exceeded:
+            print(f'over the query budget - {line}', file=sys.stderr)
+        if exceeded:
+            sys.exit(1)
+
+    if args.max_error_rate is not None:
+        exceeded = over_error_rate(results['traffic']['messages'], args.max_error_rate)
+        if results['clients']['failed']:
+            exceeded.append(f'{results["clients"]["failed"]} clients failed')
+        for line in exceeded:
+            print(f'over the error rate - {line}', file=sys.stderr)
+        if exceeded:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+import json
+import logging
+import os
+from typing import Callable, Optional, Set
+
+import gevent
+from gevent import socket
+from gevent.queue import Queue
+from gevent.server import StreamServer
+
+logger = logging.getLogger(__name__)
+
+# Channel of events for all users in the lobby
+LOBBY = 'lobby'
+
+
+def user_channel(user_id: int, game_id: Optional[int] = None) -> str:
+    """
+    :param user_id: id of an user
+    :param game_id: id of a game or None
+    :return: channel of events for all connections of the user, or only for those inside the game
+    """
+    if game_id is None:
+        return f'user:{user_id}'
+    return f'{game_channel(game_id)}:user:{user_id}'
+
+
+def game_channel(game_id: int) -> str:
+    """
+    :param game_id: id of a game
+    :return: channel of events for all users inside the game
+    """
+    return f'game:{game_id}'
+
+
+class EventBus:
+    """
+    Publishes events on channels
+    Events are delivered to the handler of every process serving the clients
+    """
+
+    def __init__(self, deliver: Callable[[str, str], None]):
+        """
+        :param deliver: called with (channel, payload) for every event that should be delivered in this process
+        """
+        self.deliver = deliver
+
+    def publish(self, channel: str, payload: str, local: bool = True) -> None:
+        """
+        Publishes an event
+        :param channel: channel of the event
+        :param payload: content of the event
+        :param local: False if the event is meant only for other processes
+        :return: None
+        """
+        raise NotImplementedError()
+
+    def start(self) -> None:
+        pass
+
+    def stop(self) -> None:
+        pass
+
+
+class LocalBus(EventBus):
+    """
+    Bus for a server running in one process
+    """
+
+    def publish(self, channel: str, payload: str, local: bool = True) -> None:
+        if local:
+            self.deliver(channel, payload)
+
+
+class SocketBus(EventBus):
+    """
+    Bus for a server running in more processes on one machine
+    Events are delivered in this process immediately and relayed to other processes by BusBroker
+    """
+
+    def __init__(self, deliver: Callable[[str, str], None], socket_path: str, reconnect_delay: float = 1.0):
+        """
+        :param deliver: called with (channel, payload) for every event that should be delivered in this process
+        :param socket_path: unix socket the BusBroker listens on
+        :param reconnect_delay: seconds to wait before connecting again after the broker was lost
+        """
+        super().__init__(deliver)
+        self.socket_path = socket_path
+        self.reconnect_delay = reconnect_delay
+        self.__outgoing: Queue = Queue()
+        self.__runner: Optional[gevent.Greenlet] = None
+
+    def publish(self, channel: str, payload: str, local: bool = True) -> None:
+        if local:
+            self.deliver(channel, payload)
+        self.__outgoing.put(json.dumps([channel, payload]).encode('utf8') + b'\n')
+
+    def __run(self) -> None:
+        while True:
+            try:
+                soc = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                soc.connect(self.socket_path)
+            except OSError:
+                gevent.sleep(self.reconnect_delay)
+                continue
+            writer = gevent.spawn(self.__write, soc)
+            try:
+                for line in soc.makefile('rb'):
+                    channel, payload = json.loads(line)
+                    try:
+                        self.deliver(channel, payload)
+                    except Exception:
+                        logger.exception('bus delivery failed')
+            except OSError:
+                pass
+            finally:
+                writer.kill()
+                soc.close()
+            logger.warning('bus broker lost, reconnecting')
+            gevent.sleep(self.reconnect_delay)
+
+    def __write(self, soc: socket.socket) -> None:
+        for line in self.__outgoing:
+            soc.sendall(line)
+
+    def start(self) -> None:
+        if self.__runner is None:
+            self.__runner = gevent.spawn(self.__run)
+
+    def stop(self) -> None:
+        if self.__runner is not None:
+            self.__runner.kill()
+            self.__runner = None
+
+
+class BusBroker:
+    """
+    Relays events published by every connected SocketBus to all other connected SocketBuses
+    """
+
+    def __init__(self, socket_path: str):
+        """
+        :param socket_path: unix socket to listen on
+        """
+        self.socket_path = socket_path
+        self.__workers: Set[socket.socket] = set()
+        self.__server: Optional[StreamServer] = None
+
+    def __handle(self, soc: socket.socket, _) -> None:
+        self.__workers.add(soc)
+        try:
+            for line in soc.makefile('rb'):
+                for worker in list(self.__workers):
+                    if worker is soc:
+                        continue
+                    try:
+                        worker.sendall(line)
+                    except OSError:
+                        self.__workers.discard(worker)
+        finally:
+            self.__workers.discard(soc)
+
+    def start(self) -> None:
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self.socket_path)
+        listener.listen()
+        self.__server = StreamServer(listener, self.__handle)
+        self.__server.start()
+
+    def stop(self) -> None:
+        if self.__server is not None:
+            self.__server.stop()
+            self.__server = None
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
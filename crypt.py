@@ -1,6 +1,12 @@
+import hashlib
+import hmac
 import json
+from typing import NamedTuple, Optional, Tuple
+
 # noinspection PyPackageRequirements
 from Crypto.Cipher import AES
+# noinspection PyPackageRequirements
+from Crypto.Random import get_random_bytes
 
 
 class MessageCrypt:
@@ -24,3 +30,173 @@ class MessageCrypt:
             data = bytearray(([0] * mod) + list(data))
         cipher = AES.new(self.key, AES.MODE_CBC, self.iv)
         return cipher.encrypt(data).hex()
+
+
+# Sizes (in bytes) used by FrameCrypt
+NONCE_SIZE = 16
+KEY_SIZE = 16
+TAG_SIZE = 16
+# longer data are encrypted by a new cipher, shorter by the cipher of the connection
+SHORT_DATA_SIZE = 512
+
+
+def ctr(key: bytes, nonce: bytes, data: bytes) -> bytes:
+    """
+    Encrypts or decrypts data by AES in the CTR mode, the counter blocks are the nonce followed by 4 bytes of their index
+    :param key: the key
+    :param nonce: 12 bytes, never used again with the key
+    :param data: the data
+    :return: the encrypted or decrypted data
+    """
+    return AES.new(key, AES.MODE_CTR, nonce=nonce, initial_value=0).encrypt(data)
+
+
+def mac(key: bytes, *parts: bytes) -> bytes:
+    """
+    :param key: the key
+    :param parts: the authenticated data
+    :return: TAG_SIZE bytes of HMAC-SHA256 of the parts
+    """
+    return hmac.digest(key, b''.join(parts), hashlib.sha256)[:TAG_SIZE]
+
+
+class SealedFrame(NamedTuple):
+    """
+    A frame encrypted once by a random data key, FrameCrypt.wrap() makes it readable by one connection
+    """
+    header: bytes
+    # the key encrypting the data followed by the key of its tag
+    data_key: bytes
+    # the encrypted frame followed by its tag
+    data: bytes
+
+
+def seal(header: bytes, data: bytes) -> SealedFrame:
+    """
+    Encrypts a frame which may be sent to many connections, each of them then encrypts only the data key
+    The data key encrypts only this frame, so its nonce does not have to change
+    :param header: sent unencrypted before the frame, authenticated with it
+    :param data: the frame
+    :return: the sealed frame
+    """
+    data_key = get_random_bytes(2 * KEY_SIZE)
+    ciphertext = ctr(data_key[:KEY_SIZE], bytes(12), data)
+    return SealedFrame(header, data_key, ciphertext + mac(data_key[KEY_SIZE:], header, ciphertext))
+
+
+class FrameCrypt:
+    """
+    Authenticated encryption of frames of one /soc connection, AES in the CTR mode followed by HMAC-SHA256
+
+    The keys of the connection are derived from the key shared by the server with its clients and from
+    nonces chosen by both sides, so frames recorded from another connection cannot be replayed into it
+    Frames are numbered in each direction and the numbers are used as their nonces,
+    so nonces are not sent and never repeat for one key
+
+    Frames of the server: header, data key encrypted by the key of the connection, its tag, frame sealed by the data key
+    Frames of the client: frame encrypted by the key of the connection, its tag
+    """
+    SERVER = 0
+    CLIENT = 1
+
+    def __init__(self, key: bytes, client_nonce: bytes, server_nonce: Optional[bytes] = None):
+        """
+        :param key: the shared key, 16, 24 or 32 bytes long
+        :param client_nonce: NONCE_SIZE random bytes chosen by the client
+        :param server_nonce: NONCE_SIZE bytes chosen by the server, random ones if None
+        :raises ValueError: if the key or a nonce has a wrong size
+        """
+        if server_nonce is None:
+            server_nonce = get_random_bytes(NONCE_SIZE)
+        if len(key) not in AES.key_size or len(client_nonce) != NONCE_SIZE or len(server_nonce) != NONCE_SIZE:
+            raise ValueError('Invalid key or nonce size')
+        self.server_nonce = server_nonce
+        keys = hmac.digest(key, client_nonce + server_nonce, hashlib.sha256)
+        self.__key = keys[:KEY_SIZE]
+        self.__mac_key = keys[KEY_SIZE:]
+        # data keys and frames of the client are short, creating a cipher for each of them takes longer than encrypting them
+        self.__block_cipher = AES.new(self.__key, AES.MODE_ECB)
+        self.__counters = [0, 0]
+
+    def __nonce(self, direction: int) -> bytes:
+        """
+        :param direction: SERVER or CLIENT, the side which sent the frame
+        :return: nonce of the next frame sent in the direction
+        """
+        nonce = bytes((direction,)) + self.__counters[direction].to_bytes(11, 'big')
+        self.__counters[direction] += 1
+        return nonce
+
+    def __ctr(self, nonce: bytes, data: bytes) -> bytes:
+        """
+        Same as ctr() with the key of the connection
+        :param nonce: nonce of the frame
+        :param data: the data
+        :return: the encrypted or decrypted data
+        """
+        if len(data) > SHORT_DATA_SIZE:
+            return ctr(self.__key, nonce, data)
+        if not data:
+            return data
+        blocks = b''.join(nonce + i.to_bytes(4, 'big') for i in range((len(data) + 15) // 16))
+        stream = self.__block_cipher.encrypt(blocks)[:len(data)]
+        return (int.from_bytes(data, 'big') ^ int.from_bytes(stream, 'big')).to_bytes(len(data), 'big')
+
+    def wrap(self, frame: SealedFrame) -> bytes:
+        """
+        Used by the server, frames have to be sent in the order in which they were wrapped
+        :param frame: the sealed frame
+        :return: the next frame sent to the client
+        """
+        nonce = self.__nonce(self.SERVER)
+        data_key = self.__ctr(nonce, frame.data_key)
+        # the tag of the data binds it to the data key
+        tag = mac(self.__mac_key, nonce, frame.header, data_key, frame.data[-TAG_SIZE:])
+        return frame.header + data_key + tag + frame.data
+
+    def unwrap(self, data: bytes, header_size: int = 1) -> Tuple[bytes, bytes]:
+        """
+        Used by the client
+        :param data: the next frame received from the server
+        :param header_size: length of the header
+        :return: (header, the frame)
+        :raises ValueError: if the frame was not sent by the server of this connection or was changed
+        """
+        header = data[:header_size]
+        key_end = header_size + 2 * KEY_SIZE
+        if len(data) < key_end + 2 * TAG_SIZE:
+            raise ValueError('Frame too short')
+        nonce = self.__nonce(self.SERVER)
+        data_key = data[header_size:key_end]
+        ciphertext, tag = data[key_end + TAG_SIZE:-TAG_SIZE], data[-TAG_SIZE:]
+        if not hmac.compare_digest(mac(self.__mac_key, nonce, header, data_key, tag), data[key_end:key_end + TAG_SIZE]):
+            raise ValueError('Invalid tag')
+        data_key = self.__ctr(nonce, data_key)
+        if not hmac.compare_digest(mac(data_key[KEY_SIZE:], header, ciphertext), tag):
+            raise ValueError('Invalid tag')
+        return header, ctr(data_key[:KEY_SIZE], bytes(12), ciphertext)
+
+    def encrypt(self, data: bytes) -> bytes:
+        """
+        Used by the client
+        :param data: the frame
+        :return: the next frame sent to the server
+        """
+        nonce = self.__nonce(self.CLIENT)
+        ciphertext = self.__ctr(nonce, data)
+        return ciphertext + mac(self.__mac_key, nonce, ciphertext)
+
+    def decrypt(self, data: bytes) -> bytes:
+        """
+        Used by the server
+        :param data: the next frame received from the client
+        :return: the frame
+        :raises ValueError: if the frame was not sent by the client of this connection or was changed
+        """
+        if len(data) < TAG_SIZE:
+            raise ValueError('Frame too short')
+        nonce = self.__nonce(self.CLIENT)
+        ciphertext = data[:-TAG_SIZE]
+        if not hmac.compare_digest(mac(self.__mac_key, nonce, ciphertext), data[-TAG_SIZE:]):
+            raise ValueError('Invalid tag')
+        return self.__ctr(nonce, ciphertext)
@@ -0,0 +1,182 @@
+import sqlite3
+import time
+from typing import Callable, Optional, Tuple, Type
+
+from gevent.lock import Semaphore
+from gevent.threadpool import ThreadPool
+
+from metrics import Gauge, Histogram
+
+# Statements before which sqlite3 begins a transaction, see the isolation_level of sqlite3.Connection
+WRITE_STATEMENTS = ('INSERT', 'UPDATE', 'DELETE', 'REPLACE')
+
+# How long (in seconds) can a transaction wait for the one writing before it, same as the timeout of sqlite3.connect()
+WRITE_TIMEOUT = 5.0
+
+
+class DatabaseThreads:
+    """
+    Runs blocking calls of the SQLite driver in a pool of threads, so the gevent hub keeps serving other connections
+    while the database works
+
+    Writes and commits are run by the threads, as they wait for fsync, checkpoints and locks of other processes.
+    Reads are run by the threads only if they can wait for writers, i.e. outside the WAL journal mode,
+    otherwise they are answered from the page cache faster than a thread would take them
+
+    Greenlets wait for their turn to write in a transaction before they take a thread,
+    so threads are never blocked by SQLite's own lock held by a transaction waiting for a thread
+    """
+
+    def __init__(self, depth: Optional[Gauge] = None, wait_seconds: Optional[Histogram] = None,
+                 write_wait_seconds: Optional[Histogram] = None):
+        """
+        :param depth: calls waiting for a thread or running in it
+        :param wait_seconds: time calls spent waiting for a thread
+        :param write_wait_seconds: time transactions spent waiting for the transaction writing before them
+        """
+        self.depth = depth
+        self.wait_seconds = wait_seconds
+        self.write_wait_seconds = write_wait_seconds
+        self.pool: Optional[ThreadPool] = None
+        self.write_lock = Semaphore()
+        # True to run reads by the threads too
+        self.reads = False
+
+    def start(self, size: int) -> None:
+        """
+        Starts the threads in this process, calls made before are run directly
+        :param size: count of threads, 0 to run calls directly in the calling greenlet
+        :return: None
+        """
+        if size > 0 and self.pool is None:
+            self.pool = ThreadPool(size)
+
+    def stop(self) -> None:
+        """
+        Stops the threads, following calls are run directly
+        :return: None
+        """
+        pool, self.pool = self.pool, None
+        if pool is not None:
+            pool.kill()
+
+    def run(self, function: Callable, *args) -> any:
+        """
+        Calls the function in one of the threads and waits for its result without blocking other greenlets
+        :param function: blocking function
+        :param args: arguments of the function
+        :return: result of the function
+        """
+        pool = self.pool
+        if pool is None:
+            return function(*args)
+        if self.depth is not None:
+            self.depth.inc()
+        try:
+            submitted = time.perf_counter()
+            started, r = pool.apply(self.__timed, (function, args))
+        finally:
+            if self.depth is not None:
+                self.depth.dec()
+        if self.wait_seconds is not None:
+            self.wait_seconds.observe(started - submitted)
+        return r
+
+    @staticmethod
+    def __timed(function: Callable, args: tuple) -> Tuple[float, any]:
+        return time.perf_counter(), function(*args)
+
+    def begin_write(self) -> None:
+        """
+        Waits until no other transaction is writing
+        :return: None
+        :raises sqlite3.OperationalError: if the other transaction writes for longer than WRITE_TIMEOUT
+        """
+        waiting = time.perf_counter()
+        if not self.write_lock.acquire(timeout=WRITE_TIMEOUT):
+            raise sqlite3.OperationalError('database is locked')
+        if self.write_wait_seconds is not None:
+            self.write_wait_seconds.observe(time.perf_counter() - waiting)
+
+    def end_write(self) -> None:
+        """
+        Lets the next transaction write
+        :return: None
+        """
+        self.write_lock.release()
+
+    def connection_class(self) -> Type[sqlite3.Connection]:
+        """
+        :return: factory of sqlite3 connections running their statements and commits by this pool,
+                 the connections have to be opened with check_same_thread=False
+        """
+        threads = self
+
+        class ThreadedCursor(sqlite3.Cursor):
+            def execute(self, sql: str, parameters=()):
+                return self.connection.run_statement(super().execute, sql, parameters)
+
+            def executemany(self, sql: str, seq_of_parameters):
+                return self.connection.run_statement(super().executemany, sql, seq_of_parameters)
+
+            def fetchone(self):
+                return threads.run(super().fetchone) if threads.reads else super().fetchone()
+
+            def fetchmany(self, size: int = None):
+                size = self.arraysize if size is None else size
+                return threads.run(super().fetchmany, size) if threads.reads else super().fetchmany(size)
+
+            def fetchall(self):
+                return threads.run(super().fetchall) if threads.reads else super().fetchall()
+
+        class ThreadedConnection(sqlite3.Connection):
+            writing = False
+
+            def cursor(self, factory: Type[sqlite3.Cursor] = ThreadedCursor):
+                return super().cursor(factory)
+
+            def execute(self, sql: str, parameters=()):
+                return self.cursor().execute(sql, parameters)
+
+            def executemany(self, sql: str, seq_of_parameters):
+                return self.cursor().executemany(sql, seq_of_parameters)
+
+            def run_statement(self, function: Callable, sql: str, parameters) -> any:
+                writes = sql.lstrip()[:7].upper().startswith(WRITE_STATEMENTS)
+                if writes and not self.writing and not self.in_transaction:
+                    threads.begin_write()
+                    self.writing = True
+                try:
+                    if writes or threads.reads:
+                        return threads.run(function, sql, parameters)
+                    return function(sql, parameters)
+                finally:
+                    self.transaction_ended()
+
+            def transaction_ended(self) -> None:
+                # also after a failed statement, it may have ended the transaction
+                if self.writing and not self.in_transaction:
+                    self.writing = False
+                    threads.end_write()
+
+            def commit(self):
+                try:
+                    return threads.run(super().commit)
+                finally:
+                    self.transaction_ended()
+
+            def rollback(self):
+                try:
+                    return threads.run(super().rollback)
+                finally:
+                    self.transaction_ended()
+
+            def close(self):
+                try:
+                    return super().close()
+                finally:
+                    if self.writing:
+                        self.writing = False
+                        threads.end_write()
+
+        return ThreadedConnection
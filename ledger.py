@@ -0,0 +1,543 @@
+import logging
+from decimal import Decimal, InvalidOperation
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Set, Tuple, Union
+
+import gevent
+from gevent.event import AsyncResult, Event
+from gevent.lock import Semaphore
+
+logger = logging.getLogger(__name__)
+
+# currency -> amount
+Balances = Dict[str, Decimal]
+# (player id, user id, is infinite, balances) as loaded from the database
+PlayerRow = Tuple[int, int, bool, Balances]
+
+# (sender id, recipient id, currency, amount)
+Transfer = Tuple[int, int, str, Decimal]
+# (sender id, recipient id, currency, amount, True if the sender must have enough money)
+StoredTransfer = Tuple[int, int, str, Decimal, bool]
+
+
+class BalanceChange(NamedTuple):
+    """
+    Change of one balance made by transfers, with the money sent and received counted for statistics of the game
+    Changes are added together by +
+    """
+    amount: Decimal = Decimal(0)
+    sent: Decimal = Decimal(0)
+    received: Decimal = Decimal(0)
+    sent_count: int = 0
+    received_count: int = 0
+
+    @classmethod
+    def sending(cls, amount: Decimal) -> "BalanceChange":
+        """
+        :return: change of the balance of a sender
+        """
+        return cls(-amount, sent=amount, sent_count=1)
+
+    @classmethod
+    def receiving(cls, amount: Decimal) -> "BalanceChange":
+        """
+        :return: change of the balance of a recipient
+        """
+        return cls(amount, received=amount, received_count=1)
+
+    def __add__(self, other: "BalanceChange") -> "BalanceChange":
+        return BalanceChange(*(a + b for a, b in zip(self, other)))
+
+    def __neg__(self) -> "BalanceChange":
+        return BalanceChange(*(-a for a in self))
+
+
+# (player id, currency) -> change of the balance
+Deltas = Dict[Tuple[int, str], BalanceChange]
+
+# Smallest amount of money that can be sent
+MONEY_QUANTUM = Decimal('0.000001')
+# Largest amount of money that can be sent or owned,
+# amounts are stored as 64-bit integer counts of MONEY_QUANTUM, which end at about 9.2e12
+MAX_AMOUNT = Decimal(10 ** 12)
+
+
+class TransferError(Exception):
+    """
+    Raised when a transfer cannot be applied
+    The message of the exception is meant to be shown to the user
+    """
+
+
+class NotEnoughMoney(TransferError):
+    """
+    Raised when the sender of a transfer does not have enough money
+    """
+
+    def __init__(self):
+        super().__init__('You do not have enought money')
+
+
+def parse_amount(value: any) -> Decimal:
+    """
+    Parses an amount of money sent by a client
+    :param value: number or string
+    :return: the amount rounded to MONEY_QUANTUM
+    :raises TransferError: if the value is not a finite number or it is larger than MAX_AMOUNT
+    """
+    try:
+        amount = Decimal(str(value))
+        if not amount.is_finite():
+            raise TransferError('Invalid amount')
+        amount = amount.quantize(MONEY_QUANTUM)
+    except InvalidOperation:
+        raise TransferError('Invalid amount')
+    if abs(amount) > MAX_AMOUNT:
+        raise TransferError(f'The amount cannot be larger than {format_amount(MAX_AMOUNT)}')
+    return amount
+
+
+def format_amount(amount: Decimal) -> str:
+    """
+    :param amount: amount of money
+    :return: the amount without trailing zeros, e.g. 10 instead of 10.000000
+    """
+    return f'{amount.normalize():f}'
+
+
+class GameLedger:
+    """
+    Balances of all players inside one game held in memory
+    """
+
+    def __init__(self, game_id: int):
+        self.game_id = game_id
+        self.balances: Dict[int, Balances] = {}
+        self.users: Dict[int, int] = {}
+        self.infinite: Set[int] = set()
+
+    def add_player(self, player_id: int, user_id: int, balances: Balances, infinite: bool = False) -> None:
+        """
+        Adds a player into this ledger
+        :param player_id: id of the player
+        :param user_id: id of the user owning the player
+        :param balances: starting balances of the player
+        :param infinite: True if the player has infinite amount of money
+        :return: None
+        """
+        self.balances[player_id] = dict(balances)
+        self.users[player_id] = user_id
+        if infinite:
+            self.infinite.add(player_id)
+
+    def check(self, sender_id: int, recipient_id: int, currency: str, amount: Decimal) -> None:
+        """
+        Checks whether a transfer between two players of this game is possible
+        :param sender_id: id of the player sending the money
+        :param recipient_id: id of the player receiving the money
+        :param currency: the currency used
+        :param amount: how much is sent
+        :return: None
+        :raises TransferError: if the transfer is not possible
+        """
+        sender = self.balances.get(sender_id)
+        recipient = self.balances.get(recipient_id)
+        if sender is None or recipient is None:
+            raise TransferError('Both players must be in the same game!')
+        if amount <= 0:
+            raise TransferError('You cannot send less than (or equal to) 0')
+        if amount > MAX_AMOUNT:
+            raise TransferError(f'The amount cannot be larger than {format_amount(MAX_AMOUNT)}')
+        if None in (sender.get(currency), recipient.get(currency)):
+            raise TransferError('Invalid currency')
+        if sender[currency] < amount and sender_id not in self.infinite:
+            raise NotEnoughMoney()
+        if recipient[currency] + amount > MAX_AMOUNT or sender[currency] - amount < -MAX_AMOUNT:
+            raise TransferError(f'A balance cannot be larger than {format_amount(MAX_AMOUNT)}')
+
+    def apply(self, sender_id: int, recipient_id: int, currency: str, amount: Decimal) -> Tuple[Decimal, Decimal]:
+        """
+        Applies already checked transfer
+        :return: (how much does have sender left, how much does have recipient left)
+        """
+        sender = self.balances[sender_id]
+        recipient = self.balances[recipient_id]
+        sender[currency] -= amount
+        recipient[currency] += amount
+        return sender[currency], recipient[currency]
+
+    def transfer(self, sender_id: int, recipient_id: int, currency: str, amount: Decimal) -> Tuple[Decimal, Decimal]:
+        """
+        Checks and applies a transfer between two players of this game
+        :param sender_id: id of the player sending the money
+        :param recipient_id: id of the player receiving the money
+        :param currency: the currency used
+        :param amount: how much is sent
+        :return: (how much does have sender left, how much does have recipient left)
+        :raises TransferError: if the transfer is not possible
+        """
+        self.check(sender_id, recipient_id, currency, amount)
+        return self.apply(sender_id, recipient_id, currency, amount)
+
+    def transfer_batch(self, transfers: List[Transfer]) -> List[Tuple[Decimal, Decimal]]:
+        """
+        Checks and applies transfers one after another, either all of them or none
+        :param transfers: [(sender id, recipient id, currency, amount)]
+        :return: [(how much does have sender left, how much does have recipient left)] after each transfer
+        :raises TransferError: if any of the transfers is not possible, nothing is applied then
+        """
+        if not transfers:
+            raise TransferError('No transfers')
+        snapshot = self.snapshot(transfers)
+        try:
+            return [self.transfer(*transfer) for transfer in transfers]
+        except TransferError:
+            self.restore(snapshot)
+            raise
+
+    def snapshot(self, transfers: List[Transfer]) -> Dict[int, Balances]:
+        """
+        :param transfers: [(sender id, recipient id, currency, amount)]
+        :return: copy of balances of all players taking part in the transfers
+        """
+        return {player_id: dict(self.balances[player_id])
+                for transfer in transfers for player_id in transfer[:2] if player_id in self.balances}
+
+    def restore(self, snapshot: Dict[int, Balances]) -> None:
+        """
+        Returns balances to the state saved by snapshot()
+        :return: None
+        """
+        self.balances.update(snapshot)
+
+
+class LedgerEngine:
+    """
+    Holds ledgers of all loaded games and persists changes of balances
+
+    With durability 'write-behind' changes of balances are written by a background
+    greenlet every flush_interval seconds, with 'sync' every transfer is written
+    into the database by a guarded update before it is confirmed, with 'group'
+    the guarded updates of all transfers made within group_window seconds are
+    written in one transaction and confirmed together
+    """
+    DURABILITY_SYNC = 'sync'
+    DURABILITY_GROUP = 'group'
+    DURABILITY_WRITE_BEHIND = 'write-behind'
+
+    def __init__(self,
+                 load: Callable[[int], Iterable[PlayerRow]],
+                 store: Callable[[Deltas, List[dict]], None],
+                 store_transfers: Callable[[List[Tuple[List[StoredTransfer], Optional[dict]]]], List[bool]],
+                 flush_interval: float = 1.0,
+                 durability: str = DURABILITY_WRITE_BEHIND,
+                 group_window: float = 0.002):
+        """
+        :param load: returns all players of game with given id
+        :param store: adds the changes of balances and writes new history records in one transaction,
+                      sets 'id' of the records after they are written
+        :param store_transfers: writes groups of transfers [([(sender id, recipient id, currency, amount, True if
+                                the sender must have enough money)], history record)] in one transaction,
+                                returns for each group False and writes nothing of it if any sender does not have
+                                enough money, True otherwise, sets 'id' of the written records
+        :param flush_interval: how often (in seconds) are the changes written in write-behind mode
+        :param durability: 'sync', 'group' or 'write-behind'
+        :param group_window: how long (in seconds) are transfers collected into one transaction in group mode
+        """
+        self.__load = load
+        self.__store = store
+        self.__store_transfers = store_transfers
+        self.flush_interval = flush_interval
+        self.durability = durability
+        self.group_window = group_window
+        self.__games: Dict[int, GameLedger] = {}
+        # game id -> pending changes of balances of its players
+        self.__deltas: Dict[int, Deltas] = {}
+        # game id -> values of its pending HistoryRecord rows
+        self.__records: Dict[int, List[dict]] = {}
+        # game id -> functions called after its pending changes are written
+        self.__written: Dict[int, List[Callable[[], None]]] = {}
+        self.__flush_lock = Semaphore()
+        self.__flusher: Optional[gevent.Greenlet] = None
+        # transfers waiting for the group commit with results set when they are written
+        self.__pending: List[Tuple[List[StoredTransfer], Optional[dict], AsyncResult]] = []
+        self.__has_pending = Event()
+        self.__committer: Optional[gevent.Greenlet] = None
+
+    @property
+    def durability(self) -> str:
+        return self.__durability
+
+    @durability.setter
+    def durability(self, value: str) -> None:
+        if value not in (self.DURABILITY_SYNC, self.DURABILITY_GROUP, self.DURABILITY_WRITE_BEHIND):
+            raise ValueError(f'Unknown ledger durability mode {value}')
+        self.__durability = value
+
+    def game(self, game_id: int) -> GameLedger:
+        """
+        Gets ledger of a game, loading it from the database if needed
+        :param game_id: id of the game
+        :return: ledger of the game
+        """
+        ledger = self.__games.get(game_id)
+        if ledger is None:
+            ledger = GameLedger(game_id)
+            for player_id, user_id, infinite, balances in self.__load(game_id):
+                ledger.add_player(player_id, user_id, balances, infinite)
+            self.__games[game_id] = ledger
+        return ledger
+
+    def add_player(self, game_id: int, player_id: int, user_id: int, balances: Balances,
+                   infinite: bool = False) -> None:
+        """
+        Registers newly created player into the ledger of his game
+        If the game is not loaded yet, the player will be loaded with it
+        :return: None
+        """
+        ledger = self.__games.get(game_id)
+        if ledger is not None:
+            ledger.add_player(player_id, user_id, balances, infinite)
+
+    def forget(self, game_id: int) -> None:
+        """
+        Drops the ledger of a game changed by somebody else, it will be loaded again when needed
+        Pending changes are written first, so they are not lost by loading the game again
+        :param game_id: id of the game
+        :return: None
+        """
+        if game_id in self.__games:
+            self.flush(game_id)
+            self.__games.pop(game_id, None)
+
+    def transfer(self, game_id: int, sender_id: int, recipient_id: int, currency: str, amount: Decimal,
+                 record: Optional[dict] = None) -> Tuple[Decimal, Decimal]:
+        """
+        Applies a transfer in memory and writes it into the database according to the durability
+        :param game_id: id of the game in which the transfer happens
+        :param sender_id: id of the player sending the money
+        :param recipient_id: id of the player receiving the money
+        :param currency: the currency used
+        :param amount: how much is sent
+        :param record: values of HistoryRecord to be written together with the transfer
+        :return: (how much does have sender left, how much does have recipient left)
+        :raises TransferError: if the transfer is not possible
+        """
+        return self.transfer_batch(game_id, [(sender_id, recipient_id, currency, amount)], record)[0]
+
+    def transfer_batch(self, game_id: int, transfers: List[Transfer],
+                       record: Optional[dict] = None) -> List[Tuple[Decimal, Decimal]]:
+        """
+        Applies transfers in memory, either all of them or none,
+        and writes them into the database according to the durability
+        In sync and group durability the transfers are reverted if the database refuses them
+        :param game_id: id of the game in which the transfers happen
+        :param transfers: [(sender id, recipient id, currency, amount)]
+        :param record: values of HistoryRecord to be written together with the transfers
+        :return: [(how much does have sender left, how much does have recipient left)] after each transfer
+        :raises TransferError: if any of the transfers is not possible
+        """
+        r = self.transfer_groups(game_id, [(transfers, record)])[0]
+        if isinstance(r, TransferError):
+            raise r
+        return r
+
+    def transfer_groups(self, game_id: int, groups: List[Tuple[List[Transfer], Optional[dict]]]) \
+            -> List[Union[List[Tuple[Decimal, Decimal]], TransferError]]:
+        """
+        Applies groups of transfers in memory one after another, each of them either whole or not at all,
+        and writes the applied groups into the database together according to the durability
+        In sync and group durability the groups are reverted if the database refuses them
+        and the groups refused for not enough money are tried once more with the balances loaded again,
+        as other processes may have changed them
+        :param game_id: id of the game in which the transfers happen
+        :param groups: [([(sender id, recipient id, currency, amount)], values of HistoryRecord to be written
+                       together with the transfers)]
+        :return: for each group [(how much does have sender left, how much does have recipient left)] after each
+                 transfer or the TransferError why the group was not applied
+        """
+        results = self.__transfer_groups(game_id, groups)
+        if self.durability == self.DURABILITY_WRITE_BEHIND:
+            return results
+        refused = [index for index, r in enumerate(results) if isinstance(r, NotEnoughMoney)]
+        if refused:
+            self.__games.pop(game_id, None)
+            for index, r in zip(refused, self.__transfer_groups(game_id, [groups[index] for index in refused])):
+                results[index] = r
+        return results
+
+    def __transfer_groups(self, game_id: int, groups: List[Tuple[List[Transfer], Optional[dict]]]) \
+            -> List[Union[List[Tuple[Decimal, Decimal]], TransferError]]:
+        ledger = self.game(game_id)
+        results: List[Union[List[Tuple[Decimal, Decimal]], TransferError]] = []
+        # (index of the group, balances before it, its transfers, its record)
+        applied: List[Tuple[int, Dict[int, Balances], List[Transfer], Optional[dict]]] = []
+        for transfers, record in groups:
+            snapshot = ledger.snapshot(transfers)
+            try:
+                results.append(ledger.transfer_batch(transfers))
+            except TransferError as e:
+                results.append(e)
+                continue
+            applied.append((len(results) - 1, snapshot, transfers, record))
+        if not applied:
+            return results
+
+        if self.durability != self.DURABILITY_WRITE_BEHIND:
+            stored_groups = [([(sender_id, recipient_id, currency, amount, sender_id not in ledger.infinite)
+                               for sender_id, recipient_id, currency, amount in transfers], record)
+                             for _, _, transfers, record in applied]
+            try:
+                if self.durability == self.DURABILITY_GROUP and self.__committer is not None:
+                    stored = self.__commit_in_group(stored_groups)
+                else:
+                    stored = self.__store_transfers(stored_groups)
+            except Exception:
+                if self.durability == self.DURABILITY_GROUP:
+                    # later transfers may have been applied on top of these, load the game again next time
+                    self.__games.pop(game_id, None)
+                else:
+                    for _, snapshot, _, _ in reversed(applied):
+                        ledger.restore(snapshot)
+                raise
+            if not all(stored):
+                # the database knows better, load the game again next time
+                self.__games.pop(game_id, None)
+                for (index, _, _, _), group_stored in zip(applied, stored):
+                    if not group_stored:
+                        results[index] = NotEnoughMoney()
+            return results
+
+        deltas = self.__deltas.setdefault(game_id, {})
+        for _, _, transfers, record in applied:
+            for sender_id, recipient_id, currency, amount in transfers:
+                for key, change in (((sender_id, currency), BalanceChange.sending(amount)),
+                                    ((recipient_id, currency), BalanceChange.receiving(amount))):
+                    deltas[key] = deltas.get(key, BalanceChange()) + change
+            if record is not None:
+                self.__records.setdefault(game_id, []).append(record)
+        return results
+
+    def __commit_in_group(self, groups: List[Tuple[List[StoredTransfer], Optional[dict]]]) -> List[bool]:
+        """
+        Waits until the groups of transfers are written by the group commit
+        :return: for each group False if any sender does not have enough money and nothing of it was written
+        """
+        results = []
+        for transfers, record in groups:
+            result = AsyncResult()
+            self.__pending.append((transfers, record, result))
+            results.append(result)
+        self.__has_pending.set()
+        return [result.get() for result in results]
+
+    def __commit_pending(self) -> None:
+        """
+        Writes all transfers waiting for the group commit in one transaction and confirms them
+        :return: None
+        """
+        pending = self.__pending
+        self.__pending = []
+        self.__has_pending.clear()
+        if not pending:
+            return
+        try:
+            stored = self.__store_transfers([(transfers, record) for transfers, record, _ in pending])
+        except Exception as e:
+            for _, _, result in pending:
+                result.set_exception(e)
+            return
+        for (_, _, result), group_stored in zip(pending, stored):
+            result.set(group_stored)
+
+    def __commit_loop(self) -> None:
+        while True:
+            self.__has_pending.wait()
+            # let transfers made at about the same time join this transaction
+            gevent.sleep(self.group_window)
+            self.__commit_pending()
+
+    def when_written(self, game_id: int, callback: Callable[[], None]) -> None:
+        """
+        Calls a function after the changes of a game made so far are written into the database,
+        at once if there are no pending changes of the game
+        In write-behind durability ids of the records written with transfers are known only after the flush
+        :param game_id: id of the game
+        :param callback: the function
+        :return: None
+        """
+        if game_id in self.__deltas or game_id in self.__records or self.__flush_lock.locked():
+            self.__written.setdefault(game_id, []).append(callback)
+        else:
+            callback()
+
+    def flush(self, game_id: Optional[int] = None) -> None:
+        """
+        Writes pending changes of balances and pending records into the database, every game in its own transaction,
+        and then calls the functions waiting for them, see when_written()
+        If writing of a game fails, its changes are kept for the next flush and the other games are written anyway
+        :param game_id: id of the game whose changes are written, None to write changes of all games
+        :return: None
+        :raises Exception: the first failure of writing a game, after all the games were tried
+        """
+        failure: Optional[Exception] = None
+        callbacks: List[Callable[[], None]] = []
+        with self.__flush_lock:
+            game_ids = list(self.__deltas.keys() | self.__records.keys() | self.__written.keys()) \
+                if game_id is None else [game_id]
+            for g in game_ids:
+                deltas = self.__deltas.pop(g, {})
+                records = self.__records.pop(g, [])
+                written = self.__written.pop(g, [])
+                if not deltas and not records and not written:
+                    continue
+                try:
+                    self.__store(deltas, records)
+                except Exception as e:
+                    logger.exception('writing changes of game %d failed', g)
+                    failure = failure or e
+                    pending = self.__deltas.setdefault(g, {})
+                    for key, change in deltas.items():
+                        pending[key] = pending.get(key, BalanceChange()) + change
+                    self.__records[g] = records + self.__records.get(g, [])
+                    self.__written[g] = written + self.__written.get(g, [])
+                    continue
+                callbacks.extend(written)
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                logger.exception('callback after the ledger flush failed')
+        if failure is not None:
+            raise failure
+
+    def __flush_loop(self) -> None:
+        while True:
+            gevent.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                pass  # logged by flush() for every game which was not written
+
+    def start(self) -> None:
+        """
+        Starts the background writers
+        :return: None
+        """
+        if self.__flusher is None:
+            self.__flusher = gevent.spawn(self.__flush_loop)
+        if self.__committer is None:
+            self.__committer = gevent.spawn(self.__commit_loop)
+
+    def stop(self) -> None:
+        """
+        Stops the background writers and writes all remaining changes
+        :return: None
+        """
+        if self.__flusher is not None:
+            self.__flusher.kill()
+            self.__flusher = None
+        if self.__committer is not None:
+            self.__committer.kill()
+            self.__committer = None
+        self.__commit_pending()
+        self.flush()
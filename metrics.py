@@ -0,0 +1,137 @@
+from bisect import bisect_left
+from typing import Dict, List, Optional, Sequence, Tuple
+
+# Label values of one time series
+Labels = Tuple[str, ...]
+
+# Upper bounds of histogram buckets in seconds, same as the default of Prometheus clients
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .075, .1, .25, .5, .75, 1.0, 2.5, 5.0, 7.5, 10.0)
+
+
+class Registry:
+    """
+    Holds all metrics exposed by the server
+    """
+
+    def __init__(self):
+        self.metrics: List["Metric"] = []
+
+    def render(self) -> str:
+        """
+        :return: all metrics in the Prometheus text format
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+# Metrics of this process
+registry = Registry()
+
+
+def format_labels(names: Sequence[str], values: Labels) -> str:
+    """
+    :param names: names of labels
+    :param values: values of labels
+    :return: labels in the Prometheus text format, e.g. {type="login"}
+    """
+    if not names:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        value = value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+class Metric:
+    """
+    Named metric with optional labels
+    """
+    type = 'untyped'
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = (),
+                 metrics_registry: Optional[Registry] = registry):
+        """
+        :param name: name of the metric
+        :param documentation: description of the metric
+        :param label_names: names of labels distinguishing time series of this metric
+        :param metrics_registry: registry to expose this metric with, None to not expose it
+        """
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        if metrics_registry is not None:
+            metrics_registry.metrics.append(self)
+
+    def render(self) -> List[str]:
+        """
+        :return: lines of this metric in the Prometheus text format
+        """
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+
+
+class Counter(Metric):
+    """
+    Value that only goes up
+    """
+    type = 'counter'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.values: Dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1, labels: Labels = ()) -> None:
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self) -> List[str]:
+        return super().render() + [f'{self.name}{format_labels(self.label_names, labels)} {value}'
+                                   for labels, value in self.values.items()]
+
+
+class Gauge(Counter):
+    """
+    Value that goes up and down
+    """
+    type = 'gauge'
+
+    def dec(self, amount: float = 1, labels: Labels = ()) -> None:
+        self.inc(-amount, labels)
+
+    def set(self, value: float, labels: Labels = ()) -> None:
+        self.values[labels] = value
+
+
+class Histogram(Metric):
+    """
+    Distribution of observed values in cumulative buckets
+    """
+    type = 'histogram'
+
+    def __init__(self, *args, buckets: Sequence[float] = DEFAULT_BUCKETS, **kwargs):
+        """
+        :param buckets: sorted upper bounds of the buckets, +Inf is added automatically
+        """
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(buckets)
+        # labels -> (counts of values in each bucket and in +Inf, sum of values)
+        self.values: Dict[Labels, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, labels: Labels = ()) -> None:
+        counts, total = self.values.setdefault(labels, ([0] * (len(self.buckets) + 1), [0.0]))
+        counts[bisect_left(self.buckets, value)] += 1
+        total[0] += value
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        bucket_names = self.label_names + ('le',)
+        for labels, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'{self.name}_bucket{format_labels(bucket_names, labels + (le,))} {cumulative}')
+            lines.append(f'{self.name}_sum{format_labels(self.label_names, labels)} {total[0]}')
+            lines.append(f'{self.name}_count{format_labels(self.label_names, labels)} {cumulative}')
+        return lines
@@ -1,75 +1,275 @@
+// Flags in the first byte of binary frames sent by the server
+const FRAME_MSGPACK = 1;
+const FRAME_DEFLATE = 2;
+const FRAME_ENCRYPTED = 4;
+
+// the key shared with the server if it encrypts connections, a link ending with #key=<hex> saves it
+const TRANSPORT_KEY_ITEM = 'gameMoneyTransportKey';
+
+const hexToBytes = (hex) => Uint8Array.from(hex.match(/../g) || [], (b) => parseInt(b, 16));
+const bytesToHex = (bytes) => Array.from(bytes, (b) => b.toString(16).padStart(2, '0')).join('');
+
+function loadTransportKey() {
+    const match = location.hash.match(/key=([0-9a-fA-F]+)/);
+    if (match !== null) {
+        localStorage.setItem(TRANSPORT_KEY_ITEM, match[1]);
+        history.replaceState(null, '', location.pathname + location.search);
+    }
+    const key = localStorage.getItem(TRANSPORT_KEY_ITEM);
+    if (key !== null)
+        return Promise.resolve(hexToBytes(key));
+    return askText('Enter the key of this server').then((key) => {
+        localStorage.setItem(TRANSPORT_KEY_ITEM, key || '');
+        return hexToBytes(key || '');
+    });
+}
+
+function forgetTransportKey() {
+    localStorage.removeItem(TRANSPORT_KEY_ITEM);
+    location.reload();
+}
+
+// encryption of frames of one connection, see FrameCrypt in crypt.py
+function FrameCrypt(key, clientNonce, serverNonce) {
+    const SERVER = 0;
+    const CLIENT = 1;
+    const keys = hmacSha256(key, clientNonce, serverNonce);
+    const cipher = new Aes(keys.subarray(0, 16));
+    const macKey = keys.subarray(16);
+    const counters = [0, 0];
+
+    const nonce = (direction) => {
+        const r = new Uint8Array(12);
+        r[0] = direction;
+        new DataView(r.buffer).setUint32(8, counters[direction]++);
+        return r;
+    };
+    const tag = (key, ...parts) => hmacSha256(key, ...parts).subarray(0, 16);
+
+    // frame is the next binary frame received, returns it with the header and without the encryption
+    this.unwrap = (frame) => {
+        const n = nonce(SERVER);
+        const header = frame.subarray(0, 1);
+        const encryptedKey = frame.subarray(1, 33);
+        const data = frame.subarray(49, frame.length - 16);
+        const dataTag = frame.subarray(frame.length - 16);
+        if (frame.length < 65 || !tagsEqual(tag(macKey, n, header, encryptedKey, dataTag), frame.subarray(33, 49)))
+            throw new Error('Invalid tag');
+        const dataKey = cipher.ctr(n, encryptedKey);
+        if (!tagsEqual(tag(dataKey.subarray(16), header, data), dataTag))
+            throw new Error('Invalid tag');
+        const r = new Uint8Array(data.length + 1);
+        r.set(header);
+        r.set(new Aes(dataKey.subarray(0, 16)).ctr(new Uint8Array(12), data), 1);
+        return r.buffer;
+    };
+
+    this.encrypt = (data) => {
+        const n = nonce(CLIENT);
+        const ciphertext = cipher.ctr(n, data);
+        const r = new Uint8Array(ciphertext.length + 16);
+        r.set(ciphertext);
+        r.set(tag(macKey, n, ciphertext), ciphertext.length);
+        return r;
+    };
+}
+
 function Comm() {
     const sockProto = location.protocol.toLowerCase().startsWith('https') ? 'wss' : 'ws';
-    const sockURL = `${sockProto}://${location.host}/soc`;
+    // the server chooses from encodings and compressions the browser can decode, JSON is always accepted
+    const compression = typeof DecompressionStream === 'undefined' ? '' : 'deflate';
+    const sockURL = `${sockProto}://${location.host}/soc?encoding=msgpack,json&compression=${compression}`;
+    // resolves to the key if the server encrypts connections, to null otherwise
+    const transportKey = document.body.dataset.encryption === 'aes-ctr-hmac' ? loadTransportKey() : Promise.resolve(null);
 
-    const sock = new WebSocket(sockURL);
+    let sock = null;
+    // encryption of the current connection, null if it is not encrypted
+    let sockCrypt = null;
     const unsentMessages = [];
+    let lastRequestId = 0;
+
+    // token of the session started by login, used to resume it after the connection is lost
+    let sessionToken = null;
+    // count of frames received in the session
+    let received = 0;
 
     let _connectionLost = false;
+    let _pingTimer = null;
     let _pingTimeout = null;
 
     const connectionLost = () => {
         if (_connectionLost)
             return;
         _connectionLost = true;
+        this.opened = false;
+        clearTimeout(_pingTimer);
+        clearTimeout(_pingTimeout);
 
         $('#modalConnectionLost').modal({'backdrop': 'static'});
 
-        function reconnect() {
-            const sock2 = new WebSocket(sock.url);
-            sock2.onopen = () => location.reload();
-            sock2.onerror = () => setTimeout(() => reconnect());
-        }
-
         reconnect();
     };
 
-    const ping = () => {
-        if (_pingTimeout !== null)
-            clearTimeout(_pingTimeout);
-        setTimeout(() =>  {
-            this.send('ping', 'ping');
-            _pingTimeout = setTimeout(() => connectionLost(), 3000);
-        }, (Math.random() * 3000) + 2000);
+    const reconnect = () => {
+        // clients of one room lose the connection at once, so they do not come back at once
+        setTimeout(() => connect(() => {
+            if (sessionToken === null) {
+                location.reload();
+                return;
+            }
+            // the server sends frames missed meanwhile and then replies with resume
+            sendFrame(JSON.stringify({type: 'resume', message: {token: sessionToken, received}}));
+        }), (Math.random() * 1000) + 500);
     };
 
-    sock.onopen = () => {
-        this.opened = true;
-        this.onOpen();
+    const resumed = () => {
+        _connectionLost = false;
+        $('#modalConnectionLost').modal('hide');
+        opened();
+    };
 
+    const opened = () => {
+        this.opened = true;
         ping();
 
         while (unsentMessages.length > 0 && this.opened) {
-            this.sendRaw(unsentMessages.pop());
+            this.sendRaw(unsentMessages.shift());
         }
     };
 
-    sock.onclose = () => {
-        this.opened = false;
-        this.onClose();
+    // the server pings the browser itself, the browser pings only after it received nothing for a while
+    const ping = () => {
+        clearTimeout(_pingTimer);
+        clearTimeout(_pingTimeout);
+        _pingTimer = setTimeout(() => {
+            this.send('ping', 'ping');
+            _pingTimeout = setTimeout(() => connectionLost(), 3000);
+        }, (Math.random() * 5000) + 10000);
     };
 
-    sock.onerror = connectionLost;
+    const sendFrame = (frame) => {
+        sock.send(sockCrypt === null ? frame : sockCrypt.encrypt(new TextEncoder().encode(frame)));
+    };
 
-    sock.onmessage = (msg) => {
-        let data;
-        try {
-            data = JSON.parse(msg.data);
-            console.debug('<- ', data);
-        } catch {
-            return;
+    const decodeFrame = async (frame, crypt) => {
+        if (typeof frame === 'string')
+            return JSON.parse(frame);
+        if (crypt !== null) {
+            try {
+                frame = crypt.unwrap(new Uint8Array(frame));
+            } catch (e) {
+                forgetTransportKey();  // the key is wrong
+                throw e;
+            }
         }
+        const flags = new Uint8Array(frame, 0, 1)[0];
+        let data = new Uint8Array(frame, 1);
+        if (flags & FRAME_DEFLATE) {
+            const stream = new Blob([data]).stream().pipeThrough(new DecompressionStream('deflate'));
+            data = new Uint8Array(await new Response(stream).arrayBuffer());
+        }
+        return (flags & FRAME_MSGPACK) ? decodeMsgPack(data) : JSON.parse(new TextDecoder().decode(data));
+    };
 
-        if (data.type === 'pong') {
-            ping();
+    // frames are handled in the order in which they were received, even if some of them take longer to decode
+    let receivedFrames = Promise.resolve();
+
+    // ready is called once frames can be sent
+    const connect = (ready) => transportKey.then((key) => {
+        if (key === null) {
+            open(sockURL, null, ready);
             return;
         }
+        // the server replies with its nonce and then with an encrypted frame proving that both sides use the same key
+        const nonce = crypto.getRandomValues(new Uint8Array(16));
+        open(`${sockURL}&encryption=aes-ctr-hmac&nonce=${bytesToHex(nonce)}`, (serverNonce) => {
+            try {
+                return new FrameCrypt(key, nonce, serverNonce);
+            } catch (e) {
+                forgetTransportKey();
+                throw e;
+            }
+        }, ready);
+    });
+
+    // createCrypt is null for unencrypted connections
+    const open = (url, createCrypt, ready) => {
+        const s = new WebSocket(url);
+        s.binaryType = 'arraybuffer';
+        sock = s;
+        sockCrypt = null;
+        let crypt = null;
+
+        // error is always followed by close
+        s.onclose = () => {
+            if (s !== sock)
+                return;
+            if (_connectionLost) {
+                // reconnecting failed
+                reconnect();
+                return;
+            }
+            this.opened = false;
+            this.onClose();
+            connectionLost();
+        };
+
+        if (createCrypt === null)
+            s.onopen = ready;
+
+        s.onmessage = (msg) => {
+            if (createCrypt !== null && crypt === null) {
+                // the only unencrypted frame of the connection
+                crypt = createCrypt(hexToBytes(JSON.parse(msg.data).message.nonce));
+                return;
+            }
+            const frameCrypt = crypt;
+            receivedFrames = receivedFrames
+                .then(() => decodeFrame(msg.data, frameCrypt).catch(() => null))
+                .then((data) => {
+                    if (s !== sock)
+                        return;
+                    if (data !== null && data.type === 'encryption') {
+                        sockCrypt = frameCrypt;
+                        ready();
+                        return;
+                    }
+                    if (data !== null && data.type === 'session') {
+                        // the first frame of the session
+                        sessionToken = data.message.token;
+                        received = 1;
+                        return;
+                    }
+                    if (sessionToken !== null)
+                        received++;
+                    if (this.opened)
+                        ping();
+                    if (data !== null)
+                        onData(data);
+                })
+                .catch((e) => console.error(e));
+        };
+    };
+
+    const onData = (data) => {
+        console.debug('<- ', data);
+
+        switch (data.type) {
+            case 'pong':
+                return;
+            case 'resume':
+                resumed();
+                return;
+            case 'resumeERR':
+                location.reload();
+                return;
+        }
 
         if (data.type.endsWith('ERR')) {
             new Popup(data.message, 5000).show();
         }
 
-        this.onMessage(data.type, data.message);
+        this.onMessage(data.type, data.message, data.id);
     };
 
     this.opened = false;
@@ -86,15 +286,24 @@ function Comm() {
         }
         console.debug('-> ', data);
 
-        sock.send(JSON.stringify(data));
+        sendFrame(JSON.stringify(data));
         return true;
     };
 
+    // returns id of the request, replies to the request carry the same id
     this.send = (type, message) => {
-        return this.sendRaw({type, message});
+        const id = ++lastRequestId;
+        this.sendRaw({type, message, id});
+        return id;
     };
 
+    // id is undefined for events which are not replies
     // noinspection JSUnusedLocalSymbols
-    this.onMessage = (type, message) => {
+    this.onMessage = (type, message, id) => {
     };
+
+    connect(() => {
+        this.onOpen();
+        opened();
+    });
 }
@@ -0,0 +1,177 @@
+// AES in the CTR mode and HMAC-SHA256 used to encrypt the connection to the server, see crypt.py
+// the Web Crypto API is available only on HTTPS
+
+const AES_SBOX = new Uint8Array(256);
+// tables combining SubBytes, ShiftRows and MixColumns, one for every byte of a column
+const AES_TABLES = [new Uint32Array(256), new Uint32Array(256), new Uint32Array(256), new Uint32Array(256)];
+
+(() => {
+    // powers and logarithms of 3 in GF(2^8)
+    const pow = new Uint8Array(256);
+    const log = new Uint8Array(256);
+    for (let i = 0, x = 1; i < 256; i++) {
+        pow[i] = x;
+        log[x] = i;
+        x ^= (x << 1) ^ ((x & 0x80) ? 0x11b : 0);
+    }
+    for (let i = 0; i < 256; i++) {
+        let s = i === 0 ? 0 : pow[255 - log[i]];
+        s ^= ((s << 1) | (s >> 7)) ^ ((s << 2) | (s >> 6)) ^ ((s << 3) | (s >> 5)) ^ ((s << 4) | (s >> 4));
+        AES_SBOX[i] = (s ^ 0x63) & 0xff;
+    }
+    for (let i = 0; i < 256; i++) {
+        const s = AES_SBOX[i];
+        const s2 = ((s << 1) ^ ((s & 0x80) ? 0x11b : 0)) & 0xff;
+        const t = ((s2 << 24) | (s << 16) | (s << 8) | (s2 ^ s)) >>> 0;
+        for (let j = 0; j < 4; j++)
+            AES_TABLES[j][i] = ((t >>> (8 * j)) | (t << (32 - 8 * j))) >>> 0;
+    }
+})();
+
+// key is a Uint8Array of 16, 24 or 32 bytes
+function Aes(key) {
+    if (![16, 24, 32].includes(key.length))
+        throw new Error('Invalid key size');
+
+    const keyWords = key.length / 4;
+    const rounds = keyWords + 6;
+    const roundKeys = new Uint32Array(4 * (rounds + 1));
+    const subWord = (t) => (AES_SBOX[t >>> 24] << 24) | (AES_SBOX[(t >>> 16) & 0xff] << 16) |
+        (AES_SBOX[(t >>> 8) & 0xff] << 8) | AES_SBOX[t & 0xff];
+    for (let i = 0, rcon = 1; i < roundKeys.length; i++) {
+        if (i < keyWords) {
+            roundKeys[i] = ((key[4 * i] << 24) | (key[4 * i + 1] << 16) | (key[4 * i + 2] << 8) | key[4 * i + 3]) >>> 0;
+            continue;
+        }
+        let t = roundKeys[i - 1];
+        if (i % keyWords === 0) {
+            t = subWord((t << 8) | (t >>> 24)) ^ (rcon << 24);
+            rcon = ((rcon << 1) ^ ((rcon & 0x80) ? 0x11b : 0)) & 0xff;
+        } else if (keyWords > 6 && i % keyWords === 4) {
+            t = subWord(t);
+        }
+        roundKeys[i] = (roundKeys[i - keyWords] ^ t) >>> 0;
+    }
+
+    // encrypts one block given as 4 words, the result is written into out
+    const encryptWords = (block, out) => {
+        const [T0, T1, T2, T3] = AES_TABLES;
+        let s0 = block[0] ^ roundKeys[0], s1 = block[1] ^ roundKeys[1];
+        let s2 = block[2] ^ roundKeys[2], s3 = block[3] ^ roundKeys[3];
+        let k = 4;
+        for (let r = 1; r < rounds; r++, k += 4) {
+            const t0 = T0[s0 >>> 24] ^ T1[(s1 >>> 16) & 0xff] ^ T2[(s2 >>> 8) & 0xff] ^ T3[s3 & 0xff] ^ roundKeys[k];
+            const t1 = T0[s1 >>> 24] ^ T1[(s2 >>> 16) & 0xff] ^ T2[(s3 >>> 8) & 0xff] ^ T3[s0 & 0xff] ^ roundKeys[k + 1];
+            const t2 = T0[s2 >>> 24] ^ T1[(s3 >>> 16) & 0xff] ^ T2[(s0 >>> 8) & 0xff] ^ T3[s1 & 0xff] ^ roundKeys[k + 2];
+            const t3 = T0[s3 >>> 24] ^ T1[(s0 >>> 16) & 0xff] ^ T2[(s1 >>> 8) & 0xff] ^ T3[s2 & 0xff] ^ roundKeys[k + 3];
+            s0 = t0;
+            s1 = t1;
+            s2 = t2;
+            s3 = t3;
+        }
+        const S = AES_SBOX;
+        out[0] = ((S[s0 >>> 24] << 24) | (S[(s1 >>> 16) & 0xff] << 16) | (S[(s2 >>> 8) & 0xff] << 8) | S[s3 & 0xff]) ^ roundKeys[k];
+        out[1] = ((S[s1 >>> 24] << 24) | (S[(s2 >>> 16) & 0xff] << 16) | (S[(s3 >>> 8) & 0xff] << 8) | S[s0 & 0xff]) ^ roundKeys[k + 1];
+        out[2] = ((S[s2 >>> 24] << 24) | (S[(s3 >>> 16) & 0xff] << 16) | (S[(s0 >>> 8) & 0xff] << 8) | S[s1 & 0xff]) ^ roundKeys[k + 2];
+        out[3] = ((S[s3 >>> 24] << 24) | (S[(s0 >>> 16) & 0xff] << 16) | (S[(s1 >>> 8) & 0xff] << 8) | S[s2 & 0xff]) ^ roundKeys[k + 3];
+    };
+
+    // encrypts or decrypts data, the counter blocks are the nonce (12 bytes) followed by 4 bytes of their index
+    this.ctr = (nonce, data) => {
+        const view = new DataView(nonce.buffer, nonce.byteOffset, 12);
+        const counter = new Uint32Array([view.getUint32(0), view.getUint32(4), view.getUint32(8), 0]);
+        const stream = new Uint32Array(4);
+        const r = new Uint8Array(data.length);
+        for (let offset = 0; offset < data.length; offset += 16, counter[3]++) {
+            encryptWords(counter, stream);
+            const end = Math.min(offset + 16, data.length);
+            for (let p = offset; p < end; p++)
+                r[p] = data[p] ^ (stream[(p - offset) >>> 2] >>> (24 - 8 * ((p - offset) & 3)));
+        }
+        return r;
+    };
+}
+
+const SHA256_K = Uint32Array.from([
+    0x428a2f98, 0x71374491, 0xb5c0fbcf, 0xe9b5dba5, 0x3956c25b, 0x59f111f1, 0x923f82a4, 0xab1c5ed5,
+    0xd807aa98, 0x12835b01, 0x243185be, 0x550c7dc3, 0x72be5d74, 0x80deb1fe, 0x9bdc06a7, 0xc19bf174,
+    0xe49b69c1, 0xefbe4786, 0x0fc19dc6, 0x240ca1cc, 0x2de92c6f, 0x4a7484aa, 0x5cb0a9dc, 0x76f988da,
+    0x983e5152, 0xa831c66d, 0xb00327c8, 0xbf597fc7, 0xc6e00bf3, 0xd5a79147, 0x06ca6351, 0x14292967,
+    0x27b70a85, 0x2e1b2138, 0x4d2c6dfc, 0x53380d13, 0x650a7354, 0x766a0abb, 0x81c2c92e, 0x92722c85,
+    0xa2bfe8a1, 0xa81a664b, 0xc24b8b70, 0xc76c51a3, 0xd192e819, 0xd6990624, 0xf40e3585, 0x106aa070,
+    0x19a4c116, 0x1e376c08, 0x2748774c, 0x34b0bcb5, 0x391c0cb3, 0x4ed8aa4a, 0x5b9cca4f, 0x682e6ff3,
+    0x748f82ee, 0x78a5636f, 0x84c87814, 0x8cc70208, 0x90befffa, 0xa4506ceb, 0xbef9a3f7, 0xc67178f2
+]);
+
+// data is a Uint8Array, returns 32 bytes
+function sha256(data) {
+    const padded = new Uint8Array(((data.length + 72) >>> 6) << 6);
+    padded.set(data);
+    padded[data.length] = 0x80;
+    const view = new DataView(padded.buffer);
+    view.setUint32(padded.length - 8, Math.floor(data.length / 0x20000000));
+    view.setUint32(padded.length - 4, (data.length << 3) >>> 0);
+
+    const h = Uint32Array.from([0x6a09e667, 0xbb67ae85, 0x3c6ef372, 0xa54ff53a,
+        0x510e527f, 0x9b05688c, 0x1f83d9ab, 0x5be0cd19]);
+    const w = new Uint32Array(64);
+    const rotr = (x, n) => (x >>> n) | (x << (32 - n));
+    for (let offset = 0; offset < padded.length; offset += 64) {
+        for (let i = 0; i < 16; i++)
+            w[i] = view.getUint32(offset + 4 * i);
+        for (let i = 16; i < 64; i++) {
+            const s0 = rotr(w[i - 15], 7) ^ rotr(w[i - 15], 18) ^ (w[i - 15] >>> 3);
+            const s1 = rotr(w[i - 2], 17) ^ rotr(w[i - 2], 19) ^ (w[i - 2] >>> 10);
+            w[i] = w[i - 16] + s0 + w[i - 7] + s1;
+        }
+        let [a, b, c, d, e, f, g, k] = h;
+        for (let i = 0; i < 64; i++) {
+            const t1 = k + (rotr(e, 6) ^ rotr(e, 11) ^ rotr(e, 25)) + ((e & f) ^ (~e & g)) + SHA256_K[i] + w[i];
+            const t2 = (rotr(a, 2) ^ rotr(a, 13) ^ rotr(a, 22)) + ((a & b) ^ (a & c) ^ (b & c));
+            k = g;
+            g = f;
+            f = e;
+            e = (d + t1) | 0;
+            d = c;
+            c = b;
+            b = a;
+            a = (t1 + t2) | 0;
+        }
+        h[0] += a;
+        h[1] += b;
+        h[2] += c;
+        h[3] += d;
+        h[4] += e;
+        h[5] += f;
+        h[6] += g;
+        h[7] += k;
+    }
+    const r = new Uint8Array(32);
+    const out = new DataView(r.buffer);
+    h.forEach((word, i) => out.setUint32(4 * i, word));
+    return r;
+}
+
+// key and all parts are Uint8Arrays, returns 32 bytes
+function hmacSha256(key, ...parts) {
+    const block = new Uint8Array(64);
+    block.set(key.length > 64 ? sha256(key) : key);
+    const pad = (value) => block.map((b) => b ^ value);
+    const concat = (arrays) => {
+        const r = new Uint8Array(arrays.reduce((length, a) => length + a.length, 0));
+        arrays.reduce((offset, a) => {
+            r.set(a, offset);
+            return offset + a.length;
+        }, 0);
+        return r;
+    };
+    return sha256(concat([pad(0x5c), sha256(concat([pad(0x36), ...parts]))]));
+}
+
+// compares two tags in a time not depending on where they differ
+function tagsEqual(a, b) {
+    let difference = a.length ^ b.length;
+    for (let i = 0; i < a.length && i < b.length; i++)
+        difference |= a[i] ^ b[i];
+    return difference === 0;
+}
@@ -24,6 +24,12 @@ window.addEventListener('load', () => {
         }
     }
 
+    // a link ending with #user=<key> logs in as the user, e.g. a user of an imported game
+    const userMatch = location.hash.match(/user=([0-9a-fA-F]+)/);
+    if (userMatch !== null) {
+        localStorage.setItem('gameMoneyId', userMatch[1]);
+        history.replaceState(null, '', location.pathname + location.search);
+    }
     let localId = localStorage.getItem('gameMoneyId');
     if (localId === null) {
         askText("Enter your name").then(name => {
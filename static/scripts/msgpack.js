@@ -0,0 +1,98 @@
+// Decodes MessagePack data (Uint8Array) sent by the server, extension types are not supported
+function decodeMsgPack(bytes) {
+    const view = new DataView(bytes.buffer, bytes.byteOffset, bytes.byteLength);
+    const textDecoder = new TextDecoder();
+    let offset = 0;
+
+    const readBytes = (length) => {
+        const r = bytes.subarray(offset, offset + length);
+        offset += length;
+        return r;
+    };
+    const readString = (length) => textDecoder.decode(readBytes(length));
+    const readArray = (length) => {
+        const r = [];
+        for (let i = 0; i < length; i++)
+            r.push(read());
+        return r;
+    };
+    const readMap = (length) => {
+        const r = {};
+        for (let i = 0; i < length; i++) {
+            const key = read();
+            r[key] = read();
+        }
+        return r;
+    };
+    const readNumber = (getter, length) => {
+        const r = view[getter](offset);
+        offset += length;
+        return r;
+    };
+    const readBigNumber = (getter) => Number(readNumber(getter, 8));
+
+    const read = () => {
+        const type = view.getUint8(offset++);
+        if (type <= 0x7f)
+            return type;
+        if (type <= 0x8f)
+            return readMap(type & 0x0f);
+        if (type <= 0x9f)
+            return readArray(type & 0x0f);
+        if (type <= 0xbf)
+            return readString(type & 0x1f);
+        if (type >= 0xe0)
+            return type - 0x100;
+        switch (type) {
+            case 0xc0:
+                return null;
+            case 0xc2:
+                return false;
+            case 0xc3:
+                return true;
+            case 0xc4:
+                return readBytes(readNumber('getUint8', 1));
+            case 0xc5:
+                return readBytes(readNumber('getUint16', 2));
+            case 0xc6:
+                return readBytes(readNumber('getUint32', 4));
+            case 0xca:
+                return readNumber('getFloat32', 4);
+            case 0xcb:
+                return readNumber('getFloat64', 8);
+            case 0xcc:
+                return readNumber('getUint8', 1);
+            case 0xcd:
+                return readNumber('getUint16', 2);
+            case 0xce:
+                return readNumber('getUint32', 4);
+            case 0xcf:
+                return readBigNumber('getBigUint64');
+            case 0xd0:
+                return readNumber('getInt8', 1);
+            case 0xd1:
+                return readNumber('getInt16', 2);
+            case 0xd2:
+                return readNumber('getInt32', 4);
+            case 0xd3:
+                return readBigNumber('getBigInt64');
+            case 0xd9:
+                return readString(readNumber('getUint8', 1));
+            case 0xda:
+                return readString(readNumber('getUint16', 2));
+            case 0xdb:
+                return readString(readNumber('getUint32', 4));
+            case 0xdc:
+                return readArray(readNumber('getUint16', 2));
+            case 0xdd:
+                return readArray(readNumber('getUint32', 4));
+            case 0xde:
+                return readMap(readNumber('getUint16', 2));
+            case 0xdf:
+                return readMap(readNumber('getUint32', 4));
+        }
+        throw new Error(`Unsupported MessagePack type 0x${type.toString(16)}`);
+    };
+
+    return read();
+}
@@ -3,145 +3,196 @@ function Renderer(variables = null, values = null, functions = null) {
     this.values = values === null ? {} : values;
     this.functions = functions === null ? {} : functions;
 
-    const localContext = (el, localVariables = null) => {
-        localVariables = localVariables !== null ? localVariables : {};
-        const ctxS = el.getAttribute('r-local-context');
-        let ctx = {};
-        if (ctxS !== null)
-            ctx = JSON.parse(ctxS);
-        return Object.assign(ctx, localVariables);
+    // expression -> function evaluating it, every expression is compiled only once
+    const compiledExpressions = new Map();
+    // statement of r-click -> function executing it
+    const compiledStatements = new Map();
+    // value of r-attr -> [attribute, expression] pairs
+    const parsedAttrs = new Map();
+    // element -> local variables it was rendered with
+    const contexts = new WeakMap();
+    // element -> texts and attributes last written into it, unchanged ones are not written again
+    const written = new WeakMap();
+    // r-for or r-if element -> key -> element rendered from it
+    const renderedOf = new WeakMap();
+    // element rendered from r-for or r-if -> the r-for or r-if element
+    const templateOf = new WeakMap();
+    // objects without an id -> their keys in r-for
+    const objectKeys = new WeakMap();
+    let lastObjectKey = 0;
+
+    const compile = (cache, code, body) => {
+        let compiled = cache.get(code);
+        if (compiled === undefined) {
+            try {
+                compiled = new Function('v', 'w', 'f', 'l', body);
+            } catch {
+                compiled = () => undefined;
+            }
+            cache.set(code, compiled);
+        }
+        return compiled;
     };
 
-    const assignClick = (el, localVariables = null) => {
-        // noinspection JSUnusedLocalSymbols
-        const v = this.variables;
-        // noinspection JSUnusedLocalSymbols
-        const w = this.values;
-        // noinspection JSUnusedLocalSymbols
-        const f = this.functions;
-
-        el.onclick = () => {
-            const l = localContext(el, localVariables);
-            eval(el.getAttribute('r-click'));
-            el.setAttribute('r-local-context', JSON.stringify(l));
+    const evaluate = (expression, l, fallback) => {
+        try {
+            return compile(compiledExpressions, expression, `return (${expression});`)(
+                this.variables, this.values, this.functions, l);
+        } catch {
+            return fallback;
         }
     };
 
-    this.render = (element = null, localVariables = null) => {
-        if (element === null) element = document.body;
-        if (localVariables === null) localVariables = {};
+    const execute = (statement, l) =>
+        compile(compiledStatements, statement, statement)(this.variables, this.values, this.functions, l);
 
-        localVariables = localContext(element, localVariables);
+    const asText = (val) => val === undefined || val === null ? '' : `${val}`;
 
-        // noinspection JSUnusedLocalSymbols
-        const v = this.variables;
-        // noinspection JSUnusedLocalSymbols
-        const w = this.values;
-        // noinspection JSUnusedLocalSymbols
-        const f = this.functions;
-
-        // delete all previously rendered
-        element.querySelectorAll('[r-child]').forEach(el =>
-            el.parentElement.removeChild(el)
-        );
-
-        // assign clicks
-        element.querySelectorAll('[r-click]').forEach(el => assignClick(el, localVariables));
-
-        // render all variables
-        element.querySelectorAll('[r-var]').forEach(el => {
-                let val;
-                try {
-                    const l = localContext(el, localVariables);
-                    val = eval(el.getAttribute('r-var'));
-                    el.setAttribute('r-local-context', JSON.stringify(l));
-                } catch {
-                    val = '';
+    const isTemplate = (el) => el.dataset.parsed === '1' && (el.hasAttribute('r-for') || el.hasAttribute('r-if'));
+
+    // local variables of the closest rendered element
+    const contextOf = (el) => {
+        for (; el !== null; el = el.parentElement) {
+            const context = contexts.get(el);
+            if (context !== undefined)
+                return context;
+        }
+        return {};
+    };
+
+    // items with an id keep their elements by it, other objects by their identity, equal values by their order
+    const itemKeys = (array) => {
+        const counts = new Map();
+        return array.map(x => {
+            let key;
+            if (x !== null && typeof x === 'object') {
+                if ('id' in x) {
+                    key = `id:${x.id}`;
+                } else {
+                    if (!objectKeys.has(x))
+                        objectKeys.set(x, `object:${++lastObjectKey}`);
+                    key = objectKeys.get(x);
                 }
-                el.textContent = `${val}`;
+            } else {
+                key = `${typeof x}:${x}`;
             }
-        );
-
-        // render attributes
-        element.querySelectorAll('[r-attr]').forEach(el => {
-                const l = localContext(el, localVariables);
-                const attrs = JSON.parse(el.getAttribute('r-attr'));
-                Object.keys(attrs).forEach(attr => {
-                    let val;
-                    try {
-                        val = eval(attrs[attr]);
-                    } catch {
-                        val = '';
-                    }
-                    el.setAttribute(attr, `${val}`);
-                });
-                el.setAttribute('r-local-context', JSON.stringify(l));
+            const count = counts.get(key) || 0;
+            counts.set(key, count + 1);
+            return count ? `${key}#${count}` : key;
+        });
+    };
+
+    const bind = (el, l) => {
+        let last = written.get(el);
+        if (last === undefined) {
+            last = {};
+            written.set(el, last);
+        }
+
+        const rVar = el.getAttribute('r-var');
+        if (rVar !== null) {
+            const text = asText(evaluate(rVar, l, ''));
+            if (last.text !== text) {
+                el.textContent = text;
+                last.text = text;
             }
-        );
+        }
 
-        // render if's
-        element.querySelectorAll('[r-if]').forEach(el => {
-            const l = localContext(el, localVariables);
-            let render = false;
-            try {
-                render = !!eval(el.getAttribute('r-if'));
-            } catch {
+        const rAttr = el.getAttribute('r-attr');
+        if (rAttr !== null) {
+            let attrs = parsedAttrs.get(rAttr);
+            if (attrs === undefined) {
+                attrs = Object.entries(JSON.parse(rAttr));
+                parsedAttrs.set(rAttr, attrs);
             }
+            attrs.forEach(([attr, expression]) => {
+                const val = asText(evaluate(expression, l, ''));
+                if (last[`@${attr}`] !== val) {
+                    el.setAttribute(attr, val);
+                    last[`@${attr}`] = val;
+                }
+            });
+        }
+
+        if (el.hasAttribute('r-click')) {
+            contexts.set(el, l);
+            if (!last.click) {
+                last.click = true;
+                el.onclick = () => execute(el.getAttribute('r-click'), contexts.get(el));
+            }
+        }
+    };
 
-            if (render) {
-                const renderedEl = el.cloneNode(false);
-                renderedEl.classList.remove('r-hidden');
-                delete renderedEl.dataset.index;
-                delete renderedEl.dataset.content;
-                renderedEl.removeAttribute('r-if');
-                renderedEl.setAttribute('r-child', el.dataset.index);
-                renderedEl.setAttribute('r-if-child', el.getAttribute('r-if'));
-                renderedEl.removeAttribute('hidden');
-                renderedEl.removeAttribute('disabled');
-
-                renderedEl.setAttribute('r-local-context', JSON.stringify(l));
-                this.renderString(renderedEl, el.dataset.content);
-                this.renderElementHeaders(renderedEl, l);
-
-                el.parentElement.insertBefore(renderedEl, el);
+    const renderChildren = (element, l) => {
+        Array.from(element.children).forEach(el => {
+            if (isTemplate(el)) {
+                renderTemplate(el, l);
+            } else if (!templateOf.has(el)) {
+                bind(el, l);
+                if (!el.hasAttribute('r-var'))
+                    renderChildren(el, l);
             }
         });
+    };
 
-        // render for's
-        element.querySelectorAll('[r-for]').forEach(el => {
-            const parts = el.getAttribute('r-for').split(' of ');
-            const forVar = parts[0];
-            const l = localContext(el, localVariables);
-            let array;
+    const createRendered = (template) => {
+        const el = template.cloneNode(false);
+        el.classList.remove('r-hidden');
+        ['r-for', 'r-if', 'hidden', 'disabled', 'data-index', 'data-content', 'data-parsed']
+            .forEach(attr => el.removeAttribute(attr));
+        el.innerHTML = template.dataset.content;
+        templateOf.set(el, template);
+        return el;
+    };
 
-            try {
-                array = eval(parts[1]) || [];
-            } catch {
-                array = [];
-            }
+    // updates elements rendered from r-for or r-if, only missing ones are created and only removed ones deleted
+    const renderTemplate = (template, l) => {
+        const localsByKey = new Map();
+        if (template.hasAttribute('r-if')) {
+            if (evaluate(template.getAttribute('r-if'), l, false))
+                localsByKey.set('', Object.assign({}, l));
+        } else {
+            const parts = template.getAttribute('r-for').split(' of ');
+            const forVar = parts[0];
+            const array = evaluate(parts[1], l, []) || [];
+            itemKeys(array).forEach((key, i) => localsByKey.set(key, Object.assign({}, l, {[forVar]: array[i]})));
+        }
 
-            array.forEach(x => {
-                const renderedEl = el.cloneNode(false);
-                renderedEl.classList.remove('r-hidden');
-                delete renderedEl.dataset.index;
-                delete renderedEl.dataset.content;
-                renderedEl.removeAttribute('r-for');
-                renderedEl.setAttribute('r-child', el.dataset.index);
-                renderedEl.setAttribute('r-for-child', el.getAttribute('r-for'));
-                renderedEl.removeAttribute('hidden');
-                renderedEl.removeAttribute('disabled');
-
-                const localVariablesCopy = Object.assign({}, l);
-                localVariablesCopy[forVar] = x;
-                renderedEl.setAttribute('r-local-context', JSON.stringify(localVariablesCopy));
-                this.renderString(renderedEl, el.dataset.content, localVariablesCopy);
-                this.renderElementHeaders(renderedEl, localVariablesCopy);
-
-                el.parentElement.insertBefore(renderedEl, el);
-            });
+        const previous = renderedOf.get(template) || new Map();
+        previous.forEach((el, key) => {
+            if (!localsByKey.has(key))
+                el.remove();
         });
+        const rendered = new Map();
+        localsByKey.forEach((locals, key) => {
+            const el = previous.get(key) || createRendered(template);
+            contexts.set(el, locals);
+            bind(el, locals);
+            renderChildren(el, locals);
+            rendered.set(key, el);
+        });
+        renderedOf.set(template, rendered);
+
+        // elements already in their place are not moved
+        let following = template;
+        Array.from(rendered.values()).reverse().forEach(el => {
+            if (el.nextSibling !== following)
+                template.parentElement.insertBefore(el, following);
+            following = el;
+        });
+    };
 
-        this.renderElementHeaders(element, localVariables);
+    this.render = (element = null, localVariables = null) => {
+        if (element === null) element = document.body;
+        const l = Object.assign({}, contextOf(element), localVariables || {});
+
+        if (isTemplate(element)) {
+            renderTemplate(element, l);
+            return;
+        }
+        bind(element, l);
+        if (!element.hasAttribute('r-var'))
+            renderChildren(element, l);
     };
 
     this.renderString = (el, str, localVariables = null) => {
@@ -151,44 +202,7 @@ function Renderer(variables = null, values = null, functions = null) {
     };
 
     this.renderElementHeaders = (el, localVariables = null) => {
-        if (localVariables === null) {
-            const context = el.getAttribute('r-local-context');
-            if (context !== null) {
-                localVariables = JSON.parse(context);
-            } else {
-                localVariables = {};
-            }
-        }
-
-        // noinspection JSUnusedLocalSymbols
-        const v = this.variables;
-        // noinspection JSUnusedLocalSymbols
-        const l = localVariables;
-        // noinspection JSUnusedLocalSymbols
-        const w = this.values;
-        // noinspection JSUnusedLocalSymbols
-        const f = this.functions;
-
-        const rVar = el.getAttribute('r-var');
-        const rAttr = el.getAttribute('r-attr');
-        const rClick = el.getAttribute('r-click');
-
-        if (rVar !== null) {
-            let val;
-            try {
-                val = eval(el.getAttribute('r-var'));
-            } catch {
-                val = '';
-            }
-            el.textContent = val;
-        }
-        if (rAttr !== null) {
-            const attrs = JSON.parse(rAttr);
-            Object.keys(attrs).forEach(attr => el.setAttribute(attr, eval(attrs[attr]) || ''));
-        }
-        if (rClick !== null) {
-            assignClick(el, localVariables);
-        }
+        bind(el, localVariables === null ? contextOf(el) : localVariables);
     };
 
     // noinspection JSUnusedGlobalSymbols
@@ -0,0 +1,136 @@
+import json
+import os
+from typing import Callable, Dict, List, Tuple
+
+import gevent
+import pytest
+
+import app
+
+REPO_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir))
+
+
+class FakeSocket:
+    def shutdown(self, _):
+        pass
+
+
+class FakeHandler:
+    def __init__(self):
+        self.socket = FakeSocket()
+
+
+class FakeWebSocket:
+    """
+    Connection of a client which keeps the frames written to it
+    """
+
+    def __init__(self):
+        self.handler = FakeHandler()
+        self.closed = False
+        self.frames = []
+
+    def send(self, frame):
+        self.frames.append(json.loads(frame))
+
+    def close(self):
+        self.closed = True
+
+
+class Client:
+    """
+    Client connected over a FakeWebSocket, its messages are handled like the server handles them
+    """
+
+    def __init__(self):
+        self.websocket = FakeWebSocket()
+        self.client = app.GameClient(self.websocket)
+
+    def request(self, message_type: str, message: any) -> dict:
+        """
+        Sends a message and waits until it is handled
+        :return: event type -> message of the events sent to the client meanwhile
+        """
+        return {e['type']: e['message'] for e in self.events(message_type, message)}
+
+    def events(self, message_type: str, message: any) -> List[dict]:
+        """
+        Sends a message and waits until it is handled
+        :return: the events sent to the client meanwhile
+        """
+        received = len(self.websocket.frames)
+        with app.app.test_request_context('/soc'):
+            self.client.on_data({'type': message_type, 'message': message})
+        self.client.pool.join(timeout=5)
+        while self.client.outbox:
+            gevent.sleep(0.01)
+        return self.websocket.frames[received:]
+
+    def register(self, name: str) -> "Client":
+        """
+        Registers a new user and logs in as him
+        :return: self
+        """
+        key = self.request('register', name)['register']
+        self.request('login', key)
+        return self
+
+
+def start_game(connect: Callable[[], Client], *names: str) -> Tuple[int, Dict[str, Client], Dict[str, int]]:
+    """
+    Starts a game of the first user and lets the others enter it
+    :return: (id of the game, name -> client of the user, name -> id of the user's player)
+    """
+    clients = {name: connect().register(name) for name in names}
+    clients[names[0]].request('createGame', {'name': 'game', 'type': 1})
+    game_id = app.Game.query.filter_by(name='game').one().id
+    for name in names[1:]:
+        clients[name].request('enterGame', {'id': game_id})
+    players = {name: app.GamePlayer.query.filter_by(game_id=game_id, user_id=client.client.user_id,
+                                                    is_infinite=False).one().id
+               for name, client in clients.items()}
+    return game_id, clients, players
+
+
+@pytest.fixture
+def websocket() -> FakeWebSocket:
+    return FakeWebSocket()
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    """
+    Empty database with the game types, used by the app inside an application context
+    """
+    monkeypatch.setitem(app.app.config, 'SQLALCHEMY_DATABASE_URI', 'sqlite:///' + str(tmp_path / 'db.sqlite'))
+    monkeypatch.setattr(app.MESSAGE_QUERIES, 'values', {})
+    with app.app.app_context():
+        app.db.create_all()
+        app.migrate()
+        with open(os.path.join(REPO_DIR, 'data', 'game-types.json')) as f:
+            for name, config in json.load(f).items():
+                app.db.session.add(app.GameType(name=name, config=json.dumps(config)))
+        app.db.session.commit()
+        yield
+        # ids of games of this database are used again by the next one
+        for game_id, in app.db.session.query(app.Game.id):
+            app.ledger.forget(game_id)
+        app.db.session.remove()
+        app.db.get_engine().dispose()
+
+
+@pytest.fixture
+def connect(database) -> Callable[[], Client]:
+    """
+    :return: function connecting a new client, the clients are disconnected after the test
+    """
+    clients = []
+
+    def connect() -> Client:
+        client = Client()
+        clients.append(client)
+        return client
+
+    yield connect
+    for client in clients:
+        client.client.on_disconnect()
@@ -0,0 +1,58 @@
+from typing import Dict, List, Tuple
+
+import app
+from backup import unpack_game
+from conftest import start_game
+
+
+def balances(game_id: int) -> Dict[Tuple[str, str], Tuple]:
+    """
+    :return: (name of the player, currency) -> (amount, sent, received, sent_count)
+    """
+    return {(player.name, balance.currency): (balance.amount, balance.sent, balance.received, balance.sent_count)
+            for player, balance in app.db.session.query(app.GamePlayer, app.GamePlayerBalance)
+            .join(app.GamePlayerBalance, app.GamePlayerBalance.player_id == app.GamePlayer.id)
+            .filter(app.GamePlayer.game_id == game_id)}
+
+
+def history(game_id: int) -> List[Tuple]:
+    """
+    :return: (string, kind, amount, names of player1, player2 and the other participants) of the records in order
+    """
+    names = {p.id: p.name for p in app.GamePlayer.query.filter_by(game_id=game_id)}
+    records = app.HistoryRecord.query.filter_by(game_id=game_id).order_by(app.HistoryRecord.id).all()
+    participants = {}
+    for record_id, player_id in app.db.session.execute(app.select(
+            app.rel_record_players.c.record_id, app.rel_record_players.c.player_id)):
+        participants.setdefault(record_id, set()).add(names.get(player_id))
+    return [(r.string, r.kind, r.amount, names.get(r.player1_id), names.get(r.player2_id),
+             participants.get(r.id, set())) for r in records]
+
+
+def test_exported_game_is_imported_with_its_balances_and_history(connect):
+    game_id, clients, players = start_game(connect, 'owner', 'alice', 'bob')
+    alice = clients['alice']
+    alice.request('gameInfo', f'/game/{game_id}')
+    alice.request('sendMoney', {'game': game_id, 'player': players['alice'], 'recipient': players['owner'],
+                                'currency': 'M CZK', 'amount': 5})
+    alice.request('sendMoneyBatch', {'game': game_id, 'transfers': [
+        {'player': players['alice'], 'recipient': players[name], 'currency': 'M CZK', 'amount': 2}
+        for name in ('owner', 'bob')]})
+
+    data = app.export_game(game_id)
+    users = unpack_game(data)['tables'][app.User.__tablename__]
+    assert 'key' not in users['columns']
+
+    new_game_id, new_users = app.import_game(data)
+    app.db.session.remove()
+    assert app.db.session.get(app.Game, new_game_id).name == 'game (2)'
+    assert balances(new_game_id) == balances(game_id)
+    assert history(new_game_id) == history(game_id)
+    assert history(new_game_id)[-1][-1] == {'owner', 'bob'}  # participants of the batch point to the new players
+
+    old_keys = {user.name: user.key for user in app.User.query.filter(app.User.id.in_(
+        [client.client.user_id for client in clients.values()]))}
+    assert sorted(user['name'] for user in new_users) == sorted(old_keys)
+    for user in new_users:
+        assert user['key'] != old_keys[user['name']]
+        assert app.db.session.get(app.User, user['id']).key == user['key']
@@ -0,0 +1,70 @@
+from typing import List
+
+import gevent
+
+import app
+from conftest import Client, start_game
+
+
+def batches() -> List[int]:
+    """
+    :return: counts of game batches and of messages handled in them observed so far
+    """
+    counts, total = app.GAME_BATCH_MESSAGES.values.get((), ([0], [0.0]))
+    return [sum(counts), int(total[0])]
+
+
+def send_together(client: Client, game_id: int, names: List[str]) -> List[dict]:
+    """
+    Sends addPlayer messages without waiting for the replies in between, so the actor gets them at once
+    :return: the events sent to the client meanwhile
+    """
+    received = len(client.websocket.frames)
+    with app.app.test_request_context('/soc'):
+        for name in names:
+            client.client.on_data({'type': 'addPlayer', 'message': {'game': game_id, 'name': name}})
+    client.client.pool.join(timeout=5)
+    gevent.sleep(0.01)
+    return client.websocket.frames[received:]
+
+
+def added_players(game_id: int) -> List[str]:
+    app.db.session.remove()
+    return sorted(p.name for p in app.GamePlayer.query.filter_by(game_id=game_id, is_infinite=False))
+
+
+def test_messages_sent_together_are_handled_in_one_batch(connect):
+    game_id, clients, _ = start_game(connect, 'alice')
+    alice = clients['alice']
+    before = batches()
+
+    events = send_together(alice, game_id, ['first', 'second', 'third'])
+
+    after = batches()
+    assert after[0] - before[0] == 1
+    assert after[1] - before[1] == 3
+    assert sorted(e['message']['name'] for e in events if e['type'] == 'playerAdded') == ['first', 'second', 'third']
+    assert added_players(game_id) == ['alice', 'first', 'second', 'third']
+
+
+def test_failing_message_does_not_fail_the_others(connect, monkeypatch):
+    game_id, clients, _ = start_game(connect, 'alice')
+    alice = clients['alice']
+    add_player = app.handlers['addPlayer'].handle
+
+    def failing_add_player(request: app.Request):
+        if request.message['name'] == 'bad':
+            app.GamePlayer.create('half-added', request.game, request.user)
+            raise RuntimeError('failed')
+        return add_player(request)
+
+    monkeypatch.setattr(app.handlers['addPlayer'], 'handle', failing_add_player)
+    before = batches()
+
+    events = send_together(alice, game_id, ['first', 'bad', 'third'])
+
+    # the actor got one batch, which failed, so its messages were handled again one by one
+    after = batches()
+    assert after[0] - before[0] == 1
+    assert sorted(e['message']['name'] for e in events if e['type'] == 'playerAdded') == ['first', 'third']
+    assert added_players(game_id) == ['alice', 'first', 'third']
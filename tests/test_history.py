@@ -0,0 +1,51 @@
+import gevent
+
+import app
+from conftest import start_game
+
+
+def test_batch_record_is_shown_to_every_recipient(connect):
+    game_id, clients, players = start_game(connect, 'owner', 'alice', 'bob', 'carol')
+    clients['alice'].request('gameInfo', f'/game/{game_id}')
+    events = clients['alice'].request('sendMoneyBatch', {'game': game_id, 'transfers': [
+        {'player': players['alice'], 'recipient': players[name], 'currency': 'M CZK', 'amount': 1}
+        for name in ('bob', 'carol')]})
+    assert 'moneyTransfer' in events
+
+    for name in ('bob', 'carol', 'owner'):
+        history = clients[name].request('gameInfo', f'/game/{game_id}')['history']
+        assert any(record['text'].startswith('%p1% sent') for record in history['records']), name
+    clients['carol'].request('sendMoney', {'game': game_id, 'player': players['carol'], 'recipient': players['bob'],
+                                           'currency': 'M CZK', 'amount': 1})
+    history = clients['alice'].request('gameInfo', f'/game/{game_id}')['history']
+    assert [record['text'] for record in history['records'] if 'sent' in record['text']] == \
+           ['%p1% sent 1 M CZK to bob, 1 M CZK to carol']
+
+
+def test_transfer_record_is_sent_before_it_is_written(connect):
+    game_id, clients, players = start_game(connect, 'owner', 'alice')
+    alice = clients['alice']
+    alice.request('gameInfo', f'/game/{game_id}')
+    events = alice.request('sendMoney', {'game': game_id, 'player': players['alice'], 'recipient': players['owner'],
+                                         'currency': 'M CZK', 'amount': 1})
+    temporary_id = events['historyUpdate']['id']
+    assert temporary_id < 0
+
+    received = len(alice.websocket.frames)
+    app.ledger.flush(game_id)
+    gevent.sleep(0.01)
+    events = alice.websocket.frames[received:]
+    record = alice.request('gameInfo', f'/game/{game_id}')['history']['records'][-1]
+    assert events == [{'type': 'historyId', 'message': {'temporary': temporary_id, 'id': record['id']}}]
+
+
+def test_transfer_record_written_at_once_is_sent_with_its_id(connect, monkeypatch):
+    monkeypatch.setattr(app.ledger, 'durability', app.LedgerEngine.DURABILITY_SYNC)
+    game_id, clients, players = start_game(connect, 'owner', 'alice')
+    alice = clients['alice']
+    alice.request('gameInfo', f'/game/{game_id}')
+    events = alice.request('sendMoney', {'game': game_id, 'player': players['alice'], 'recipient': players['owner'],
+                                         'currency': 'M CZK', 'amount': 1})
+    record = alice.request('gameInfo', f'/game/{game_id}')['history']['records'][-1]
+    assert events['historyUpdate']['id'] == record['id'] > 0
+    assert 'historyId' not in events
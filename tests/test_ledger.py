@@ -0,0 +1,147 @@
+from decimal import Decimal
+from typing import Dict, List, Optional, Tuple
+
+import pytest
+
+from ledger import MAX_AMOUNT, LedgerEngine, NotEnoughMoney, StoredTransfer, TransferError, parse_amount
+
+GAME_ID = 1
+ALICE, BOB = 1, 2
+
+
+class Database:
+    """
+    Balances as written by all processes, transfers are refused if the sender does not have enough money
+    """
+
+    def __init__(self, balances: Dict[int, Decimal]):
+        self.balances = balances
+        self.loads = 0
+
+    def load(self, _: int):
+        self.loads += 1
+        return [(player_id, player_id, False, {'M': amount}) for player_id, amount in self.balances.items()]
+
+    def store_transfers(self, groups: List[Tuple[List[StoredTransfer], Optional[dict]]]) -> List[bool]:
+        results = []
+        for transfers, _ in groups:
+            if any(guarded and self.balances[sender_id] < amount for sender_id, _, _, amount, guarded in transfers):
+                results.append(False)
+                continue
+            for sender_id, recipient_id, _, amount, _ in transfers:
+                self.balances[sender_id] -= amount
+                self.balances[recipient_id] += amount
+            results.append(True)
+        return results
+
+
+def engine(database: Database) -> LedgerEngine:
+    return LedgerEngine(database.load, lambda *_: None, database.store_transfers,
+                        durability=LedgerEngine.DURABILITY_SYNC)
+
+
+def test_transfer_refused_by_stale_balances_is_retried():
+    database = Database({ALICE: Decimal(0), BOB: Decimal(10)})
+    ledger = engine(database)
+    ledger.game(GAME_ID)
+    database.balances[ALICE] = Decimal(5)  # received by another process
+    assert ledger.transfer(GAME_ID, ALICE, BOB, 'M', Decimal(3)) == (Decimal(2), Decimal(13))
+    assert database.balances == {ALICE: Decimal(2), BOB: Decimal(13)}
+    assert database.loads == 2
+
+
+def test_transfer_refused_by_the_database_is_retried_once():
+    database = Database({ALICE: Decimal(5), BOB: Decimal(10)})
+    ledger = engine(database)
+    ledger.game(GAME_ID)
+    database.balances[ALICE] = Decimal(1)  # sent by another process
+    with pytest.raises(NotEnoughMoney):
+        ledger.transfer(GAME_ID, ALICE, BOB, 'M', Decimal(3))
+    assert ledger.game(GAME_ID).balances[ALICE] == {'M': Decimal(1)}
+    assert database.loads == 2
+
+
+def test_write_behind_trusts_the_memory():
+    database = Database({ALICE: Decimal(0), BOB: Decimal(10)})
+    ledger = LedgerEngine(database.load, lambda *_: None, database.store_transfers)
+    with pytest.raises(NotEnoughMoney):
+        ledger.transfer(GAME_ID, ALICE, BOB, 'M', Decimal(3))
+    assert database.loads == 1
+
+
+def test_written_record_is_waited_for_until_the_flush():
+    database = Database({ALICE: Decimal(5), BOB: Decimal(10)})
+    stored = []
+
+    def store(_, records: List[dict]) -> None:
+        for record in records:
+            record['id'] = len(stored) + 1
+            stored.append(record)
+
+    ledger = LedgerEngine(database.load, store, database.store_transfers)
+    record = {'string': 'sent'}
+    ledger.transfer(GAME_ID, ALICE, BOB, 'M', Decimal(3), record)
+    ids = []
+    ledger.when_written(GAME_ID, lambda: ids.append(record.get('id')))
+    assert ids == []
+    ledger.flush()
+    assert ids == [1]
+    ledger.when_written(GAME_ID, lambda: ids.append(record.get('id')))
+    assert ids == [1, 1]
+
+
+def test_flush_of_one_game_leaves_other_games_pending():
+    players = {1: (ALICE, BOB), 2: (3, 4)}
+    stored = []
+    ledger = LedgerEngine(lambda game_id: [(player_id, player_id, False, {'M': Decimal(10)})
+                                           for player_id in players[game_id]],
+                          lambda deltas, records: stored.append((set(deltas), records)),
+                          Database({}).store_transfers)
+    for game_id, (sender_id, recipient_id) in players.items():
+        ledger.transfer(game_id, sender_id, recipient_id, 'M', Decimal(1), {'game_id': game_id})
+    ledger.flush(1)
+    assert stored == [({(ALICE, 'M'), (BOB, 'M')}, [{'game_id': 1}])]
+    ledger.flush()
+    assert stored[1:] == [({(3, 'M'), (4, 'M')}, [{'game_id': 2}])]
+
+
+@pytest.mark.parametrize('value', ['1e13', '1e40', 'inf', 'nan', 'abc'])
+def test_invalid_or_too_large_amount_is_refused(value):
+    with pytest.raises(TransferError):
+        parse_amount(value)
+
+
+def test_balance_over_the_limit_is_refused_before_it_is_written():
+    database = Database({ALICE: Decimal(0), BOB: MAX_AMOUNT - 1})
+    stored = []
+    ledger = LedgerEngine(lambda _: [(ALICE, ALICE, True, {'M': Decimal(0)}), (BOB, BOB, False, {'M': MAX_AMOUNT - 1})],
+                          lambda deltas, records: stored.append(deltas), database.store_transfers)
+    with pytest.raises(TransferError):
+        ledger.transfer(GAME_ID, ALICE, BOB, 'M', Decimal(2))
+    with pytest.raises(TransferError):
+        ledger.transfer(GAME_ID, ALICE, BOB, 'M', MAX_AMOUNT + 1)
+    ledger.flush()
+    assert stored == [] and ledger.game(GAME_ID).balances[BOB] == {'M': MAX_AMOUNT - 1}
+    ledger.transfer(GAME_ID, ALICE, BOB, 'M', Decimal(1))
+
+
+def test_game_which_cannot_be_written_does_not_hold_back_other_games():
+    players = {1: (ALICE, BOB), 2: (3, 4)}
+    stored = []
+
+    def store(deltas, records: List[dict]) -> None:
+        if records[0]['game_id'] == 1:
+            raise OverflowError('Python int too large to convert to SQLite INTEGER')
+        stored.append(records)
+
+    ledger = LedgerEngine(lambda game_id: [(player_id, player_id, False, {'M': Decimal(10)})
+                                           for player_id in players[game_id]],
+                          store, Database({}).store_transfers)
+    for game_id, (sender_id, recipient_id) in players.items():
+        ledger.transfer(game_id, sender_id, recipient_id, 'M', Decimal(1), {'game_id': game_id})
+    with pytest.raises(OverflowError):
+        ledger.flush()
+    assert stored == [[{'game_id': 2}]]
+    with pytest.raises(OverflowError):
+        ledger.flush()
+    assert stored == [[{'game_id': 2}]]
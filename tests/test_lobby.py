@@ -0,0 +1,46 @@
+import gevent
+
+import app
+
+
+def names(page: dict) -> list:
+    return [game['name'] for game in page['games']]
+
+
+def test_lobby_is_paged_and_searched(connect, monkeypatch):
+    monkeypatch.setitem(app.CONFIG, 'lobby_page_size', 2)
+    owner = connect().register('owner')
+    for name in ('alpha', 'Beta', 'beta 2', 'gamma', 'delta'):
+        owner.request('createGame', {'name': name, 'type': 1})
+
+    user = connect().register('user')
+    page = user.request('listGames', {'page': 0})['listGames']
+    assert (names(page), page['more']) == (['delta', 'gamma'], True)
+    page = user.request('listGames', {'page': 2})['listGames']
+    assert (names(page), page['more']) == (['alpha'], False)
+    page = user.request('listGames', {'page': 0, 'prefix': 'BET'})['listGames']
+    assert (names(page), page['more']) == (['beta 2', 'Beta'], False)
+
+
+def test_lobby_gets_diffs_of_created_and_hidden_games(connect):
+    owner, user = connect().register('owner'), connect().register('user')
+    user.request('listGames', {'page': 0})
+
+    received = len(user.websocket.frames)
+    owner.request('createGame', {'name': 'new', 'type': 1, 'password': 'secret'})
+    game_id = app.Game.query.filter_by(name='new').one().id
+    owner.request('hideGame', {'game': game_id})
+    gevent.sleep(0.01)
+    assert [e['message'] for e in user.websocket.frames[received:] if e['type'] == 'lobbyDiff'] == [
+        {'added': [{'id': game_id, 'name': 'new', 'game': 'Monopoly - Cesko', 'password': True}], 'removed': []},
+        {'added': [], 'removed': [game_id]}]
+    assert names(user.request('listGames', {'page': 0})['listGames']) == []
+
+
+def test_games_from_before_the_upgrade_stay_in_the_lobby(connect):
+    owner = connect().register('owner')
+    owner.request('createGame', {'name': 'old', 'type': 1})
+    app.db.session.execute(app.Game.__table__.update().values(active_at=None))
+    app.db.session.commit()
+    app.migrate()
+    assert names(connect().register('user').request('listGames', {'page': 0})['listGames']) == ['old']
@@ -0,0 +1,39 @@
+import json
+
+import app
+from conftest import FakeWebSocket
+
+
+def frame(event_type: str, message: any) -> str:
+    return json.dumps({'type': event_type, 'message': message})
+
+
+def test_overflow_keeps_the_newest_replaceable_frame(monkeypatch, websocket: FakeWebSocket):
+    monkeypatch.setitem(app.CONFIG, 'outbound_queue_size', 3)
+    client = app.GameClient(websocket)
+    try:
+        session = app.Session(1, 100)
+        session.attach(client)
+        client.send_raw(frame('playersSnapshot', 1), replaces='players')
+        client.send_raw(frame('moneyTransfer', 1))
+        client.send_raw(frame('moneyTransfer', 2))
+        client.send_raw(frame('playersSnapshot', 2), replaces='players')
+        assert client.evicted
+        assert [json.loads(f)['message'] for f in session.buffer] == [1, 1, 2, 2]
+        assert session.buffer[-1] == frame('playersSnapshot', 2)
+    finally:
+        client.on_disconnect()
+
+
+def test_replaceable_frame_is_coalesced_below_the_limit(monkeypatch, websocket: FakeWebSocket):
+    monkeypatch.setitem(app.CONFIG, 'outbound_queue_size', 3)
+    client = app.GameClient(websocket)
+    try:
+        client.send_raw(frame('playersSnapshot', 1), replaces='players')
+        client.send_raw(frame('moneyTransfer', 1))
+        client.send_raw(frame('playersSnapshot', 2), replaces='players')
+        assert not client.evicted
+        assert [entry[0] for entry in client.outbox] == [frame('moneyTransfer', 1), frame('playersSnapshot', 2)]
+        assert client.queued == 2
+    finally:
+        client.on_disconnect()
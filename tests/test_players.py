@@ -0,0 +1,23 @@
+import gevent
+
+from conftest import start_game
+
+
+def test_missed_change_of_players_is_in_the_next_snapshot(connect):
+    game_id, clients, _ = start_game(connect, 'alice', 'bob')
+    alice, bob = clients['alice'], clients['bob']
+    seq = alice.request('gameInfo', f'/game/{game_id}')['playersSnapshot']['seq']
+
+    received = len(alice.websocket.frames)
+    for name in ('first', 'second', 'third'):
+        bob.request('addPlayer', {'game': game_id, 'name': name})
+    gevent.sleep(0.01)
+    changes = [e['message'] for e in alice.websocket.frames[received:] if e['type'] == 'playerAdded']
+    assert [change['seq'] for change in changes] == [seq + 1, seq + 2, seq + 3]
+
+    # the client applies changes in the order of their numbers and asks for a snapshot when one of them is missing
+    missed = changes.pop(1)
+    assert changes[1]['seq'] != changes[0]['seq'] + 1
+    snapshot = alice.request('playersSnapshot', {'game': game_id})['playersSnapshot']
+    assert snapshot['seq'] >= missed['seq']
+    assert snapshot['playersAll'][str(missed['id'])] == 'second'
@@ -0,0 +1,49 @@
+import json
+import os
+from typing import Callable
+
+import app
+from conftest import REPO_DIR, Client
+
+with open(os.path.join(REPO_DIR, 'bench', 'query_budget.json')) as f:
+    QUERY_BUDGET = json.load(f)
+
+
+def queries_per_message(message_type: str) -> float:
+    counts, total = app.MESSAGE_QUERIES.values[(message_type,)]
+    return total[0] / sum(counts)
+
+
+def test_messages_stay_in_query_budget(connect: Callable[[], Client]):
+    """
+    Counts of queries of the messages do not grow with the count of players
+    """
+    owner = connect()
+    key = owner.request('register', 'owner')['register']
+    assert owner.request('login', key)['login'] == 'owner'
+    owner.request('listGames', {'page': 0})
+    owner.request('createGame', {'name': 'budget', 'type': 1, 'password': ''})
+    game_id = app.Game.query.filter_by(name='budget').one().id
+
+    for i in range(10):
+        client = connect()
+        key = client.request('register', f'user{i}')['register']
+        client.request('login', key)
+        client.request('listGames', {'page': 0})
+        assert 'gameEnter' in client.request('enterGame', {'id': game_id})
+        assert 'gameInfo' in client.request('gameInfo', f'/game/{game_id}')
+    owner.request('gameInfo', f'/game/{game_id}')
+    for i in range(10):
+        assert 'playerAdded' in owner.request('addPlayer', {'game': game_id, 'name': f'player{i}'})
+
+    players = [p.id for p in app.GamePlayer.query.filter_by(game_id=game_id, user_id=owner.client.user_id,
+                                                             is_infinite=False)]
+    for i in range(20):
+        events = owner.request('sendMoney', {'game': game_id, 'player': players[i % len(players)],
+                                             'recipient': players[(i + 1) % len(players)], 'currency': 'M CZK',
+                                             'amount': 1})
+        assert 'moneyTransfer' in events, events
+
+    for message_type, budget in QUERY_BUDGET.items():
+        assert (message_type,) in app.MESSAGE_QUERIES.values, f'{message_type} was not sent'
+        assert queries_per_message(message_type) <= budget, message_type
@@ -0,0 +1,43 @@
+from decimal import Decimal
+
+import pytest
+
+import app
+from conftest import start_game
+
+
+@pytest.mark.parametrize('durability', [app.LedgerEngine.DURABILITY_WRITE_BEHIND, app.LedgerEngine.DURABILITY_SYNC])
+def test_batch_is_sent_whole_or_not_at_all(connect, monkeypatch, durability):
+    monkeypatch.setattr(app.ledger, 'durability', durability)
+    game_id, clients, players = start_game(connect, 'alice', 'bob', 'carol')
+    alice = clients['alice']
+    alice.request('gameInfo', f'/game/{game_id}')
+    balances = {name: app.ledger.game(game_id).balances[player_id]['M CZK'] for name, player_id in players.items()}
+
+    events = alice.request('sendMoneyBatch', {'game': game_id, 'transfers': [
+        {'player': players['alice'], 'recipient': players['bob'], 'currency': 'M CZK', 'amount': 1},
+        {'player': players['alice'], 'recipient': players['carol'], 'currency': 'M CZK',
+         'amount': str(balances['alice'])}]})
+    assert events == {'sendMoneyBatchERR': 'You do not have enought money'}
+
+    app.ledger.flush(game_id)
+    app.db.session.remove()
+    for name, player_id in players.items():
+        assert app.ledger.game(game_id).balances[player_id]['M CZK'] == balances[name], name
+        assert app.GamePlayerBalance.query.filter_by(player_id=player_id).one().amount == balances[name], name
+    assert app.HistoryRecord.query.filter_by(game_id=game_id, kind=app.HistoryRecord.KIND_TRANSFER_BATCH).count() == 0
+
+    events = alice.request('sendMoneyBatch', {'game': game_id, 'transfers': [
+        {'player': players['alice'], 'recipient': players[name], 'currency': 'M CZK', 'amount': 1}
+        for name in ('bob', 'carol')]})
+    assert [(t['recipient'], t['senderAmount']) for t in events['moneyTransfer']] == \
+           [(players['bob'], float(balances['alice'] - 1)), (players['carol'], float(balances['alice'] - 2))]
+
+
+def test_batch_with_invalid_transfer_is_refused(connect):
+    game_id, clients, players = start_game(connect, 'alice', 'bob')
+    events = clients['alice'].request('sendMoneyBatch', {'game': game_id, 'transfers': [
+        {'player': players['alice'], 'recipient': players['bob'], 'currency': 'M CZK', 'amount': 1},
+        {'player': players['alice'], 'recipient': players['bob'], 'currency': 'M CZK', 'amount': '1e40'}]})
+    assert events == {'sendMoneyBatchERR': 'Invalid amount'}
+    assert app.ledger.game(game_id).balances[players['bob']]['M CZK'] == Decimal(15)
@@ -0,0 +1,30 @@
+import gevent
+
+from conftest import start_game
+
+
+def test_resumed_session_gets_events_sent_while_disconnected(connect):
+    game_id, clients, players = start_game(connect, 'alice', 'bob')
+    alice, bob = clients['alice'], clients['bob']
+    alice.request('gameInfo', f'/game/{game_id}')
+    types = [e['type'] for e in alice.websocket.frames]
+    token = alice.websocket.frames[types.index('session')]['message']['token']
+    received = len(types) - types.index('session')  # frames are numbered from the session frame
+    alice.client.on_disconnect()
+
+    bob.request('sendMoney', {'game': game_id, 'player': players['bob'], 'recipient': players['alice'],
+                              'currency': 'M CZK', 'amount': 2})
+    gevent.sleep(0.01)
+    assert len(alice.websocket.frames) == len(types)
+
+    resumed = connect()
+    events = resumed.events('resume', {'token': token, 'received': received})
+    assert [e['type'] for e in events] == ['moneyTransfer', 'historyUpdate', 'resume']
+    assert events[0]['message']['recipientAmount'] == 17
+    assert resumed.request('playersSnapshot', {'game': game_id})['playersSnapshot']['user'] == \
+           alice.client.user_id
+
+
+def test_unknown_session_cannot_be_resumed(connect):
+    assert connect().request('resume', {'token': 'unknown', 'received': 1}) == \
+           {'resumeERR': 'The session cannot be resumed'}
@@ -0,0 +1,27 @@
+from conftest import start_game
+
+
+def test_stats_sum_the_transfers(connect):
+    game_id, clients, players = start_game(connect, 'owner', 'alice', 'bob')
+    alice, bob = clients['alice'], clients['bob']
+
+    def transfer(sender: str, recipient: str, amount: int) -> dict:
+        return {'player': players[sender], 'recipient': players[recipient], 'currency': 'M CZK', 'amount': amount}
+
+    for amount in (2, 3):
+        alice.request('sendMoney', dict(transfer('alice', 'bob', amount), game=game_id))
+    bob.request('sendMoney', dict(transfer('bob', 'alice', 1), game=game_id))
+    alice.request('sendMoneyBatch', {'game': game_id, 'transfers': [transfer('alice', 'bob', 1),
+                                                                     transfer('alice', 'owner', 1.5)]})
+
+    stats = alice.request('gameStats', {'game': game_id})['gameStats']
+    assert stats['transfers'] == 5
+    assert stats['currencies'] == [{'currency': 'M CZK', 'volume': 8.5, 'transfers': 5}]
+    assert stats['players'] == [{'id': players['alice'], 'name': 'alice', 'money': [
+        {'currency': 'M CZK', 'sent': 7.5, 'received': 1.0, 'sentCount': 4, 'receivedCount': 1}]}]
+
+    stats = clients['owner'].request('gameStats', {'game': game_id})['gameStats']
+    money = {player['name']: player['money'][0] for player in stats['players']}
+    assert set(money) == {'Bank', 'owner', 'alice', 'bob'}
+    assert (money['bob']['received'], money['bob']['receivedCount']) == (6.0, 3)
+    assert (money['owner']['received'], money['Bank']['sent']) == (1.5, 0.0)
@@ -0,0 +1,16 @@
+import os
+import subprocess
+import sys
+
+REPO_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir))
+
+
+def test_workers_confirm_transfers(tmp_path):
+    """
+    Workers keep their own ledgers of the games, none of them may refuse transfers by stale balances
+    """
+    r = subprocess.run([sys.executable, os.path.join(REPO_DIR, 'bench', 'soc_bench.py'), '--clients', '40',
+                        '--players-per-game', '10', '--duration', '3', '--ramp', '1', '--config', '{"workers": 2}',
+                        '--max-error-rate', '0.01', '--output', str(tmp_path / 'results.json')],
+                       capture_output=True, text=True, timeout=180)
+    assert r.returncode == 0, r.stderr
@@ -0,0 +1,89 @@
+import json
+import zlib
+from typing import Iterable, NamedTuple, Optional, Union
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    from crypt import SealedFrame, seal
+except ImportError:
+    SealedFrame = seal = None
+
+ENCODING_JSON = 'json'
+ENCODING_MSGPACK = 'msgpack'
+COMPRESSION_DEFLATE = 'deflate'
+ENCRYPTION_AES_CTR_HMAC = 'aes-ctr-hmac'
+
+# Flags in the first byte of binary frames, text frames are always plain JSON
+FLAG_MSGPACK = 1
+FLAG_DEFLATE = 2
+# the rest of the frame is sealed by crypt.seal() and wrapped for the connection by crypt.FrameCrypt
+FLAG_ENCRYPTED = 4
+
+# A frame returned by WireFormat.encode()
+EncodedFrame = Union[str, bytes, 'SealedFrame']
+
+
+def supported_encodings() -> Iterable[str]:
+    """
+    :return: encodings available in this process, the preferred one first
+    """
+    if msgpack is not None:
+        yield ENCODING_MSGPACK
+    yield ENCODING_JSON
+
+
+class WireFormat(NamedTuple):
+    """
+    How frames are encoded for one connection
+    Connections with equal formats receive the same encoded frames
+    """
+    encoding: str = ENCODING_JSON
+    compression: Optional[str] = None
+    # set by the server, not negotiated
+    encryption: Optional[str] = None
+
+    @classmethod
+    def negotiate(cls, encodings: Iterable[str], compressions: Iterable[str]) -> "WireFormat":
+        """
+        Chooses the best format both sides support
+        :param encodings: encodings accepted by the client
+        :param compressions: compressions accepted by the client
+        :return: the format, plain JSON if the client does not accept anything else
+        """
+        encodings = set(encodings)
+        encoding = next((e for e in supported_encodings() if e in encodings), ENCODING_JSON)
+        compression = COMPRESSION_DEFLATE if COMPRESSION_DEFLATE in compressions else None
+        return cls(encoding, compression)
+
+    def encode(self, frame: str, compression_threshold: int, compression_level: int = 6) -> EncodedFrame:
+        """
+        Encodes a JSON frame for the connection
+        Binary frames start with a byte of FLAG_* telling how the rest is encoded
+        :param frame: the frame encoded as JSON
+        :param compression_threshold: frames shorter than this (in bytes) are not compressed
+        :param compression_level: zlib compression level
+        :return: the frame as str if it remains plain JSON, SealedFrame to be wrapped for every connection
+                 if it is encrypted, bytes otherwise
+        """
+        flags = 0
+        if self.encoding == ENCODING_MSGPACK:
+            data = msgpack.packb(json.loads(frame))
+            flags |= FLAG_MSGPACK
+        else:
+            data = frame.encode('utf8')
+        if self.compression == COMPRESSION_DEFLATE and len(data) >= compression_threshold:
+            data = zlib.compress(data, compression_level)
+            flags |= FLAG_DEFLATE
+        if self.encryption == ENCRYPTION_AES_CTR_HMAC:
+            return seal(bytes((flags | FLAG_ENCRYPTED,)), data)
+        if not flags:
+            return frame
+        return bytes((flags,)) + data
+
+
+# Format of clients which did not negotiate anything
+PLAIN_JSON = WireFormat()